@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmark for the compare_replace step of md2pdf_webserver.
+
+Compares the compiled CompareReplacer against the original approach (every
+rule applied to every line with str.replace, and the output built up by string
+concatenation), and checks that both give exactly the same output.
+
+Usage: python3 benchmarks/compare_replace_benchmark.py [--lines N] [--rules N]
+'''
+
+import argparse
+import io
+import logging
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import md2pdf_webserver
+
+logging.disable(logging.CRITICAL)
+
+
+def original_compare_replace(in_file, replace_maps):
+    # The compare_replace loop from before the rules were compiled
+    output_file = ""
+    for line in in_file:
+        output_line = line
+        for replace_map in replace_maps:
+            for key in replace_map:
+                output_line = output_line.replace(key, replace_map[key])
+        output_file += output_line
+    return output_file
+
+
+def make_rules(count, rng):
+    # Rules in the style of a real config: one map per rule, mostly distinct words
+    rules = []
+    for index in range(count):
+        word = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(6, 12)))
+        rules.append({"{}{}".format(word, index): "\\textbf{{{}}}".format(word.upper())})
+    return rules
+
+
+def make_document(lines, rules, rng):
+    keys = [key for replace_map in rules for key in replace_map]
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "figure", "table", "section"]
+    document = []
+    for index in range(lines):
+        line = [rng.choice(words) for _ in range(rng.randint(5, 15))]
+        if keys and rng.random() < 0.3:
+            line.insert(rng.randint(0, len(line)), rng.choice(keys))
+        document.append(" ".join(line) + "\n")
+    return "".join(document)
+
+
+def random_rules(rng):
+    # Small alphabets, so rules overlap and feed into each other as often as possible
+    alphabet = "ab\n"
+    rules = []
+    for index in range(rng.randint(1, 6)):
+        key = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 3)))
+        value = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 3)))
+        rules.append({key: value})
+    return rules
+
+
+def check_equivalence(trials, rng):
+    # Compare against the original on random, heavily overlapping rule sets
+    for trial in range(trials):
+        rules = random_rules(rng)
+        text = "".join(rng.choice("ab\n") for _ in range(rng.randint(0, 40)))
+        expected = original_compare_replace(io.StringIO(text), rules)
+        output = io.StringIO()
+        md2pdf_webserver.CompareReplacer(rules).apply_file(io.StringIO(text), output)
+        if output.getvalue() != expected:
+            print("MISMATCH for rules {!r} on text {!r}".format(rules, text))
+            return False
+    return True
+
+
+def time_it(function, repeat):
+    best = None
+    for attempt in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the compare_replace step")
+    parser.add_argument('--lines', type=int, default=10000, help="Number of lines in the document")
+    parser.add_argument('--rules', type=int, default=300, help="Number of replacement rules")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of timed runs, the best is reported")
+    parser.add_argument('--trials', type=int, default=20000, help="Number of random equivalence checks")
+    args = parser.parse_args()
+
+    rng = random.Random(1234)
+    rules = make_rules(args.rules, rng)
+    document = make_document(args.lines, rules, rng)
+
+    old_time, old_output = time_it(lambda: original_compare_replace(io.StringIO(document), rules), args.repeat)
+
+    compile_time, replacer = time_it(lambda: md2pdf_webserver.CompareReplacer(rules), args.repeat)
+
+    def compiled():
+        output = io.StringIO()
+        replacer.apply_file(io.StringIO(document), output)
+        return output.getvalue()
+    new_time, new_output = time_it(compiled, args.repeat)
+
+    print("Document: {} lines, {} bytes; rules: {} in {} passes".format(
+        args.lines, len(document), args.rules, len(replacer.passes)))
+    print("Original: {:8.1f} ms".format(old_time * 1000))
+    print("Compiled: {:8.1f} ms (plus {:.1f} ms to compile the rules once, at startup)".format(
+        new_time * 1000, compile_time * 1000))
+    print("Speed-up: {:8.1f}x".format(old_time / new_time))
+    same = (old_output == new_output)
+    print("Output identical: {}".format(same))
+    equivalent = check_equivalence(args.trials, rng)
+    print("Random equivalence checks ({}): {}".format(args.trials, "passed" if equivalent else "FAILED"))
+    if not (same and equivalent):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
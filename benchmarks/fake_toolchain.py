@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+'''
+Stand-in for the tools in the TeX Live chroot, used by load_test.py.
+
+Acts as pandoc, xelatex or latexdiff (the first argument), or as one of the
+figure converters (epstopdf, rsvg-convert or ImageMagick's convert), taking a
+configurable amount of time and writing output of a fixed size, so the server
+can be measured without a real TeX Live install. As the real tools do, Pandoc
+converts each SVG figure for every PDF, and xelatex converts each EPS figure on
+every pass. The settings are read from
+fake-toolchain.json in the stand-in chroot, which is given by $FAKE_ROOT.
+
+Usage: fake_toolchain.py (pandoc|xelatex|latexdiff|epstopdf|rsvg-convert|convert) [tool arguments...]
+'''
+
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import time
+
+
+def load_config():
+    config = {"pdf_kb": 100, "latex_passes": 2, "tools": {}}
+    try:
+        with open(os.path.join(os.environ.get("FAKE_ROOT", "/"), "fake-toolchain.json"), 'rt') as config_file:
+            config.update(json.load(config_file))
+    except FileNotFoundError:
+        pass
+    return config
+
+
+def chroot_path(path):
+    # Absolute paths are inside the stand-in chroot
+    if os.path.isabs(path):
+        return os.path.join(os.environ.get("FAKE_ROOT", "/"), path.lstrip("/"))
+    return path
+
+
+def simulate(config, tool, input_files):
+    # Sleep for the configured latency: a fixed part plus a part for each MB of input,
+    # scaled by a log-normal factor if a sigma is set. The factor is seeded from the
+    # input, so the same corpus gives the same timings on every run.
+    settings = config["tools"].get(tool, {})
+    input_hash = hashlib.sha256(tool.encode("utf-8"))
+    input_size = 0
+    for input_file in input_files:
+        with open(input_file, 'rb') as in_file:
+            data = in_file.read()
+        input_size += len(data)
+        input_hash.update(data)
+    latency = settings.get("latency", 0.0) + settings.get("per_mb", 0.0) * input_size / (1024 * 1024)
+    sigma = settings.get("sigma", 0.0)
+    if sigma > 0:
+        latency *= random.Random(input_hash.digest()).lognormvariate(0, sigma)
+    time.sleep(latency)
+
+
+def write_pdf(config, path):
+    size = int(config["pdf_kb"] * 1024)
+    header = b"%PDF-1.5\n% fake output from fake_toolchain.py\n"
+    with open(path, 'wb') as pdf_file:
+        pdf_file.write(header + b"0" * max(0, size - len(header)))
+
+
+def simulate_figures(config, input_files, passes):
+    # Take the time to convert the SVG figures used by the input once, and the EPS figures on every
+    # pass, as figures which were already converted into PDF are used as they are
+    for input_file in input_files:
+        with open(input_file, 'rt', encoding="utf-8") as in_file:
+            paths = re.findall(r"(?:\]\(|\\includegraphics(?:\[[^\]]*\])?\{)([^)}\s]+)", in_file.read())
+        for path in paths:
+            extension = os.path.splitext(path)[1].lower()
+            figure = [path] if os.path.isfile(path) else []
+            if extension == ".svg":
+                simulate(config, "rsvg-convert", figure)
+            elif extension == ".eps":
+                for latex_pass in range(passes):
+                    simulate(config, "epstopdf", figure)
+
+
+def write_figure(input_path, output_path, fraction):
+    # Write a converted figure, of a fraction of the size of the original
+    with open(input_path, 'rb') as in_file:
+        data = in_file.read()
+    with open(output_path, 'wb') as out_file:
+        out_file.write(data[:max(1, int(len(data) * fraction))])
+
+
+def option_value(argv, name):
+    for index, arg in enumerate(argv):
+        if arg == name and index + 1 < len(argv):
+            return argv[index + 1]
+        if arg.startswith(name + "="):
+            return arg[len(name) + 1:]
+    return None
+
+
+def fake_pandoc(config, argv):
+    output = option_value(argv, "-o")
+    inputs = [arg for arg in argv if arg.endswith(".md")]
+    template = option_value(argv, "--template")
+    if template and not os.path.isfile(chroot_path(template)) and not os.path.isfile(template):
+        print("pandoc: template '{}' not found".format(template), file=sys.stderr)
+        return 1
+    simulate(config, "pandoc", inputs)
+    if output.endswith(".pdf"):
+        # Pandoc runs xelatex itself, from scratch, until the cross-references settle
+        for latex_pass in range(config["latex_passes"]):
+            simulate(config, "xelatex", inputs)
+        simulate_figures(config, inputs, config["latex_passes"])
+        write_pdf(config, output)
+        return 0
+    if output.endswith(".html"):
+        # A draft preview, with no LaTeX involved
+        with open(output, 'wt', encoding="utf-8") as out_file:
+            out_file.write("<!DOCTYPE html>\n<html><body><!-- fake output from fake_toolchain.py --></body></html>\n")
+        return 0
+    # Write LaTeX in the shape Pandoc gives, so the LaTeX filters have some work to do
+    with open(output, 'wt', encoding="utf-8") as out_file:
+        out_file.write("\\documentclass{article}\n\\begin{document}\n")
+        for input_md in inputs:
+            with open(input_md, 'rt', encoding="utf-8") as in_file:
+                for index, line in enumerate(in_file):
+                    if line.startswith("#"):
+                        label = "sec-{}".format(index)
+                        out_file.write("\\hypertarget{{{0}}}{{%\n\\section{{{1}}}\\label{{{0}}}}}\n".format(
+                            label, line.strip("# \n")))
+                    else:
+                        out_file.write(line)
+        out_file.write("\\end{document}\n")
+    return 0
+
+
+def fake_xelatex(config, argv):
+    if "-ini" in argv:
+        # Building a format file
+        job_name = option_value(argv, "-jobname")
+        simulate(config, "xelatex", [])
+        with open(job_name + ".fmt", 'wb') as format_file:
+            format_file.write(b"fake format\n")
+        return 0
+    inputs = [arg for arg in argv if arg.endswith(".latex") or arg.endswith(".tex")]
+    simulate(config, "xelatex", inputs)
+    simulate_figures(config, inputs[-1:], 1)
+    output_stem = os.path.join(option_value(argv, "-output-directory") or ".",
+                               os.path.splitext(os.path.basename(inputs[-1]))[0])
+    # Write the labels into the aux file as LaTeX does, so a pass changes it until the labels settle
+    with open(inputs[-1], 'rt', encoding="utf-8") as in_file:
+        labels = re.findall(r"\\label\{([^}]*)\}", in_file.read())
+    with open(output_stem + ".aux", 'wt', encoding="utf-8") as aux_file:
+        aux_file.write("".join("\\newlabel{{{}}}{{}}\n".format(label) for label in labels))
+    with open(output_stem + ".log", 'wt', encoding="utf-8") as log_file:
+        log_file.write("This is a fake XeTeX\n")
+    write_pdf(config, output_stem + ".pdf")
+    return 0
+
+
+def fake_latexdiff(config, argv):
+    old_latex, new_latex = [arg for arg in argv if arg.endswith(".latex")][-2:]
+    simulate(config, "latexdiff", [old_latex, new_latex])
+    with open(new_latex, 'rb') as in_file:
+        sys.stdout.buffer.write(in_file.read())
+    return 0
+
+
+def fake_epstopdf(config, argv):
+    simulate(config, "epstopdf", argv[-1:])
+    write_figure(argv[-1], option_value(argv, "--outfile"), 0.25)
+    return 0
+
+
+def fake_rsvg_convert(config, argv):
+    simulate(config, "rsvg-convert", argv[-1:])
+    write_figure(argv[-1], option_value(argv, "-o"), 0.5)
+    return 0
+
+
+def fake_convert(config, argv):
+    # Called as: convert input -resize geometry output
+    simulate(config, "convert", argv[:1])
+    write_figure(argv[0], argv[-1], 0.25)
+    return 0
+
+
+def main():
+    tool = sys.argv[1]
+    argv = sys.argv[2:]
+    if "--version" in argv:
+        print("{}-fake 1.0".format(tool))
+        return 0
+    config = load_config()
+    return {"pandoc": fake_pandoc, "xelatex": fake_xelatex, "latexdiff": fake_latexdiff, "epstopdf": fake_epstopdf,
+            "rsvg-convert": fake_rsvg_convert, "convert": fake_convert}[tool](config, argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
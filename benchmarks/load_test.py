@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+'''
+Load test for md2pdf_webserver, which needs no TeX Live chroot.
+
+Runs the real App under CherryPy (or the AsyncServer, with --engine asyncio),
+with a stand-in chroot whose pandoc, xelatex
+and latexdiff are fake tools (see fake_toolchain.py) with a configurable
+latency and output size. A pool of clients then uploads synthetic documents,
+waits for each one with the status API and fetches the PDF. The latency of
+each job (from the start of the upload to the end of the fetch) and the
+throughput are reported for each kind of document:
+
+- notes: a single short Markdown file
+- manual: a long Markdown file, of about 200 pages
+- images: a short Markdown file with many images
+- figures: a short Markdown file with EPS and SVG figures, which every upload shares
+- compare: an old and new version of a document, rendered in compare mode
+
+With --nodes, several servers are started as separate processes on
+consecutive ports, as a cluster. Each job is uploaded to one server and
+its status and PDF are requested from the next one, so the requests for
+the hash have to be forwarded to its owner (or found in --shared-storage).
+
+Every document is unique unless --repeat is given, so the result cache is
+only hit when asked for. Commands are run through a "chroot" script that
+maps the chroot-relative paths onto the stand-in chroot, so the warm shells
+(warm_workers) are not supported.
+
+Usage: python3 benchmarks/load_test.py [--jobs N] [--concurrency N] [--mix notes=4,compare=1]
+'''
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import cherrypy
+import requests
+
+benchmark_path = os.path.dirname(os.path.abspath(__file__))
+repo_path = os.path.join(benchmark_path, "..")
+sys.path.insert(0, repo_path)
+import md2pdf_webserver
+
+# Runs the command in the stand-in chroot, in the same way as the real chroot would
+chroot_script = '''#!/bin/sh
+root="$1"
+shift
+export FAKE_ROOT="$root"
+if [ "$1" = /bin/sh ] && [ "$2" = -c ]; then
+    # The command is run through 'cd "$0" && exec "$@"', where $0 is the folder inside the chroot
+    script="$3"
+    workdir="$4"
+    shift 4
+    exec /bin/sh -c "$script" "$root$workdir" "$@"
+fi
+cd "$root" && exec "$@"
+'''
+
+wrapper_script = '''#!/bin/sh
+$1
+'''
+
+tool_script = '''#!/bin/sh
+exec "{python}" "{fake_toolchain}" {tool} "$@"
+'''
+
+words = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do",
+         "eiusmod", "tempor", "incididunt", "labore", "magna", "aliqua", "colour", "figure", "table")
+
+
+def make_chroot(root, fake_config):
+    # Lay out the stand-in chroot, with the fake tools and the "chroot" script in its "fake-bin" folder
+    os.makedirs(os.path.join(root, "tmp"))
+    bin_path = os.path.join(root, "fake-bin")
+    os.makedirs(bin_path)
+    scripts = {"chroot": chroot_script, "wrapper": wrapper_script}
+    for tool in ("pandoc", "xelatex", "latexdiff", "epstopdf", "rsvg-convert", "convert"):
+        scripts[tool] = tool_script.format(python=sys.executable, tool=tool,
+                                           fake_toolchain=os.path.join(benchmark_path, "fake_toolchain.py"))
+    for name, script in scripts.items():
+        script_path = os.path.join(bin_path, name)
+        with open(script_path, 'wt') as script_file:
+            script_file.write(script)
+        os.chmod(script_path, 0o755)
+    with open(os.path.join(root, "fake-toolchain.json"), 'wt') as config_file:
+        json.dump(fake_config, config_file, indent=2)
+    return bin_path
+
+
+def make_precompiled_template(root):
+    # Copy the example static content, adding a version of the example template that can be
+    # precompiled: its \documentclass line depends on the document, so it is given fixed options
+    static_path = os.path.join(root, "static")
+    shutil.copytree(os.path.join(repo_path, "example-static"), static_path)
+    with open(os.path.join(static_path, "example.latex"), 'rt', encoding="utf-8") as template_file:
+        template = template_file.read()
+    template = re.sub(r"^\\documentclass\[.*$", lambda match: "\\documentclass[11pt,a4paper,twoside]{memoir}\n"
+                      "\\csname endofdump\\endcsname", template, count=1, flags=re.MULTILINE)
+    with open(os.path.join(static_path, "example-precompiled.latex"), 'wt', encoding="utf-8") as template_file:
+        template_file.write(template)
+    return static_path
+
+
+def start_server(args, root, bin_path, cache_path, node_urls=None):
+    # Set up the server in the same way as main() does for --run, from a config made from the
+    # arguments, but with the stand-in chroot
+    server = md2pdf_webserver
+    os.environ["PATH"] = bin_path + ":" + os.environ["PATH"]
+    server.chroot_env["PATH"] = bin_path + ":" + server.chroot_env["PATH"]
+    server.chroot_path = root
+    server.html_path = repo_path
+    server.static_path = os.path.join(repo_path, "example-static")
+    conf = {
+        "listen_port": args.port,
+        "listen_address": "127.0.0.1",
+        "static_content": ["example.latex", "gear.eps", "building.eps"],
+        "default_template": "example.latex",
+        "compare_replace": [{"colour": "color"}, {"figure": "Figure"}],
+        "worker_count": args.workers,
+        "queue_size": args.queue_size,
+        "result_cache": {"path": cache_path} if cache_path else False,
+        "cleanup": {"job_ttl_seconds": 60, "disk_watermark_percent": 0},
+        "profiles": {
+            "draft": {"crossref": False, "draft_graphics": True, "max_passes": 1},
+            "preview": {"crossref": False, "output": "html"},
+        },
+    }
+    if args.precompile:
+        server.static_path = make_precompiled_template(root)
+        conf["static_content"].append("example-precompiled.latex")
+        conf["default_template"] = "example-precompiled.latex"
+        conf["precompiled_templates"] = ["example-precompiled.latex"]
+    if args.incremental:
+        conf["incremental"] = True
+    if args.graphics:
+        conf["graphics"] = {"max_pixels": 1000, "min_kb": 16}
+    if args.shared_storage:
+        conf["storage"] = {"backend": "shared", "path": args.shared_storage}
+    if node_urls:
+        conf["cluster"] = {"self": "http://127.0.0.1:{}".format(args.port), "peers": node_urls}
+    if args.warm_up:
+        conf["warmup"] = {"templates": ["example.latex"]}
+    settings = server.read_config(conf, os.path.join(root, "md2pdf_webserver_config.yaml"))
+    server.start_services(settings)
+
+    url = "http://127.0.0.1:{}".format(args.port)
+    if args.engine == "asyncio":
+        threading.Thread(target=server.AsyncServer("127.0.0.1", args.port).run, daemon=True).start()
+        for attempt in range(100):
+            try:
+                requests.get(url + "/metrics", timeout=1)
+                break
+            except requests.RequestException:
+                time.sleep(0.1)
+        return url
+
+    cherrypy.config.update({
+        'server.socket_host': "127.0.0.1",
+        'server.socket_port': args.port,
+        'server.thread_pool': 16,
+        'server.max_request_body_size': 0,
+        'server.socket_timeout': 60,
+        'log.screen': False,
+        'engine.autoreload.on': False,
+        'checker.on': False,
+    })
+    cherrypy.tree.mount(server.App(), '/')
+    cherrypy.engine.start()
+    cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+    return url
+
+
+def paragraph(rng, sentences):
+    text = []
+    for index in range(sentences):
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(8, 20)))
+        text.append(sentence.capitalize() + ".")
+    return " ".join(text)
+
+
+def make_manual(rng, pages):
+    # Roughly one page per section: a heading, some paragraphs, a table and some code
+    lines = ["---", "title: Manual", "---", ""]
+    for page in range(pages):
+        lines += ["# Section {}".format(page + 1), "", paragraph(rng, 12), "", paragraph(rng, 10), ""]
+        lines += ["| Name | Value |", "|------|-------|"]
+        lines += ["| {} | {} |".format(rng.choice(words), rng.randint(0, 1000)) for _ in range(5)]
+        lines += ["", "```", "\n".join(paragraph(rng, 1) for _ in range(4)), "```", ""]
+    return "\n".join(lines) + "\n"
+
+
+def make_document(kind, rng, nonce):
+    # Return the files of one synthetic document, and the headers to upload it with
+    header = "<!-- {} -->\n".format(nonce)
+    if kind == "notes":
+        return {"notes.md": header + "# Notes\n\n" + paragraph(rng, 10) + "\n"}, {}
+    if kind == "manual":
+        return {"manual.md": header + make_manual(rng, 200)}, {}
+    if kind == "images":
+        files = {}
+        text = [header, "# Images\n"]
+        for index in range(30):
+            name = "images/figure{}.png".format(index)
+            files[name] = rng.randbytes(32 * 1024)
+            text.append("![Figure {0}]({1}){{#fig:{0}}}\n\n{2}\n".format(index, name, paragraph(rng, 2)))
+        files["images.md"] = "\n".join(text)
+        return files, {}
+    if kind == "figures":
+        # Only the text differs between uploads, the figures are the same
+        files = {}
+        text = [header, "# Figures\n"]
+        for index in range(10):
+            name = "figures/figure{}.{}".format(index, "eps" if index % 2 else "svg")
+            files[name] = random.Random("figure-{}".format(index)).randbytes(64 * 1024)
+            text.append("![Figure {0}]({1}){{#fig:{0}}}\n\n{2}\n".format(index, name, paragraph(rng, 2)))
+        files["figures.md"] = "\n".join(text)
+        return files, {}
+    if kind == "compare":
+        old_text = make_manual(rng, 20)
+        new_lines = old_text.splitlines()
+        for index in rng.sample(range(len(new_lines)), len(new_lines) // 20):
+            new_lines[index] = paragraph(rng, 1)
+        return {"doc.old.md": header + old_text, "doc.new.md": header + "\n".join(new_lines) + "\n"}, \
+               {"x-latex-compare": "true"}
+    raise ValueError("Unknown kind of document: " + kind)
+
+
+def make_zip(files):
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as out_zip:
+        for name, data in sorted(files.items()):
+            # A fixed date, so the same document always has the same hash
+            info = zipfile.ZipInfo(name, (2020, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            out_zip.writestr(info, data)
+    return zip_buffer.getvalue()
+
+
+def make_corpus(args):
+    # Build every upload before the test starts, so the clients only measure the server
+    mix = []
+    for item in args.mix.split(","):
+        kind, _, weight = item.partition("=")
+        mix += [kind.strip()] * int(weight or 1)
+    rng = random.Random(args.seed)
+    corpus = []
+    for index in range(args.jobs):
+        kind = mix[index % len(mix)]
+        # Repeated documents have the same content, so they can be served from the result cache
+        if args.repeat and rng.random() < args.repeat:
+            nonce = "repeat"
+        else:
+            nonce = "job {}".format(index)
+        files, headers = make_document(kind, random.Random("{}-{}".format(args.seed, kind)), nonce)
+        if args.incremental and kind != "compare":
+            # Every document of a kind differs only in its first line, so each is a revision of the last
+            headers["x-document-id"] = kind
+        if args.profile and kind != "compare":
+            headers["x-render-profile"] = args.profile
+        corpus.append((kind, make_zip(files), headers))
+    return corpus
+
+
+def run_job(urls, index, session, kind, data, headers):
+    # Upload one document, wait for it and fetch the PDF, returning the timings. With
+    # several servers, the status and PDF are requested from a different server.
+    url = urls[index % len(urls)]
+    result = {"kind": kind, "ok": False, "busy": 0, "bytes": len(data)}
+    start_time = time.perf_counter()
+    headers = dict(headers, **{"x-method": "MD-to-PDF"})
+    while True:
+        response = session.post(url + "/upload", files={"ufile": ("upload.zip", data)}, headers=headers)
+        if response.status_code not in (409, 503):
+            break
+        # The queue is full (or the same file is being rendered with other options), wait and retry
+        result["busy"] += 1
+        time.sleep(min(5, int(response.headers.get("Retry-After", 1))))
+    result["upload"] = time.perf_counter() - start_time
+    hashsum = response.cookies.get("hashsum")
+    if response.status_code != 200 or not hashsum:
+        result["error"] = "upload returned {}".format(response.status_code)
+        return result
+    url = urls[(index + 1) % len(urls)]
+    state = None
+    while state not in ("done", "failed", "timed_out"):
+        status = session.get(url + "/status/" + hashsum, params={"timeout": 30}).json()
+        state = status["state"]
+    response = session.get(url + "/fetch", params={"hashsum": hashsum})
+    result["total"] = time.perf_counter() - start_time
+    result["ok"] = (state == "done" and response.content.startswith((b"%PDF", b"<!DOCTYPE html>")))
+    if not result["ok"]:
+        result["error"] = status.get("error", "no PDF returned")
+    return result
+
+
+def run_load(urls, corpus, concurrency):
+    results = []
+    jobs = list(enumerate(corpus))
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if not jobs:
+                    return
+                index, (kind, data, headers) = jobs.pop(0)
+            result = run_job(urls, index, session, kind, data, headers)
+            with lock:
+                results.append(result)
+
+    start_time = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return results, time.perf_counter() - start_time
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))]
+
+
+def summarise(results, elapsed):
+    summary = {}
+    for kind in sorted(set(result["kind"] for result in results)) + ["all"]:
+        selected = [result for result in results if kind in ("all", result["kind"])]
+        latencies = [result["total"] for result in selected if result["ok"]]
+        summary[kind] = {
+            "jobs": len(selected),
+            "failed": len(selected) - len(latencies),
+            "busy_retries": sum(result["busy"] for result in selected),
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "upload_p50": percentile([result["upload"] for result in selected if "upload" in result], 0.50),
+            "jobs_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        }
+    return summary
+
+
+def stage_times(urls):
+    # Total time spent in each stage on all of the servers, and the number of forwarded
+    # requests, from their metrics
+    stages = {}
+    forwarded = {}
+    for url in urls:
+        for line in requests.get(url + "/metrics").text.splitlines():
+            match = re.match(r'md2pdf_stage_duration_seconds_(sum|count)\{stage="(\w+)"\} (\S+)', line)
+            if match:
+                row = stages.setdefault(match.group(2), {"count": 0, "seconds": 0.0})
+                if match.group(1) == "sum":
+                    row["seconds"] += float(match.group(3))
+                else:
+                    row["count"] += int(float(match.group(3)))
+            match = re.match(r'md2pdf_forwarded_requests_total\{endpoint="(\w+)"\} (\S+)', line)
+            if match:
+                forwarded[match.group(1)] = forwarded.get(match.group(1), 0) + int(float(match.group(2)))
+    return stages, forwarded
+
+
+def serve_node(args, fake_config):
+    # Run one server of a cluster, until it is stopped
+    root = tempfile.mkdtemp(prefix="md2pdf-load-test-node-")
+    try:
+        bin_path = make_chroot(os.path.join(root, "chroot"), fake_config)
+        start_server(args, os.path.join(root, "chroot"), bin_path,
+                     os.path.join(root, "cache") if args.cache else None, args.node_urls.split(","))
+        if args.engine == "asyncio":
+            # The server runs in a daemon thread, so wait here until the node is stopped
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+            while True:
+                signal.pause()
+        cherrypy.engine.signals.subscribe()
+        cherrypy.engine.block()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def start_nodes(args):
+    # Start each server of a cluster as its own process, and wait until they answer
+    node_urls = ["http://127.0.0.1:{}".format(args.port + index) for index in range(args.nodes)]
+    processes = []
+    for index, url in enumerate(node_urls):
+        command = [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port + index),
+                   "--node-urls", ",".join(node_urls)]
+        for name in ("workers", "queue_size", "latency", "per_mb", "sigma", "pdf_kb", "shared_storage", "engine",
+                     "profile"):
+            if getattr(args, name) is not None:
+                command += ["--" + name.replace("_", "-"), str(getattr(args, name))]
+        for name in ("cache", "precompile", "warm_up", "incremental", "graphics"):
+            if getattr(args, name):
+                command.append("--" + name.replace("_", "-"))
+        processes.append(subprocess.Popen(command))
+    for url in node_urls:
+        for attempt in range(100):
+            try:
+                requests.get(url + "/metrics", timeout=1)
+                break
+            except requests.RequestException:
+                time.sleep(0.2)
+    return node_urls, processes
+
+
+def wait_until_ready(urls):
+    # Wait for the warm-up of each server to finish, and return the time it took
+    start_time = time.monotonic()
+    for url in urls:
+        while True:
+            response = requests.get(url + "/ready", timeout=10)
+            if response.status_code == 200:
+                break
+            if response.json()["state"] == "failed":
+                raise RuntimeError("Warm-up failed on {}: {}".format(url, response.text))
+            time.sleep(0.1)
+    return time.monotonic() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test md2pdf_webserver with a fake toolchain")
+    parser.add_argument('--jobs', type=int, default=40, help="Number of documents to render")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of clients uploading at the same time")
+    parser.add_argument('--mix', default="notes=4,manual=1,images=1,compare=2",
+                        help="Kinds of document to upload, with their weights")
+    parser.add_argument('--repeat', type=float, default=0.0, help="Fraction of uploads that repeat an earlier document")
+    parser.add_argument('--workers', type=int, default=4, help="Number of render workers")
+    parser.add_argument('--queue-size', type=int, default=64, help="Size of the render queue")
+    parser.add_argument('--cache', action="store_true", help="Enable the result cache")
+    parser.add_argument('--precompile', action="store_true", help="Precompile the example template into a format file")
+    parser.add_argument('--warm-up', action="store_true", help="Render the warm-up canaries, and wait until the servers are ready")
+    parser.add_argument('--incremental', action="store_true",
+                        help="Render revisions incrementally, sending a document ID with each upload (needs --cache)")
+    parser.add_argument('--graphics', action="store_true",
+                        help="Convert the figures of each upload before rendering, with the converted figures cached (needs --cache)")
+    parser.add_argument('--profile', choices=["final", "draft", "preview"],
+                        help="Render profile to ask for, except in compare mode (draft runs one xelatex pass, preview is HTML)")
+    parser.add_argument('--latency', type=float, default=0.2, help="Fixed latency of each tool, in seconds")
+    parser.add_argument('--per-mb', type=float, default=2.0, help="Extra latency of each tool per MB of input, in seconds")
+    parser.add_argument('--sigma', type=float, default=0.0,
+                        help="Spread of the sampled (log-normal) latency, 0 for a fixed latency")
+    parser.add_argument('--pdf-kb', type=float, default=100, help="Size of each fake PDF, in KB")
+    parser.add_argument('--seed', type=int, default=1234, help="Seed for the synthetic documents")
+    parser.add_argument('--port', type=int, default=9191, help="Port for the server to listen on")
+    parser.add_argument('--engine', choices=["cherrypy", "asyncio"], default="cherrypy", help="Web server to run")
+    parser.add_argument('--nodes', type=int, default=1, help="Number of servers to run as a cluster")
+    parser.add_argument('--shared-storage', metavar="PATH", help="Use shared job storage in this folder")
+    parser.add_argument('--serve', action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument('--node-urls', help=argparse.SUPPRESS)
+    parser.add_argument('--json', metavar="FILE", help="Also write the results to a JSON file")
+    parser.add_argument('--keep', action="store_true", help="Keep the stand-in chroot afterwards")
+    args = parser.parse_args()
+    if args.incremental and not args.cache:
+        parser.error("--incremental needs --cache")
+    if args.graphics and not args.cache:
+        parser.error("--graphics needs --cache")
+
+    logging.disable(logging.WARNING)
+    tool_config = {"latency": args.latency, "per_mb": args.per_mb, "sigma": args.sigma}
+    tools = ("pandoc", "xelatex", "latexdiff", "epstopdf", "rsvg-convert", "convert")
+    fake_config = {"pdf_kb": args.pdf_kb, "tools": {tool: tool_config for tool in tools}}
+    if args.serve:
+        serve_node(args, fake_config)
+        return
+
+    root = tempfile.mkdtemp(prefix="md2pdf-load-test-")
+    processes = []
+    try:
+        if args.nodes > 1:
+            urls, processes = start_nodes(args)
+        else:
+            bin_path = make_chroot(os.path.join(root, "chroot"), fake_config)
+            urls = [start_server(args, os.path.join(root, "chroot"), bin_path,
+                                 os.path.join(root, "cache") if args.cache else None)]
+        if args.warm_up:
+            print("Servers were ready after {:.2f} s of warm-up".format(wait_until_ready(urls)))
+        corpus = make_corpus(args)
+        print("Uploading {} documents ({:.1f} MB) with {} clients, to {} server(s) with {} workers each".format(
+            len(corpus), sum(len(data) for kind, data, headers in corpus) / (1024 * 1024),
+            args.concurrency, len(urls), args.workers))
+        results, elapsed = run_load(urls, corpus, args.concurrency)
+        summary = summarise(results, elapsed)
+        stages, forwarded = stage_times(urls)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        cherrypy.engine.exit()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print("")
+    print("{:<8} {:>5} {:>6} {:>6} {:>8} {:>8} {:>8} {:>10} {:>8}".format(
+        "kind", "jobs", "failed", "busy", "p50 s", "p95 s", "p99 s", "upload s", "jobs/s"))
+    for kind, row in summary.items():
+        print("{:<8} {:>5} {:>6} {:>6} {:>8.3f} {:>8.3f} {:>8.3f} {:>10.3f} {:>8.2f}".format(
+            kind, row["jobs"], row["failed"], row["busy_retries"], row["p50"], row["p95"], row["p99"],
+            row["upload_p50"], row["jobs_per_sec"]))
+    print("")
+    print("Server time by stage:")
+    for stage, row in sorted(stages.items(), key=lambda item: -item[1]["seconds"]):
+        print("  {:<10} {:>6} calls {:>10.3f} s total {:>8.1f} ms mean".format(
+            stage, row["count"], row["seconds"], 1000 * row["seconds"] / max(1, row["count"])))
+    if forwarded:
+        print("Forwarded requests: " + ", ".join("{} {}".format(count, endpoint) for endpoint, count in sorted(forwarded.items())))
+    print("Wall time: {:.2f} s".format(elapsed))
+    errors = set(result["error"] for result in results if not result["ok"])
+    for error in sorted(errors):
+        print("Error: " + error)
+
+    if args.json:
+        with open(args.json, 'wt') as json_file:
+            json.dump({"args": vars(args), "elapsed": elapsed, "summary": summary, "stages": stages,
+                       "forwarded": forwarded}, json_file, indent=2)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,23 +25,99 @@ __version__ = "0.1.0"
 
 import argparse
 import os
+import io
+import json
 import stat
 import shutil
+import signal
 import sys
 import cherrypy
 import string
 import re
 import random
+import shlex
 import hashlib
 import logging
 import threading
 import time
+import bisect
+import heapq
+import contextlib
+import math
+import queue
+import asyncio
+import functools
+import concurrent.futures
+import urllib.parse
 import zipfile
 import subprocess
+import requests
 from ruamel.yaml import YAML
 
 yaml = YAML()
 
+# The longest time a status request will wait for a change, in seconds
+max_status_wait = 55
+# How often to send a keep-alive comment on a status event stream, in seconds
+status_heartbeat = 15
+# Mapping between command line options and config file syntax
+config_dict = {"listen": "listen_address", "tempdir": "temp_path", "port": "listen_port"}
+# Environment for the commands run inside the chroot
+chroot_env = {
+    "PATH": "/usr/local/texlive/bin/x86_64-linux:/usr/local/bin:/usr/sbin:/usr/bin:/bin",
+    "LC_ALL": "C",
+    # Let TeX find the shared static content, as well as its usual paths (from the trailing ':')
+    "TEXINPUTS": ".:/md2pdf-static:"
+}
+# Where the static content is shared, inside the chroot
+chroot_static_dir = "/md2pdf-static"
+# Headers passed back to the client when a request is forwarded to another server
+relayed_headers = ('Content-Type', 'Content-Disposition', 'Content-Range', 'Accept-Ranges', 'Cache-Control',
+                   'ETag', 'Last-Modified', 'Retry-After')
+# How long a client may keep a PDF fetched with its render key, in seconds
+immutable_max_age = 365 * 86400
+# Sidecar in each job folder with the job's timeline and resource use, served by /jobinfo/<hash>
+job_info_name = "jobinfo.json"
+# Folder in a job folder where the graphics stage puts the figures it converts into PDF
+graphics_dir = "md2pdf-graphics"
+# Paths of figures in Markdown: images, and LaTeX or HTML written into the Markdown
+graphics_reference_pattern = re.compile(r"""(!\[[^\]]*\]\(\s*<?|\\includegraphics\s*(?:\[[^\]]*\])?\s*\{|<img\s[^>]*?src=["'])([^\s)}>"']+)""")
+# Folder in a job folder where xelatex is run by incremental renders
+latex_build_dir = "latex-build"
+# The files xelatex carries from one pass to the next, which are kept for incremental renders
+latex_aux_extensions = (".aux", ".toc", ".out", ".lof", ".lot")
+# Messages in a xelatex log asking for another pass, from LaTeX itself and from packages like rerunfilecheck
+latex_rerun_pattern = re.compile(r"Rerun to get|Please rerun|Rerun LaTeX|may have changed\. Rerun")
+# Where a precompiled template's fixed preamble ends, written as mylatexformat suggests so the
+# template also works without the format
+end_of_dump_pattern = re.compile(r"\\csname\s*endofdump\s*\\endcsname")
+# Render profile used when a client doesn't ask for one, which renders as the server always has
+default_render_profile = "final"
+# Content types of the files a job can produce
+output_content_types = {".pdf": "application/pdf", ".html": "text/html;charset=utf-8"}
+# Names the manifest of a batch upload can have, in order of preference
+batch_manifest_names = ("manifest.yaml", "manifest.yml", "manifest.json")
+# Document rendered through each template at startup, to warm up the font and TeX Live caches
+canary_document = """# Warm-up canary
+
+This document is rendered at startup, so that the *font*, **package** and `file` caches
+are warm before the first real job. See @tbl:canary and @eq:canary.
+
+| Column | Value |
+|--------|------:|
+| One    | 1.5   |
+| Two    | 2.25  |
+
+: A small table {#tbl:canary}
+
+$$ \\sum_{i=1}^{n} x_i^2 = \\int_0^1 f(x)\\,dx $$ {#eq:canary}
+
+```python
+def canary(value):
+    return value * 2
+```
+"""
+
 ## TODO:
 # - Spruce up index.html
 # - Add command line flag to run tlmgr install / update (for extra TeX packages)
@@ -55,12 +131,8 @@ logging.basicConfig(level=logging.DEBUG,
 
 def main():
     ## Declare some global vars
-    global def_tempdir
     global def_latex_static
     global def_template
-    global config_dict
-    config_dict = {}
-    global compare_replace
     global static_path
     global html_path
     global chroot_path
@@ -68,12 +140,6 @@ def main():
     global running_as_snap
 
 
-    ## Define the mapping between command line options and config file syntax
-    config_dict["listen"] = "listen_address"
-    config_dict["tempdir"] = "temp_path"
-    config_dict["port"] = "listen_port"
-
-
     ## Hard-coded defaults, used if no config file exists
     def_port = 9090
     def_listen = "127.0.0.1"
@@ -111,11 +177,14 @@ def main():
         chroot_path = os.path.join(config_path, "texlive-chroot")
         config_path = os.path.join(config_path, config_name)
 
-    logging.debug("Setting chroot path to '%s'", chroot_path)
+    # A different config file can be given on the command line, i.e. to run several servers on one machine
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument('-c', '--config')
+    config_arg = config_parser.parse_known_args()[0].config
+    if config_arg:
+        config_path = os.path.abspath(config_arg)
 
-    # Use the chroot as the base for the temporary directory
-    def_tempdir = os.path.join(chroot_path, "tmp")
-    logging.debug("Setting temp path to '%s'", def_tempdir)
+    logging.debug("Setting chroot path to '%s'", chroot_path)
 
     # If running as a Snap, check the static content has been copied in place
     if running_as_snap:
@@ -162,26 +231,10 @@ def main():
         config_file.close()
         config_file = open(config_path, 'rt', encoding="utf-8")
 
-    # Read from the config file
     conf = yaml.load(config_file)
-    try:
-        def_port = int(conf[config_dict["port"]])
-        def_listen = conf[config_dict["listen"]]
-        def_latex_static = conf["static_content"]
-        def_template = conf["default_template"]
-    except KeyError as e:
-        logging.critical("Config item %s could not be read from config file at '%s'", e, config_path)
-        sys.exit()
-
-    # Read the optional "compare_replace" section from the config file
-    try:
-        compare_replace = conf["compare_replace"]
-        logging.debug("Compare-Replace strings loaded")
-    except KeyError:
-        # No "compare_replace" config exists, this is OK
-        compare_replace = False
-        logging.debug("Compare-Replace strings not found in config file")
-
+    settings = read_config(conf, config_path)
+    def_port = settings["port"]
+    def_listen = settings["listen"]
     logging.debug("Successfully read config from file at '%s'", config_path)
     config_file.close()
 
@@ -194,6 +247,8 @@ def main():
     group.add_argument('--install', action="store_true", help="Performs the initial installation of TeX Live, using a TeX Live ISO image")
     parser.add_argument('-p', '--port', metavar="PORT", type=int, help="Port to listen on (overrides value set in config file)", default=def_port)
     parser.add_argument('-l', '--listen', metavar="ADDRESS", help="Local IP address to listen on (overrides value set in config file)", default=def_listen)
+    parser.add_argument('-c', '--config', metavar="FILE", help="Config file to use, instead of the default location")
+    parser.add_argument('-e', '--engine', choices=["cherrypy", "asyncio"], default="cherrypy", help="Web server to use: the CherryPy thread pool (default), or a single asyncio event loop which can hold many more idle connections")
 
     args = parser.parse_args()
 
@@ -224,20 +279,28 @@ def main():
         p = subprocess.Popen(arg, shell=True)
         p.wait()
 
-        ## Start the CherryPy server
+        ## Start everything the server needs to render jobs
+        start_services(settings)
+
         def_listen = args.listen
         def_port = args.port
-        cherry_config = {
-            'global' : {
-                'server.socket_host' : def_listen,
-                'server.socket_port' : def_port,
-                'server.thread_pool' : 16,
-                'server.max_request_body_size' : 0,
-                'server.socket_timeout' : 60,
-                'log.screen': False
+        if args.engine == "asyncio":
+            ## Start the asyncio server
+            AsyncServer(def_listen, def_port).run()
+        else:
+            ## Start the CherryPy server
+            cherry_config = {
+                'global' : {
+                    'server.socket_host' : def_listen,
+                    'server.socket_port' : def_port,
+                    'server.thread_pool' : 16,
+                    # Allow some room for the multipart headers around the uploaded file
+                    'server.max_request_body_size' : (max_upload_size + 65536) if max_upload_size else 0,
+                    'server.socket_timeout' : 60,
+                    'log.screen': False
+                }
             }
-        }
-        cherrypy.quickstart(App(), '/', cherry_config)
+            cherrypy.quickstart(App(), '/', cherry_config)
     elif args.check:
         ## Parse and validate config options
         logging.info("Config file is located at: %s", config_path)
@@ -279,9 +342,8 @@ def main():
             arg = "./setup-chroot.sh"
 
         shutil.copy2(script_path, chroot_path)
-        os.chdir(chroot_path)
 
-        p = subprocess.Popen(arg, shell=True)
+        p = subprocess.Popen(arg, shell=True, cwd=chroot_path)
         p.wait()
 
     else:
@@ -292,426 +354,3926 @@ def main():
 # END main()
 
 
-class DeleteTimerThread(threading.Thread):
-    def __init__(self, folder):
-        # Initialise the threading.Thread parent
-        super().__init__()
-        # Store the passed objects
-        self.folder = folder
+def read_config(conf, config_path):
+    """Reads the settings from a parsed config file into the module's globals, exiting if any of
+    them are not valid. Returns the settings which are only needed to start the server, for
+    start_services()."""
+    global def_tempdir
+    global def_latex_static
+    global def_template
+    global compare_replace
+    global compare_replacer
+    global latex_filters
+    global upload_chunk_size
+    global upload_spool_size
+    global max_upload_size
+    global stage_timeouts
+    global process_limits
+    global max_latex_passes
+    global render_profiles
+    global slow_job_seconds
+    global graphics_converter
+    global peer_ring
 
-    def run(self):
-        # Delete the folder after a 1 minute wait, to save disk space
-        logging.debug("Will remove '%s' in one minute", self.folder)
-        time.sleep(60)
-        logging.info("Removing folder '%s'", self.folder)
+    ## Hard-coded defaults for the optional settings
+    def_latex_filters = ("strip_hypertarget", "fix_label_end")
+    def_queue_size = 64
+    def_cache_size_mb = 1024
+    def_cache_age_days = 30
+    def_upload_chunk_kb = 64
+    def_upload_spool_kb = 1024
+    def_max_upload_mb = 0
+    def_job_ttl_seconds = 300
+    def_disk_watermark_percent = 0
+    def_stage_timeouts = {"graphics": 300, "pandoc": 600, "latexdiff": 300, "xelatex": 300}
+    def_max_latex_passes = 5
+
+    # Read the settings every config file has
+    try:
+        port = int(conf[config_dict["port"]])
+        listen = conf[config_dict["listen"]]
+        def_latex_static = conf["static_content"]
+        def_template = conf["default_template"]
+    except KeyError as e:
+        logging.critical("Config item %s could not be read from config file at '%s'", e, config_path)
+        sys.exit()
+
+    # Read the optional "compare_replace" section from the config file
+    try:
+        compare_replace = conf["compare_replace"]
+        logging.debug("Compare-Replace strings loaded")
+    except KeyError:
+        # No "compare_replace" config exists, this is OK
+        compare_replace = False
+        logging.debug("Compare-Replace strings not found in config file")
+    compare_replacer = CompareReplacer(compare_replace)
+
+    # Read the optional "latex_filters" section, for fixing up Pandoc's LaTeX in compare mode
+    try:
+        latex_filter_conf = conf["latex_filters"]
+    except KeyError:
+        latex_filter_conf = def_latex_filters
+    try:
+        latex_filters = LatexFilterPipeline(latex_filter_conf)
+    except (ValueError, KeyError, TypeError, re.error) as e:
+        logging.critical("Config item 'latex_filters' is not valid: %s", e)
+        sys.exit()
+
+    # Read the optional render scheduler settings from the config file
+    try:
+        worker_count = int(conf["worker_count"])
+    except KeyError:
+        # Default to one render worker per CPU
+        worker_count = os.cpu_count() or 1
+    try:
+        queue_size = int(conf["queue_size"])
+    except KeyError:
+        queue_size = def_queue_size
+    logging.debug("Render scheduler will use %d workers and a queue of %d jobs", worker_count, queue_size)
+
+    # Read the optional list of templates to build LaTeX format files for
+    try:
+        precompiled_templates = list(conf["precompiled_templates"])
+    except KeyError:
+        precompiled_templates = []
+
+    # Read the optional "warm_workers" setting, for long-lived shells inside the chroot
+    try:
+        warm_workers = int(conf["warm_workers"])
+    except KeyError:
+        warm_workers = 0
+
+    # Read the optional "result_cache" section from the config file
+    cache_conf = conf.get("result_cache", {})
+    if cache_conf is False:
+        cache_path = False
+        cache_size_mb = cache_age_days = 0
+        logging.debug("Result cache is disabled in config file")
+    else:
+        cache_path = cache_conf.get("path", os.path.join(os.path.dirname(config_path), "md2pdf_cache"))
+        cache_size_mb = int(cache_conf.get("max_size_mb", def_cache_size_mb))
+        cache_age_days = float(cache_conf.get("max_age_days", def_cache_age_days))
+        logging.debug("Result cache will be stored in '%s'", cache_path)
+
+    # Read the optional "upload" section from the config file
+    upload_conf = conf.get("upload", {})
+    upload_chunk_size = int(upload_conf.get("chunk_size_kb", def_upload_chunk_kb)) * 1024
+    upload_spool_size = int(upload_conf.get("spool_size_kb", def_upload_spool_kb)) * 1024
+    max_upload_size = int(upload_conf.get("max_size_mb", def_max_upload_mb)) * 1024 * 1024
+    if max_upload_size:
+        logging.debug("Uploads will be limited to %d bytes", max_upload_size)
+
+    # Read the optional "temp_path" setting, which must be inside the chroot, and is the chroot's
+    # "tmp" folder by default
+    def_tempdir = os.path.abspath(conf.get(config_dict["tempdir"], os.path.join(chroot_path, "tmp")))
+    if os.path.commonpath([def_tempdir, os.path.abspath(chroot_path)]) != os.path.abspath(chroot_path):
+        logging.critical("Config item 'temp_path' must be inside the chroot at '%s'", chroot_path)
+        sys.exit()
+    logging.debug("Setting temp path to '%s'", def_tempdir)
+
+    # Read the optional "cleanup" section, for when job folders are removed from the temporary directory
+    cleanup_conf = conf.get("cleanup", {})
+    job_ttl = float(cleanup_conf.get("job_ttl_seconds", def_job_ttl_seconds))
+    disk_watermark = float(cleanup_conf.get("disk_watermark_percent", def_disk_watermark_percent))
+    if disk_watermark:
+        logging.debug("Job folders will be kept for %d seconds, or until the disk is %d%% full", job_ttl, disk_watermark)
+    else:
+        logging.debug("Job folders will be kept for %d seconds", job_ttl)
+
+    # Read the optional "limits" section, for the time and resources each job's commands may use
+    limits_conf = conf.get("limits", {})
+    try:
+        stage_timeouts = dict(def_stage_timeouts)
+        stage_timeouts.update({stage: float(timeout) for stage, timeout in limits_conf.get("timeouts", {}).items()})
+        process_limits = ProcessLimits(int(limits_conf.get("cpu_seconds", 0)), int(limits_conf.get("memory_mb", 0)),
+                                       limits_conf.get("cgroup"))
+    except (AttributeError, TypeError, ValueError) as e:
+        logging.critical("Config item 'limits' is not valid: %s", e)
+        sys.exit()
+    if process_limits.cgroup and not os.path.isfile(os.path.join(process_limits.cgroup, "cgroup.procs")):
+        logging.critical("Config item 'limits' has a 'cgroup' which is not a cgroup folder: '%s'", process_limits.cgroup)
+        sys.exit()
+    logging.debug("Stage timeouts are %s", ", ".join("{} {:g} s".format(stage, timeout)
+                                                      for stage, timeout in sorted(stage_timeouts.items())))
+
+    # Read the optional "incremental" section, for rendering revisions of a document from the
+    # LaTeX aux files of the last render
+    incremental_conf = conf.get("incremental", False)
+    if incremental_conf is True:
+        incremental_conf = {}
+    if incremental_conf is not False:
+        if cache_path is False:
+            logging.critical("Config item 'incremental' needs the result cache, which is disabled")
+            sys.exit()
         try:
-            shutil.rmtree(self.folder)
-        except Exception as e:
-            logging.error("An error occurred while removing '%s': %s", self.folder, e)
+            max_latex_passes = max(1, int(incremental_conf.get("max_passes", def_max_latex_passes)))
+        except (AttributeError, TypeError, ValueError) as e:
+            logging.critical("Config item 'incremental' is not valid: %s", e)
+            sys.exit()
+        logging.debug("Incremental renders will run xelatex up to %d times", max_latex_passes)
+    else:
+        max_latex_passes = 0
 
+    # Read the optional "graphics" section, for converting the figures in uploads before they are rendered
+    graphics_conf = conf.get("graphics", False)
+    if graphics_conf is True:
+        graphics_conf = {}
+    if graphics_conf is not False:
+        if cache_path is False:
+            logging.critical("Config item 'graphics' needs the result cache, which is disabled")
+            sys.exit()
+        try:
+            graphics_converter = GraphicsConverter(**graphics_conf)
+        except (AttributeError, TypeError, ValueError) as e:
+            logging.critical("Config item 'graphics' is not valid: %s", e)
+            sys.exit()
+        logging.debug("Figures will be converted with settings %s", graphics_converter.settings())
+    else:
+        graphics_converter = None
 
-class PdfWorkerThread(threading.Thread):
-    def __init__(self, input_md, template, compare_mode=False, compare_md=""):
-        # Initialise the threading.Thread parent
-        super().__init__()
-        # Store the passed objects
-        self.md_file = input_md
-        self.latex_template = template
-        self.compare_mode = compare_mode
-        self.compare_md = compare_md
+    # Read the optional "profiles" section, for named sets of render options that clients can pick
+    # with the 'x-render-profile' header
+    render_profiles = {default_render_profile: RenderProfile(default_render_profile)}
+    try:
+        for name, profile_conf in (conf.get("profiles") or {}).items():
+            render_profiles[str(name)] = RenderProfile(str(name), **(profile_conf or {}))
+    except (AttributeError, TypeError, ValueError) as e:
+        logging.critical("Config item 'profiles' is not valid: %s", e)
+        sys.exit()
+    logging.debug("Render profiles are %s", ", ".join(sorted(render_profiles)))
 
-    def run(self):
-        # Get the full path of the input MD file
-        dirname = os.path.abspath(os.path.dirname(self.md_file))
-        # Make the template name safe if it contains spaces
-        template_path = self.latex_template
-        # Make the MD name safe if it contains spaces
-        md_name = os.path.basename(self.md_file)
-        # Get the full path to the MD file, inside the chroot
-        md_name_full = os.path.join("/", os.path.relpath(self.md_file, chroot_path))
-
-        # Create a temporary shell script, to call inside the chroot
-        shell_name = os.path.join(dirname, "pandoc-wrapper.sh")
-
-        # Get the path of the temporary directory inside the chroot
-        chroot_tmp = os.path.join("/", os.path.relpath(dirname, chroot_path))
-
-        if self.compare_mode:
-            # Write out the special script for doing the latexdiff operation
-            # Set up all the filenames
-            name_new_md = os.path.basename(self.md_file)
-            name_old_md = os.path.basename(self.compare_md)
-            name_new_latex = name_new_md.replace("md", "latex")
-            name_old_latex = name_old_md.replace("md", "latex")
-            name_diff_latex = name_new_latex.replace(".new","_changes")
-
-            # Create the first-stage script
-            with open(shell_name, 'wt', encoding="utf-8") as shell_file:
-                arg = "pandoc --filter pandoc-crossref --pdf-engine=xelatex --template=\""
-                arg += template_path
-                arg += "\" -M figPrefix=Figure -M tblPrefix=Table -M secPrefix=Section -M autoSectionLabels=true --highlight-style=tango \""
-                arg += name_new_md
-                arg += "\" -o \""
-                arg += name_new_latex
-                arg += "\""
-
-                shell_file.write("#!/bin/sh\n\n")
-                shell_file.write("export LC_ALL=C\n")
-                shell_file.write("cd " + chroot_tmp + "\n")
-                shell_file.write("export PATH=/usr/local/texlive/bin/x86_64-linux:/usr/local/bin:/usr/sbin:/usr/bin:/bin\n\n")
-                shell_file.write(arg + "\n")
-
-                # Replace "new" names with "old", and add to the script
-                arg = arg.replace(name_new_md, name_old_md)
-                arg = arg.replace(name_new_latex, name_old_latex)
-                shell_file.write(arg + "\n")
-
-            # Create the second-stage script
-            shell_name_2nd = shell_name.replace("pandoc-wrapper", "latex-wrapper")
-            with open(shell_name_2nd, 'wt', encoding="utf-8") as shell_file:
-                shell_file.write("#!/bin/sh\n\n")
-                shell_file.write("export LC_ALL=C\n")
-                shell_file.write("cd " + chroot_tmp + "\n")
-                shell_file.write("export PATH=/usr/local/texlive/bin/x86_64-linux:/usr/local/bin:/usr/sbin:/usr/bin:/bin\n\n")
-
-                # Add the calls to latexdiff
-                shell_file.write("latexdiff -t CULINECHBAR \"" + name_old_latex + "\" \"" + name_new_latex + "\" > \"" + name_diff_latex + "\"\n")
-
-                # Finally, call xelatex to produce the PDF
-                shell_file.write("xelatex -interaction=batchmode \"" + name_diff_latex + "\"")
-
-            # Set script to be executable
-            os.chmod(shell_name_2nd, 0o744)
+    # Read the optional "slow_job_seconds" setting, for logging the timeline of jobs that take too long
+    try:
+        slow_job_seconds = float(conf.get("slow_job_seconds", 0))
+    except (TypeError, ValueError) as e:
+        logging.critical("Config item 'slow_job_seconds' is not valid: %s", e)
+        sys.exit()
 
-        else:
-            # Write out the normal script for generating PDF
-            with open(shell_name, 'wt', encoding="utf-8") as shell_file:
-                arg = "pandoc --filter pandoc-crossref --pdf-engine=xelatex --template=\""
-                arg += template_path
-                arg += "\" -M figPrefix=Figure -M tblPrefix=Table -M secPrefix=Section -M autoSectionLabels=true --highlight-style=tango \""
-                arg += md_name
-                arg += "\" -o \""
-                arg += md_name.replace("md", "pdf")
-                arg += "\""
-
-                shell_file.write("#!/bin/sh\n\n")
-                shell_file.write("export LC_ALL=C\n")
-                shell_file.write("cd " + chroot_tmp + "\n")
-                shell_file.write("export PATH=/usr/local/texlive/bin/x86_64-linux:/usr/local/bin:/usr/sbin:/usr/bin:/bin\n\n")
-                shell_file.write(arg + "\n")
-
-        # Set script to be executable
-        os.chmod(shell_name, 0o744)
-
-        # Modify shell_name to now be the path inside the chroot
-        shell_name = os.path.join("/", os.path.relpath(shell_name, chroot_path))
-        logging.debug("Wrapper script path inside chroot is '%s'", shell_name)
-
-        # Create command to call script inside chroot
-        arg = "chroot " + chroot_path + " " + shell_name
+    # Read the optional "storage" section, for where the output of finished jobs is kept
+    storage_conf = conf.get("storage", {})
+    storage_backend = storage_conf.get("backend", "local")
+    if storage_backend not in JOB_STORAGE_BACKENDS:
+        logging.critical("Config item 'storage' has an unknown backend '%s', use one of: %s",
+                         storage_backend, ", ".join(sorted(JOB_STORAGE_BACKENDS)))
+        sys.exit()
+    if storage_backend != "local" and "path" not in storage_conf:
+        logging.critical("Config item 'storage' needs a 'path' for the '%s' backend", storage_backend)
+        sys.exit()
 
-        # Run compare_replace
-        if self.compare_mode:
-            logging.info("Running compare_replace on input files")
-            name_new_md = os.path.join(dirname, name_new_md)
-            name_new_md_tmp = name_new_md + ".tmp"
-            name_old_md = os.path.join(dirname, name_old_md)
-            name_old_md_tmp = name_old_md + ".tmp"
-            os.rename(name_new_md, name_new_md_tmp)
-            os.rename(name_old_md, name_old_md_tmp)
-
-            for input_md in (name_new_md_tmp, name_old_md_tmp):
-                # Open each file in turn
-                with open(input_md, 'rt', encoding="utf-8") as in_file:
-                    output_file = ""
-                    # Loop over all the lines in the file
-                    for line in in_file:
-                        output_line = line
-                        # For each line, loop through all the replacement pairs
-                        for replace_map in compare_replace:
-                            for key in replace_map:
-                                output_line = output_line.replace(key, replace_map[key])
-                        output_file += output_line
-                    # Write out the replaced file
-                    with open(input_md.replace(".tmp",""), 'w', encoding="utf-8") as out_file:
-                        out_file.write(output_file)
-
-        logging.debug("Will execute command: " + arg)
-
-        os.chdir(dirname)
-
-        # Open a log file for the subprocess call
-        log_name = md_name_full.replace("md", "log")
-        log_name = os.path.join(chroot_path, os.path.relpath(log_name, "/"))
-        logging.debug("Writing log file to '%s'", log_name)
-        with open(log_name, 'wt', encoding="utf-8") as log_file:
-            # Run the shell call, and wait for it to end
-            p = subprocess.Popen(arg, shell=True, stdout=log_file, stderr=log_file)
-            p.wait()
-
-            # Run the second-stage, if applicable
-            if self.compare_mode:
-                logging.info("Running hypertarget fix on input files")
-                # name_new_latex = os.path.join(dirname, name_new_latex)
-                name_new_latex_tmp = name_new_latex + ".tmp"
-                # name_old_latex = os.path.join(dirname, name_old_latex)
-                name_old_latex_tmp = name_old_latex + ".tmp"
-                os.rename(name_new_latex, name_new_latex_tmp)
-                os.rename(name_old_latex, name_old_latex_tmp)
-
-                for input_latex in (name_new_latex_tmp, name_old_latex_tmp):
-                    # Define regex patterns
-                    logging.debug("Running fix on: %s", input_latex)
-                    hypertarget_pattern = re.compile("(\\\\hypertarget{.*?}\\s?{%?}?)")
-                    label_end_pattern = re.compile("\\\\label{.*?(}\\s?})")
-                    # Open each file in turn
-                    output_file = ""
-                    with open(input_latex, 'rt', encoding="utf-8") as in_file:
-                        line_ctr = 0
-                        # Loop over all the lines in the file
-                        for line in in_file:
-                            output_line = line
-                            line_ctr += 1
-                            # Run "hypertarget" removal, to fix Pandoc LaTeX source
-                            match = hypertarget_pattern.search(output_line)
-                            if match:
-                                # Completely remove the '\hypertarget' line
-                                output_line = output_line.replace(match.group(1), "")
-                            match = label_end_pattern.search(output_line)
-                            if match:
-                                # Fix up the extra bracket on the line end
-                                output_line = output_line.replace(match.group(1), "}")
-                            output_file += output_line
-                    # Write out the replaced file
-                    output_latex_name = input_latex.replace(".tmp","")
-                    with open(output_latex_name, 'w', encoding="utf-8") as out_file:
-                        out_file.write(output_file)
-                        logging.debug("Wrote out file: %s", output_latex_name)
-                # Run the 2nd stage
-                arg = arg.replace("pandoc-wrapper", "latex-wrapper")
-                p = subprocess.Popen(arg, shell=True, stdout=log_file, stderr=log_file)
-                p.wait()
-
-        # Spawn a new thread, which will delete the folder after one minute
-        thread = DeleteTimerThread(dirname)
-        thread.start()
+    # Read the optional "cluster" section, for sharing work with other servers
+    cluster_conf = conf.get("cluster", {})
+    if cluster_conf:
+        try:
+            peer_ring = PeerRing(cluster_conf["self"], list(cluster_conf["peers"]),
+                                 timeout=float(cluster_conf.get("timeout", 30)))
+        except KeyError as e:
+            logging.critical("Config item 'cluster' is missing %s", e)
+            sys.exit()
+        logging.debug("Cluster has %d nodes, this is '%s'", len(peer_ring.nodes), peer_ring.self_url)
+    else:
+        peer_ring = None
 
+    # Read the optional "warmup" section, for rendering canary documents at startup
+    warmup_conf = conf.get("warmup", False)
+    if warmup_conf is True:
+        warmup_conf = {}
+    if warmup_conf is not False:
+        try:
+            # By default, warm up the default template and any other templates in the static content
+            warmup_templates = list(warmup_conf.get("templates", [def_template] + [
+                os.path.basename(static) for static in def_latex_static
+                if static.endswith((".latex", ".tex")) and os.path.basename(static) != def_template]))
+            warmup_compare = bool(warmup_conf.get("compare", True))
+            warmup_document = warmup_conf.get("document")
+            if warmup_document:
+                with open(warmup_document, 'rt', encoding="utf-8") as canary_file:
+                    warmup_document = canary_file.read()
+            else:
+                warmup_document = canary_document
+        except (AttributeError, TypeError, OSError) as e:
+            logging.critical("Config item 'warmup' is not valid: %s", e)
+            sys.exit()
+        logging.debug("Warm-up will render a canary with templates: %s", ", ".join(warmup_templates))
+        warmup = (warmup_templates, warmup_compare, warmup_document)
+    else:
+        warmup = None
 
-class App:
-    @cherrypy.expose
-    def index(self):
-        # cd back to the launch path, in case cwd has been set elsewhere
-        os.chdir(html_path)
-        return open('index.html')
+    return {"port": port, "listen": listen, "worker_count": worker_count, "queue_size": queue_size,
+            "precompiled_templates": precompiled_templates, "warm_workers": warm_workers,
+            "cache_path": cache_path, "cache_size_mb": cache_size_mb, "cache_age_days": cache_age_days,
+            "job_ttl": job_ttl, "disk_watermark": disk_watermark, "storage_backend": storage_backend,
+            "storage_conf": storage_conf, "warmup": warmup}
 
-    @cherrypy.expose
-    def style(self):
-        # cd back to the launch path, in case cwd has been set elsewhere
-        os.chdir(html_path)
-        return open('style.css')
 
-    @cherrypy.expose
-    def upload(self, ufile):
-        logging.debug("Using temporary directory '%s'", def_tempdir)
-        upload_path = os.path.normpath(def_tempdir)
-        upload_rand_name = ''.join(random.sample(string.hexdigits, 16))
-        upload_file = os.path.join(upload_path, upload_rand_name)
-        logging.debug("Uploading to file '%s'", upload_file)
-        size = 0
+def start_services(settings):
+    """Starts everything the server needs to render jobs, with the settings from read_config()"""
+    global metrics
+    global static_index
+    global toolchain_version
+    global result_cache
+    global job_registry
+    global single_flight
+    global janitor
+    global job_storage
+    global warm_pool
+    global format_cache
+    global scheduler
+    global warm_up
 
-        ## Check that the client has set the "x-method" header
-        x_method = cherrypy.request.headers.get('x-method')
-        good_req = False
-        if isinstance(x_method, str):
-            if x_method == "MD-to-PDF":
-                good_req = True
-        if not good_req:
-            raise cherrypy.HTTPError(405, "This server only supports Markdown to PDF rendering, please check your request")
+    ## Collect timings and counters for the /metrics endpoint
+    metrics = Metrics()
+
+    ## Index the static content and share it with jobs through the chroot, and checksum
+    ## the toolchain, as both are part of every cache key
+    static_index = StaticIndex(def_latex_static)
+    static_index.load()
+    toolchain_version = get_toolchain_version()
+    logging.info("Toolchain version: %s", toolchain_version)
+
+    ## Open the result cache, which is kept between runs
+    if settings["cache_path"]:
+        result_cache = ResultCache(settings["cache_path"], settings["cache_size_mb"] * 1024 * 1024,
+                                   settings["cache_age_days"] * 86400)
+        result_cache.evict()
+    else:
+        result_cache = None
+
+    ## Keep track of the state of each job, for the status API, and of the renders in progress
+    job_registry = JobRegistry()
+    single_flight = SingleFlight()
+
+    ## Start the janitor, which removes the folders of finished jobs
+    janitor = Janitor(settings["job_ttl"], settings["disk_watermark"])
+    janitor.start()
+
+    ## Set up where the output of finished jobs is kept
+    job_storage = JOB_STORAGE_BACKENDS[settings["storage_backend"]](settings["storage_conf"])
+
+    ## Start the long-lived shells inside the chroot, if enabled
+    if settings["warm_workers"] > 0:
+        warm_pool = WarmShellPool(settings["warm_workers"])
+        warm_pool.start()
+    else:
+        warm_pool = None
+
+    ## Build LaTeX format files for the templates that have opted in
+    format_cache = FormatCache(settings["precompiled_templates"])
+    format_cache.build_all()
+
+    ## Start the pool of render workers
+    scheduler = RenderScheduler(settings["worker_count"], settings["queue_size"])
+    scheduler.start()
+
+    ## Render the canary documents in the background, the server is only ready once they pass
+    if settings["warmup"] is not None:
+        warm_up = WarmUp(*settings["warmup"])
+        warm_up.start()
+    else:
+        warm_up = None
+
+
+def find_static_file(static):
+    # Static content can be relative to the static path, or an absolute path
+    static_file = os.path.join(static_path, static)
+    if os.path.isfile(static_file):
+        return static_file
+    logging.debug("File '%s' does not seem to be a relative path, trying as absolute", static_file)
+    if os.path.isfile(static):
+        return static
+    return None
 
-        ## Check if the client has set the 'template' header
+
+def hash_file(path):
+    # Return the SHA256 hash of a file, reading it in chunks
+    file_hash = hashlib.new('sha256')
+    with open(path, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(65536), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class StaticIndex:
+    """Index of the static content, which is checksummed and mirrored into the chroot once
+    (as hardlinks where possible), rather than copied into every job folder. Jobs find it through
+    TEXINPUTS and Pandoc's resource path, and the index is refreshed when the files change."""
+    def __init__(self, static_list, check_interval=5):
+        self.static_list = list(static_list)
+        self.mirror_path = os.path.join(chroot_path, chroot_static_dir.lstrip("/"))
+        self.check_interval = check_interval
+        self.last_check = 0
+        self.lock = threading.Lock()
+        # Maps the file name (as used by jobs) to details of the static file
+        self.entries = {}
+        # A single string which changes whenever any of the static content changes
+        self.checksums = ""
+
+    def load(self):
+        # Remove anything in the mirror which is not in the config any more. The rest is replaced
+        # in place, as other servers might be using the same chroot.
+        with self.lock:
+            os.makedirs(self.mirror_path, exist_ok=True)
+            names = set(os.path.basename(static) for static in self.static_list)
+            for name in os.listdir(self.mirror_path):
+                if name not in names:
+                    try:
+                        os.remove(os.path.join(self.mirror_path, name))
+                    except FileNotFoundError:
+                        pass
+            self.scan()
+
+    def refresh(self):
+        # Check for changed files, at most once every check_interval seconds
+        if time.monotonic() - self.last_check < self.check_interval:
+            return
+        with self.lock:
+            self.scan()
+
+    def scan(self):
+        self.last_check = time.monotonic()
+        changed = False
+        for static in self.static_list:
+            name = os.path.basename(static)
+            entry = self.entries.get(name)
+            static_file = find_static_file(static)
+            if not static_file:
+                if entry is not None or not self.checksums:
+                    logging.error("Static content '%s' is not accessible", static)
+                if entry is not None:
+                    del self.entries[name]
+                    try:
+                        os.remove(os.path.join(self.mirror_path, name))
+                    except FileNotFoundError:
+                        pass
+                    changed = True
+                continue
+            file_stat = os.stat(static_file)
+            file_stat = (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+            if entry is not None and entry["stat"] == file_stat:
+                continue
+            if entry is not None:
+                logging.info("Static content '%s' has changed, reloading it", static)
+            self.entries[name] = {"source": static_file, "stat": file_stat, "sha256": hash_file(static_file)}
+            self.mirror(static_file, name)
+            changed = True
+        if changed or not self.checksums:
+            self.checksums = ";".join(name + ":" + self.entries[name]["sha256"] for name in sorted(self.entries))
+
+    def mirror(self, static_file, name):
+        # Link (or if that is not possible, copy) a file into the mirror inside the chroot
+        mirror_file = os.path.join(self.mirror_path, name)
+        tmp_file = "{}.tmp-{}".format(mirror_file, os.getpid())
+        os.replace(link_file(static_file, tmp_file), mirror_file)
+        logging.debug("Static content '%s' is shared as '%s'", static_file, mirror_file)
+
+    def template_path(self, template):
+        # Return the path to give Pandoc for a template - static templates are used from the
+        # mirror inside the chroot, anything else is expected to be part of the upload
+        if template in self.entries:
+            return os.path.join(chroot_static_dir, template)
+        return template
+
+    def file_for(self, template):
+        # Return the path of a static file on the host, or None if it is not static content
+        entry = self.entries.get(template)
+        return entry["source"] if entry else None
+
+    def checksum(self, template):
+        entry = self.entries.get(template)
+        return entry["sha256"] if entry else None
+
+
+def get_toolchain_version():
+    # Ask the tools inside the chroot for their versions, so that cached PDFs
+    # are not reused after Pandoc or TeX Live are updated
+    versions = []
+    for tool in ("pandoc --version", "xelatex --version", "latexdiff --version"):
         try:
-            x_template = cherrypy.request.headers.get('x-latex-template')
-        except:
-            pass
-        if isinstance(x_template, str):
-            template = x_template
-        else:
-            template = def_template
+            result = subprocess.run(["chroot", chroot_path, "wrapper", tool], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, timeout=60)
+            output = result.stdout.decode("utf-8", "replace").strip().splitlines()
+            versions.append(output[0] if output else "unknown")
+        except Exception as e:
+            logging.warning("Could not get version with '%s': %s", tool, e)
+            versions.append("unknown")
+    return "; ".join(versions)
 
-        ## Check if the client has set the 'compare' header
+
+def get_render_key(input_hash, template, compare_mode, profile=None):
+    # Build the key for the result cache, from everything that affects the output PDF
+    key_hash = hashlib.new('sha256')
+    key_parts = [input_hash, template, str(bool(compare_mode)), static_index.checksums, toolchain_version]
+    if compare_mode:
+        key_parts.append(repr(compare_replace))
+    if profile is not None and not profile.is_default():
+        key_parts.append(profile.settings())
+    if graphics_converter is not None:
+        key_parts.append(graphics_converter.settings())
+    key_hash.update("\n".join(key_parts).encode("utf-8"))
+    return key_hash.hexdigest()
+
+
+class ResultCache:
+    """Content-addressed store of rendered PDFs, which is kept between runs"""
+    def __init__(self, cache_path, max_size, max_age):
+        self.results_path = os.path.join(cache_path, "results")
+        self.hashes_path = os.path.join(cache_path, "hashes")
+        self.latex_path = os.path.join(cache_path, "latex")
+        self.aux_path = os.path.join(cache_path, "aux")
+        self.graphics_path = os.path.join(cache_path, "graphics")
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        os.makedirs(self.results_path, exist_ok=True)
+        os.makedirs(self.hashes_path, exist_ok=True)
+        os.makedirs(self.latex_path, exist_ok=True)
+        os.makedirs(self.aux_path, exist_ok=True)
+        os.makedirs(self.graphics_path, exist_ok=True)
+
+    def lookup(self, render_key):
+        # Return the path of the cached PDF for a render key, or None
+        entry_path = os.path.join(self.results_path, render_key)
         try:
-            x_compare = cherrypy.request.headers.get('x-latex-compare')
-        except:
+            for file in os.listdir(entry_path):
+                if file.endswith(tuple(output_content_types)):
+                    # Mark the entry as recently used
+                    os.utime(entry_path)
+                    return os.path.join(entry_path, file)
+        except FileNotFoundError:
             pass
-        if isinstance(x_compare, str):
-            logging.info("Upload has requested 'compare mode'")
-            compare_mode = True
-        else:
-            compare_mode = False
+        return None
 
-        ## Accept the upload file and write it to disk with a temporary name
-        with open(upload_file, 'wb') as out:
-            while True:
-                data = ufile.file.read(8192)
-                if not data:
-                    break
-                out.write(data)
-                size += len(data)
+    def lookup_hash(self, hashsum):
+        # Return the cached PDF for the most recent render of an uploaded file, or None
+        if not re.fullmatch("[0-9a-f]{64}", hashsum):
+            return None
+        try:
+            with open(os.path.join(self.hashes_path, hashsum), 'rt', encoding="utf-8") as alias_file:
+                render_key = alias_file.read().strip()
+        except (FileNotFoundError, ValueError):
+            return None
+        return self.lookup(render_key)
+
+    def set_alias(self, hashsum, render_key):
+        # Point an uploaded file's hash at a render key, or remove the pointer if render_key is None
+        alias_path = os.path.join(self.hashes_path, hashsum)
+        if render_key is None:
+            try:
+                os.remove(alias_path)
+            except FileNotFoundError:
+                pass
+            return
+        tmp_path = alias_path + "." + ''.join(random.sample(string.hexdigits, 8))
+        with open(tmp_path, 'wt', encoding="utf-8") as alias_file:
+            alias_file.write(render_key)
+        os.replace(tmp_path, alias_path)
 
-        ## Calculate the SHA256 hash of the file, to use as a reference
+    def store(self, render_key, hashsum, pdf_path):
+        # Copy a rendered PDF into the cache
+        entry_path = os.path.join(self.results_path, render_key)
+        tmp_path = entry_path + ".tmp-" + ''.join(random.sample(string.hexdigits, 8))
         try:
-            input_hash = hashlib.new('sha256')
-            with open(upload_file, 'rb') as input_file:
-                buf = input_file.read()
-                input_hash.update(buf)
-            logging.debug("Hash for file '%s' is %s", upload_file, input_hash.hexdigest())
+            os.mkdir(tmp_path)
+            shutil.copy(pdf_path, tmp_path)
+            try:
+                os.rename(tmp_path, entry_path)
+            except OSError:
+                # Another job already stored this result
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            self.set_alias(hashsum, render_key)
+            logging.info("Stored '%s' in the result cache", os.path.basename(pdf_path))
+        except Exception as e:
+            logging.error("Unable to store '%s' in the result cache: %s", pdf_path, e)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
 
-            new_name = os.path.join(upload_path, (input_hash.hexdigest() + ".zip"))
-            os.rename(upload_file, new_name)
-        except:
-            logging.critical("File '%s' could not be processed", full_path)
-            raise cherrypy.HTTPError(500)
+    def lookup_latex(self, latex_key, output_path):
+        # Copy cached intermediate LaTeX to output_path, returning True if it was found
+        entry_path = os.path.join(self.latex_path, latex_key + ".latex")
+        try:
+            shutil.copyfile(entry_path, output_path)
+            os.utime(entry_path)
+            return True
+        except FileNotFoundError:
+            return False
 
-        ## Move the temporary file to use the SHA256 hash as a filename
-        path_exists = False
+    def store_latex(self, latex_key, latex_path):
+        # Keep a copy of intermediate LaTeX, produced by Pandoc
+        entry_path = os.path.join(self.latex_path, latex_key + ".latex")
+        tmp_path = entry_path + ".tmp-" + ''.join(random.sample(string.hexdigits, 8))
         try:
-            output_path = os.path.join(upload_path, input_hash.hexdigest())
-            os.mkdir(output_path)
-        except(FileExistsError):
-            logging.info("Path already exists: %s", output_path)
-            path_exists = True
+            shutil.copyfile(latex_path, tmp_path)
+            os.replace(tmp_path, entry_path)
+        except Exception as e:
+            logging.error("Unable to store '%s' in the result cache: %s", latex_path, e)
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
 
-        report_string = ""
-        ## Extract the ZIP archive into a temporary folder
-        if not path_exists:
+    def lookup_graphic(self, graphic_key, output_path):
+        # Link a cached converted figure to output_path, replacing any file there, and return True if
+        # it was found
+        entry_path = os.path.join(self.graphics_path, graphic_key + os.path.splitext(output_path)[1])
+        tmp_path = output_path + ".tmp-" + ''.join(random.sample(string.hexdigits, 8))
+        try:
+            link_file(entry_path, tmp_path)
+        except FileNotFoundError:
+            return False
+        os.replace(tmp_path, output_path)
+        os.utime(entry_path)
+        return True
+
+    def store_graphic(self, graphic_key, graphic_path):
+        # Keep a copy of a converted figure
+        entry_path = os.path.join(self.graphics_path, graphic_key + os.path.splitext(graphic_path)[1])
+        tmp_path = entry_path + ".tmp-" + ''.join(random.sample(string.hexdigits, 8))
+        try:
+            shutil.copyfile(graphic_path, tmp_path)
+            os.replace(tmp_path, entry_path)
+        except Exception as e:
+            logging.error("Unable to store '%s' in the result cache: %s", graphic_path, e)
             try:
-                in_zip = zipfile.ZipFile(new_name, 'r')
-                in_zip.extractall(output_path)
-            except Exception as e:
-                logging.error("Error in zip extraction: %s", e)
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
 
-            ## Make symbolic links to required static content for PDF creation
-            for static in def_latex_static:
-                logging.debug("Making copy of static content '%s'", static)
-                try:
-                    # First try static content as a relative path
-                    static_file = os.path.join(static_path, static)
-                    path_valid = False
-                    if os.path.isfile(static_file):
-                        path_valid = True
-                    else:
-                        # If not, try it as an absolute path
-                        logging.debug("File '%s' does not seem to be a relative path, trying as absolute", static_file)
-                        static_file = static
-                        if os.path.isfile(static_file):
-                            path_valid = True
-                    if not path_valid:
-                        logging.critical("Static file '%s' is not accessible")
-                    else:
-                        shutil.copy(static_file, output_path)
-
-                except Exception as e:
-                    logging.critical("Unable to make link for file: %s. Error: ", static, e.msg)
-
-            ## Delete any existing PDF and log files
-            for file in os.listdir(output_path):
-                if file.endswith(".log") or file.endswith(".pdf"):
-                    del_path = os.path.join(output_path, file)
-                    logging.info("Deleting file: %s", del_path)
-                    os.remove(del_path)
-
-            report_string = "File is being processed into a PDF, request it using the hash value"
-        else:
-            report_string = "File has already been submitted, request the PDF using the hash value"
+    def lookup_aux(self, aux_key, build_path, job_name):
+        # Copy the kept LaTeX aux files of a document into build_path, returning True if there were any
+        entry_path = os.path.join(self.aux_path, aux_key)
+        try:
+            files = os.listdir(entry_path)
+            for file in files:
+                shutil.copyfile(os.path.join(entry_path, file), os.path.join(build_path, job_name + os.path.splitext(file)[1]))
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return False
+        return bool(files)
 
-        ## Look for a MarkDown file in the extracted directory, and spawn a subprocess to render it
-        md_path = False
-        md_path_compare = False
-        for file in os.listdir(output_path):
-            if file.endswith(".md"):
-                tmp_path = os.path.join(output_path, file)
-                logging.info("Found MD file: %s", tmp_path)
-                if compare_mode:
-                    if tmp_path.find("old") > -1:
-                        # Store the name of the "old" MD file
-                        md_path_compare = tmp_path
-                    elif tmp_path.find("new") > -1:
-                        # Store the name of the "new" MD file
-                        md_path = tmp_path
-                else:
-                    # Stop at the first found MD file in normal mode
-                    md_path = tmp_path
+    def store_aux(self, aux_key, build_path, job_name):
+        # Keep the LaTeX aux files of a document, replacing those of its last render
+        entry_path = os.path.join(self.aux_path, aux_key)
+        tmp_path = entry_path + ".tmp-" + ''.join(random.sample(string.hexdigits, 8))
+        old_path = entry_path + ".tmp-" + ''.join(random.sample(string.hexdigits, 8))
+        try:
+            os.mkdir(tmp_path)
+            for extension in latex_aux_extensions:
+                aux_file = os.path.join(build_path, job_name + extension)
+                if os.path.isfile(aux_file):
+                    shutil.copyfile(aux_file, os.path.join(tmp_path, "document" + extension))
+            try:
+                os.rename(entry_path, old_path)
+            except FileNotFoundError:
+                pass
+            os.rename(tmp_path, entry_path)
+        except Exception as e:
+            logging.error("Unable to store the aux files of '%s' in the result cache: %s", job_name, e)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def evict(self):
+        # Remove entries older than max_age, then the least recently used entries until under max_size
+        with self.lock:
+            entries = []
+            now = time.time()
+            for base_path in (self.results_path, self.latex_path, self.aux_path, self.graphics_path):
+                for name in os.listdir(base_path):
+                    entry_path = os.path.join(base_path, name)
+                    try:
+                        last_used = os.stat(entry_path).st_mtime
+                        if os.path.isdir(entry_path):
+                            size = sum(os.path.getsize(os.path.join(entry_path, file)) for file in os.listdir(entry_path))
+                        else:
+                            size = os.path.getsize(entry_path)
+                    except OSError:
+                        continue
+                    if ".tmp-" in name:
+                        # Left behind by an interrupted store, clean it up once it is old enough
+                        if now - last_used > 3600:
+                            self.remove_entry(entry_path)
+                        continue
+                    entries.append((last_used, size, entry_path))
+            entries.sort()
+            total_size = sum(entry[1] for entry in entries)
+            for last_used, size, entry_path in entries:
+                if (now - last_used) <= self.max_age and total_size <= self.max_size:
                     break
-        if md_path:
-            md_basename = os.path.basename(md_path)
-            logging.debug("Basename is '%s'", md_basename)
-            # Spawn PdfWorkerThread with necessary options
-            if compare_mode:
-                thread = PdfWorkerThread(input_md=md_path, template=template, compare_mode=True, compare_md=md_path_compare)
-                thread.start()
-            else:
-                thread = PdfWorkerThread(input_md=md_path, template=template)
-                thread.start()
+                logging.info("Evicting '%s' from the result cache", entry_path)
+                self.remove_entry(entry_path)
+                total_size -= size
+            # Remove aliases which no longer point at a cached result
+            for hashsum in os.listdir(self.hashes_path):
+                alias_path = os.path.join(self.hashes_path, hashsum)
+                try:
+                    with open(alias_path, 'rt', encoding="utf-8") as alias_file:
+                        render_key = alias_file.read().strip()
+                    if not os.path.isdir(os.path.join(self.results_path, render_key)):
+                        os.remove(alias_path)
+                except (OSError, ValueError):
+                    pass
+
+    def remove_entry(self, entry_path):
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
         else:
-            report_string = "MD file not found in submitted archive"
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
 
-        ## Put the hash value in a cookie to send back to the client
-        cookie = cherrypy.response.cookie
-        cookie['hashsum'] = input_hash.hexdigest()
-        ## Create a short message to send back to the client
-        out = '''
-File received
-length: {}
-filename: {}
-hash: {}
-{}
-''' .format(size, ufile.filename, input_hash.hexdigest(), report_string, data)
-        ## Finally, actually send the response
-        return out
 
-    ## Provide a handler for fetching a compiled PDF
-    @cherrypy.expose
-    def fetch(self, hashsum=""):
-        req_path = os.path.join(def_tempdir, hashsum)
-
-        # By default, assume the PDF was not found
-        pdf_path = False
-        # Attempt to find a PDF for the given hash
-        try:
-            for file in os.listdir(req_path):
-                if file.endswith(".pdf"):
-                    pdf_path = os.path.join(req_path, file)
-                    logging.info("Found PDF file: %s", pdf_path)
-        except(FileNotFoundError):
-            # Raise a 404 error if we cannot find the given path
-            logging.critical("File not found for hash: %s", hashsum)
-            raise cherrypy.HTTPError(404, ("No file was found for the given hashsum: " + hashsum))
-        except Exception as e:
-            # Raise a 500 error if any other exception occurs
-            logging.critical("Other error: %s", e.msg)
-            raise cherrypy.HTTPError(500)
+class LocalJobStorage:
+    """Keeps the output of each job in its folder in the temporary directory, so it can only be
+    fetched from this server"""
+    def __init__(self, storage_conf):
+        pass
 
-        # If we have found the PDF, serve it to the client
-        if pdf_path:
-            return cherrypy.lib.static.serve_file(pdf_path, disposition='attachment', name=os.path.basename(pdf_path))
-        # If we did not find it, try to serve the error log instead
-        else:
+    def store(self, hashsum, dirname, job_status):
+        # The job folder is already where find_output looks
+        pass
+
+    def find_output(self, hashsum):
+        # Return the path of the PDF from a job, or its log if there is no PDF (or the ZIP file
+        # from a batch), or None
+        folder = os.path.join(def_tempdir, hashsum)
+        # The job's record names its output, which saves searching the folder for it
+        job = job_registry.get(hashsum) or {}
+        name = job.get("pdf") or job.get("zip") or job.get("log")
+        if name and os.path.isfile(os.path.join(folder, name)):
+            return os.path.join(folder, name)
+        return self.find_in(folder)
+
+    def load_status(self, hashsum):
+        return None
+
+    def load_info(self, hashsum):
+        # Return the timeline and resource use of a job, or None
+        if not re.fullmatch("[0-9a-f]{64}", hashsum):
+            return None
+        return self.read_info(os.path.join(def_tempdir, hashsum))
+
+    @staticmethod
+    def read_info(folder):
+        try:
+            with open(os.path.join(folder, job_info_name), 'rt', encoding="utf-8") as info_file:
+                return json.load(info_file)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def find_in(folder):
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            return None
+        for extension in (".pdf", ".html", ".log", ".zip"):
+            for name in names:
+                if name.endswith(extension):
+                    return os.path.join(folder, name)
+        return None
+
+
+class SharedJobStorage(LocalJobStorage):
+    """Also copies the output and final status of each job into a folder shared by all the servers
+    (i.e. over NFS), so any of them can serve it. Entries are removed after the retention time."""
+    def __init__(self, storage_conf):
+        self.shared_path = storage_conf["path"]
+        self.retention = float(storage_conf.get("retention_hours", 24)) * 3600
+        self.last_evict = 0
+        os.makedirs(self.shared_path, exist_ok=True)
+
+    def store(self, hashsum, dirname, job_status):
+        output_file = self.find_in(dirname)
+        # Build the entry in a temporary folder, then rename it into place
+        tmp_path = os.path.join(self.shared_path, ".tmp-" + ''.join(random.sample(string.hexdigits, 16)))
+        entry_path = os.path.join(self.shared_path, hashsum)
+        try:
+            os.makedirs(tmp_path)
+            if output_file:
+                shutil.copy(output_file, tmp_path)
+            if os.path.isfile(os.path.join(dirname, job_info_name)):
+                shutil.copy(os.path.join(dirname, job_info_name), tmp_path)
+            with open(os.path.join(tmp_path, "status.json"), 'wt', encoding="utf-8") as status_file:
+                json.dump(job_status, status_file)
+            shutil.rmtree(entry_path, ignore_errors=True)
+            os.rename(tmp_path, entry_path)
+            logging.debug("Stored output of job %s in '%s'", hashsum, entry_path)
+        except OSError as e:
+            logging.error("Unable to store output of job %s in shared storage: %s", hashsum, e)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
+
+    def find_output(self, hashsum):
+        return super().find_output(hashsum) or self.find_in(self.entry_path(hashsum))
+
+    def load_info(self, hashsum):
+        return super().load_info(hashsum) or self.read_info(self.entry_path(hashsum))
+
+    def load_status(self, hashsum):
+        try:
+            with open(os.path.join(self.entry_path(hashsum), "status.json"), 'rt', encoding="utf-8") as status_file:
+                return json.load(status_file)
+        except (OSError, ValueError):
+            return None
+
+    def entry_path(self, hashsum):
+        # Only accept real hashes, so the path cannot leave the shared folder
+        if not re.fullmatch("[0-9a-f]{64}", hashsum):
+            return os.path.join(self.shared_path, ".missing")
+        return os.path.join(self.shared_path, hashsum)
+
+    def evict(self):
+        # Remove old entries, at most once every ten minutes
+        now = time.time()
+        if now - self.last_evict < 600:
+            return
+        self.last_evict = now
+        for name in os.listdir(self.shared_path):
+            entry_path = os.path.join(self.shared_path, name)
             try:
-                err_path = False
-                for file in os.listdir(req_path):
-                    if file.endswith(".log"):
-                        err_path = os.path.join(req_path, file)
-                        logging.info("Found error logfile: %s", err_path)
-            except Exception as e:
-                # Raise a 500 error if something unknown goes wrong
-                logging.critical("Other error: %s", e.msg)
-                raise cherrypy.HTTPError(500)
+                if now - os.stat(entry_path).st_mtime > self.retention:
+                    logging.debug("Removing old shared job output '%s'", entry_path)
+                    shutil.rmtree(entry_path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
 
-            if err_path:
-                return cherrypy.lib.static.serve_file(err_path, disposition='attachment', name=os.path.basename(err_path))
 
-        # If we get to this point, we could not find a PDF or an error log
-        raise cherrypy.HTTPError(404, ("No file was found for the given hashsum: " + hashsum))
+JOB_STORAGE_BACKENDS = {
+    "local": LocalJobStorage,
+    "shared": SharedJobStorage,
+}
+
+
+class PeerRing:
+    """Consistent hash ring over the servers in a cluster. Each upload hash is owned by one server,
+    which renders it, and the other servers forward requests for that hash to it."""
+    # Header added to forwarded requests, so they are never forwarded again
+    FORWARDED_HEADER = "X-Md2pdf-Forwarded"
+
+    def __init__(self, self_url, peers, replicas=64, timeout=30):
+        self.self_url = self_url.rstrip("/")
+        self.nodes = sorted(set([peer.rstrip("/") for peer in peers] + [self.self_url]))
+        self.timeout = timeout
+        # Each server gets several points on the ring, to spread the hashes evenly
+        points = []
+        for node in self.nodes:
+            for replica in range(replicas):
+                points.append((self.ring_position("{}#{}".format(node, replica)), node))
+        points.sort()
+        self.positions = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    @staticmethod
+    def ring_position(value):
+        return int(hashlib.sha256(value.encode("utf-8")).hexdigest()[:16], 16)
+
+    def owner(self, hashsum):
+        index = bisect.bisect(self.positions, self.ring_position(hashsum)) % len(self.positions)
+        return self.owners[index]
+
+    def forward_to(self, hashsum, request_headers):
+        # Return the server to forward a request for this hash to, or None to handle it here
+        if request_headers.get(self.FORWARDED_HEADER):
+            return None
+        owner = self.owner(hashsum)
+        return None if owner == self.self_url else owner
+
+    def forward(self, method, url, **kwargs):
+        headers = kwargs.pop("headers", {})
+        headers[self.FORWARDED_HEADER] = self.self_url
+        return requests.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+
+    def forward_upload(self, owner, filename, spool, request_headers, path="/upload"):
+        # Send an upload on to another server, and return its response.
+        # Returns None if that server could not be reached, so the file can be rendered here instead.
+        headers = {}
+        for name in ('x-method', 'x-latex-template', 'x-latex-compare', 'x-document-id', 'x-render-profile'):
+            if name in request_headers:
+                headers[name] = request_headers[name]
+        spool.seek(0)
+        try:
+            response = self.forward("POST", owner + path, headers=headers, files={"ufile": (filename, spool)})
+        except requests.RequestException as e:
+            logging.warning("Unable to forward upload '%s' to '%s', will render it here: %s", filename, owner, e)
+            return None
+        logging.info("Forwarded upload '%s' to '%s'", filename, owner)
+        metrics.inc("md2pdf_forwarded_requests_total", endpoint=path.strip("/"))
+        return response
+
+
+class Janitor(threading.Thread):
+    """Removes the folders of finished jobs from the temporary directory once their time is up,
+    using one thread and a heap of deadlines. Fetching a job's output gives it more time, and
+    the folders closest to their deadline are removed early if the file system gets too full."""
+    def __init__(self, ttl, watermark, check_interval=10):
+        # Initialise the threading.Thread parent, as a daemon so it won't block shutdown
+        super().__init__(name="janitor", daemon=True)
+        # Store the passed objects
+        self.ttl = ttl
+        self.watermark = watermark
+        self.check_interval = check_interval
+        self.condition = threading.Condition()
+        # Heap of (deadline, folder). The current deadline of each folder is kept in self.deadlines,
+        # so entries left in the heap by an extension can be skipped.
+        self.heap = []
+        self.deadlines = {}
+        # Set while the disk is over the watermark with nothing left to remove, to only warn once
+        self.disk_full = False
+
+    def schedule(self, folder, ttl=None):
+        # Remove a folder (and the upload it was extracted from) after a time, replacing any earlier deadline
+        deadline = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.condition:
+            self.deadlines[folder] = deadline
+            heapq.heappush(self.heap, (deadline, folder))
+            self.condition.notify()
+
+    def extend(self, folder):
+        # Give a folder which is waiting to be removed another full TTL
+        with self.condition:
+            if folder in self.deadlines:
+                deadline = max(self.deadlines[folder], time.monotonic() + self.ttl)
+                self.deadlines[folder] = deadline
+                heapq.heappush(self.heap, (deadline, folder))
+
+    def cancel(self, folder):
+        # Keep a folder, as it is being used again
+        with self.condition:
+            self.deadlines.pop(folder, None)
+
+    def pending(self):
+        with self.condition:
+            return len(self.deadlines)
+
+    def disk_usage(self):
+        # Return how full the file system holding the temporary directory is, as a percentage
+        usage = shutil.disk_usage(def_tempdir)
+        return 100.0 * usage.used / usage.total
+
+    def run(self):
+        while True:
+            with self.condition:
+                expired = []
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    deadline, folder = heapq.heappop(self.heap)
+                    if self.deadlines.get(folder) == deadline:
+                        del self.deadlines[folder]
+                        expired.append(folder)
+            for folder in expired:
+                self.remove(folder, "expired")
+            if self.watermark:
+                self.check_disk()
+            with self.condition:
+                timeout = self.check_interval
+                if self.heap:
+                    timeout = min(timeout, max(0, self.heap[0][0] - time.monotonic()))
+                self.condition.wait(timeout)
+
+    def check_disk(self):
+        # Remove folders in order of their deadlines until the file system is below the watermark
+        while self.disk_usage() > self.watermark:
+            with self.condition:
+                if not self.deadlines:
+                    if not self.disk_full:
+                        logging.warning("Temporary directory is over %d%% full, but no job folders can be removed",
+                                        self.watermark)
+                        self.disk_full = True
+                    return
+                folder = min(self.deadlines, key=self.deadlines.get)
+                del self.deadlines[folder]
+            self.remove(folder, "disk")
+        self.disk_full = False
+
+    def remove(self, folder, reason):
+        logging.info("Removing folder '%s' (%s)", folder, reason)
+        metrics.inc("md2pdf_janitor_removed_total", reason=reason)
+        try:
+            shutil.rmtree(folder)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error("An error occurred while removing '%s': %s", folder, e)
+        try:
+            os.remove(folder + ".zip")
+        except FileNotFoundError:
+            pass
+
+
+class JobRegistry:
+    """In-memory record of the state of each job, which clients can wait on for changes"""
+    # The states a job moves through, the last three are final ("rendering" is only used by batches)
+    STATES = ("queued", "extracting", "graphics", "pandoc", "latexdiff", "xelatex", "rendering", "done", "failed", "timed_out")
+    FINAL_STATES = ("done", "failed", "timed_out")
+
+    def __init__(self, retention=3600):
+        self.jobs = {}
+        self.condition = threading.Condition()
+        # Finished jobs are forgotten after this many seconds
+        self.retention = retention
+        # Functions called with the hash of each job that changes, from whichever thread changed it
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def update(self, hashsum, state, **details):
+        # Move a job into a new state, and wake up anyone waiting on it
+        now = time.time()
+        with self.condition:
+            job = self.jobs.get(hashsum)
+            if job is None or (job["state"] in self.FINAL_STATES and state not in self.FINAL_STATES):
+                # Start a new record, for a new job or a new render of a finished one
+                job = {"hash": hashsum, "version": 0, "created": now, "history": []}
+                self.jobs[hashsum] = job
+            job["state"] = state
+            job["updated"] = now
+            job["version"] += 1
+            if not job["history"] or job["history"][-1]["state"] != state:
+                job["history"].append({"state": state, "time": now})
+            job.update(details)
+            self.condition.notify_all()
+            self.prune(now)
+        for listener in self.listeners:
+            listener(hashsum)
+
+    def remove(self, hashsum):
+        with self.condition:
+            self.jobs.pop(hashsum, None)
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener(hashsum)
+
+    def get(self, hashsum):
+        # Return a copy of the job record, or None if it is not known
+        with self.condition:
+            return self.copy(hashsum)
+
+    def wait(self, hashsum, since=None, timeout=0):
+        # Wait until the job's version is newer than 'since' (or, if 'since' is None,
+        # until it is finished), then return a copy of it. Returns early on timeout.
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                job = self.jobs.get(hashsum)
+                if job is None:
+                    return None
+                if since is None:
+                    if job["state"] in self.FINAL_STATES:
+                        break
+                elif job["version"] > since:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.copy(hashsum)
+
+    def copy(self, hashsum):
+        job = self.jobs.get(hashsum)
+        if job is None:
+            return None
+        job = dict(job)
+        job["history"] = list(job["history"])
+        return job
+
+    def prune(self, now):
+        # Forget finished jobs once they are older than the retention time
+        for hashsum in [key for key, job in self.jobs.items()
+                        if job["state"] in self.FINAL_STATES and now - job["updated"] > self.retention]:
+            del self.jobs[hashsum]
+
+
+class SingleFlight:
+    """Keeps track of the files being rendered, so that each one is only rendered once at a time"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps the hash of each file being rendered to the render key of that render
+        self.flights = {}
+
+    def claim(self, hashsum, render_key):
+        # Start a render of a file, if it is not being rendered already. Returns None if the caller
+        # now owns the render (and must release it), or the render key of the one in progress.
+        with self.lock:
+            current_key = self.flights.get(hashsum)
+            if current_key is None:
+                self.flights[hashsum] = render_key
+            return current_key
+
+    def release(self, hashsum):
+        with self.lock:
+            self.flights.pop(hashsum, None)
+
+
+class RenderConflict(Exception):
+    """Raised for an upload of a file which is already being rendered with other options"""
+
+
+class Metrics:
+    """Counters and timing histograms, which are served at /metrics in the Prometheus text format"""
+    # Upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    DESCRIPTIONS = {
+        "md2pdf_stage_duration_seconds": "Time spent in each stage of handling a document",
+        "md2pdf_cache_requests_total": "Lookups in the result and LaTeX caches",
+        "md2pdf_failures_total": "Render failures, by the stage that failed",
+        "md2pdf_jobs_total": "Finished render jobs, by result",
+        "md2pdf_upload_bytes_total": "Bytes of uploaded ZIP files received",
+        "md2pdf_pdf_rendered_bytes_total": "Bytes of PDF files rendered",
+        "md2pdf_pdf_served_bytes_total": "Bytes of PDF files sent to clients",
+        "md2pdf_queue_depth": "Render jobs waiting in the queue",
+        "md2pdf_active_workers": "Render workers currently running a job",
+        "md2pdf_workers": "Render workers in the pool",
+        "md2pdf_forwarded_requests_total": "Requests forwarded to the server which owns the hash",
+        "md2pdf_janitor_removed_total": "Job folders removed from the temporary directory, by reason",
+        "md2pdf_janitor_pending_folders": "Job folders waiting to be removed",
+        "md2pdf_temp_disk_used_percent": "How full the file system holding the temporary directory is",
+        "md2pdf_warmup_duration_seconds": "Time taken to render each warm-up canary at startup",
+        "md2pdf_ready": "Whether the server is ready for jobs, after the warm-up",
+        "md2pdf_cpu_seconds_total": "CPU time used by the commands run for jobs, by stage and mode",
+        "md2pdf_slow_jobs_total": "Render jobs which took longer than the slow job threshold",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Both map a metric name to a dict of {label tuple: value}
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        # Histograms are stored as [bucket counts..., sum, count]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.histograms.setdefault(name, {})
+            histogram = values.setdefault(key, [0] * len(self.BUCKETS) + [0.0, 0])
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def observe_stage(self, stage, duration):
+        self.observe("md2pdf_stage_duration_seconds", duration, stage=stage)
+
+    @contextlib.contextmanager
+    def time_stage(self, stage):
+        # Time a block of code as one stage
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.monotonic() - start_time)
+
+    @staticmethod
+    def format_labels(key, extra=()):
+        labels = list(key) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                              for name, value in labels) + "}"
+
+    def render(self, gauges):
+        # Return all of the metrics in the Prometheus text exposition format
+        lines = []
+        def describe(name, metric_type):
+            lines.append("# HELP {} {}".format(name, self.DESCRIPTIONS.get(name, name)))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+        with self.lock:
+            for name in sorted(self.counters):
+                describe(name, "counter")
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append("{}{} {}".format(name, self.format_labels(key), value))
+            for name in sorted(self.histograms):
+                describe(name, "histogram")
+                for key, histogram in sorted(self.histograms[name].items()):
+                    for bound, count in zip(self.BUCKETS, histogram):
+                        lines.append("{}_bucket{} {}".format(name, self.format_labels(key, [("le", bound)]), count))
+                    lines.append("{}_bucket{} {}".format(name, self.format_labels(key, [("le", "+Inf")]), histogram[-1]))
+                    lines.append("{}_sum{} {}".format(name, self.format_labels(key), histogram[-2]))
+                    lines.append("{}_count{} {}".format(name, self.format_labels(key), histogram[-1]))
+        for name, value in gauges.items():
+            describe(name, "gauge")
+            lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+class RenderScheduler:
+    """Runs render jobs on a fixed pool of worker threads, fed by a bounded FIFO queue"""
+    def __init__(self, worker_count, queue_size):
+        self.worker_count = max(1, worker_count)
+        self.jobs = queue.Queue(maxsize=max(1, queue_size))
+        self.lock = threading.Lock()
+        self.active_workers = 0
+        # Rolling average of the time taken for one job, used to estimate waiting times
+        self.average_duration = 30.0
+
+    def start(self):
+        for index in range(self.worker_count):
+            worker = RenderWorkerThread(self, index)
+            worker.start()
+        logging.info("Started %d render workers", self.worker_count)
+
+    def is_full(self):
+        return self.jobs.full()
+
+    def submit(self, job):
+        # Add a job to the queue, and return its position (1 is the next to run).
+        # Raises queue.Full if the queue has no space left.
+        with self.lock:
+            self.jobs.put_nowait(job)
+            return self.jobs.qsize()
+
+    def estimate_wait(self, position=None):
+        # Estimate how many seconds a job at the given queue position will wait
+        with self.lock:
+            if position is None:
+                position = self.jobs.qsize() + 1
+            idle_workers = self.worker_count - self.active_workers
+            if position <= idle_workers:
+                return 0
+            rounds = math.ceil((position - idle_workers) / self.worker_count)
+            return int(math.ceil(rounds * self.average_duration))
+
+    def job_started(self):
+        with self.lock:
+            self.active_workers += 1
+
+    def job_finished(self, duration):
+        with self.lock:
+            self.active_workers -= 1
+            self.average_duration = (0.8 * self.average_duration) + (0.2 * duration)
+
+
+class RenderWorkerThread(threading.Thread):
+    def __init__(self, scheduler, index):
+        # Initialise the threading.Thread parent, as a daemon so it won't block shutdown
+        super().__init__(name="render-worker-" + str(index), daemon=True)
+        # Store the passed objects
+        self.scheduler = scheduler
+
+    def run(self):
+        # Take jobs off the queue in order, forever
+        while True:
+            job = self.scheduler.jobs.get()
+            self.scheduler.job_started()
+            start_time = time.monotonic()
+            metrics.observe_stage("queue", start_time - job.created)
+            try:
+                job.run()
+            except Exception as e:
+                logging.error("Render job for '%s' failed: %s", job.md_file, e)
+                job.finish_stage()
+                metrics.inc("md2pdf_failures_total", stage=job.stage)
+                metrics.inc("md2pdf_jobs_total", result="failed")
+                job_registry.update(job.hashsum, "failed", error=str(e))
+            finally:
+                # Uploads of the same file can start a new render from here on
+                single_flight.release(job.hashsum)
+                self.scheduler.job_finished(time.monotonic() - start_time)
+                self.scheduler.jobs.task_done()
+
+
+class CompareReplacer:
+    """The "compare_replace" rules, compiled so that each line is scanned as few times as possible.
+
+    The rules are applied in order, each one to the output of the last. Neighbouring rules are
+    combined into a single regular expression pass, as long as that gives exactly the same result -
+    i.e. none of their strings can overlap each other, or the text that an earlier rule puts in."""
+    def __init__(self, replace_maps):
+        self.rules = []
+        for replace_map in replace_maps or []:
+            for key in replace_map:
+                self.rules.append((str(key), str(replace_map[key])))
+        # Text can be processed in large blocks rather than line by line, unless a rule could
+        # match across the end of a line (or is empty, and so matches at every position)
+        self.by_line = any("\n" in key or not key for key, value in self.rules)
+        self.passes = []
+        group = []
+        for rule in self.rules:
+            if group and not all(self.independent(earlier, rule) for earlier in group):
+                self.passes.append(self.compile(group))
+                group = []
+            group.append(rule)
+        if group:
+            self.passes.append(self.compile(group))
+        logging.debug("Compiled %d compare_replace rules into %d passes", len(self.rules), len(self.passes))
+
+    @staticmethod
+    def overlaps(first, second):
+        # True if the two strings could overlap each other in a piece of text
+        if not first or not second:
+            return True
+        if second[0] not in first and first[0] not in second:
+            # Neither can start inside the other, which rules out every kind of overlap
+            return False
+        if first in second or second in first:
+            return True
+        for length in range(1, min(len(first), len(second))):
+            if first.endswith(second[:length]) or second.endswith(first[:length]):
+                return True
+        return False
+
+    def independent(self, earlier, later):
+        # True if the later rule can be applied in the same pass as the earlier one. Its string must
+        # not overlap the earlier rule's string, or the text put in by the earlier rule (an empty
+        # replacement counts as overlapping, as it joins up the text either side of it).
+        return not self.overlaps(earlier[0], later[0]) and not self.overlaps(earlier[1], later[0])
+
+    @classmethod
+    def compile(cls, group):
+        # Return a function that applies a group of independent rules in one pass
+        if len(group) == 1:
+            key, value = group[0]
+            return lambda text: text.replace(key, value)
+        table = dict(group)
+        pattern = re.compile(cls.trie_pattern([key for key, value in group]))
+        replace = lambda match: table[match.group(0)]
+        return lambda text: pattern.sub(replace, text)
+
+    @classmethod
+    def trie_pattern(cls, keys):
+        # Build a regular expression matching any of the keys, shaped like a tree of their shared
+        # prefixes. This lets the regex engine rule out most keys after a character or two, where a
+        # plain "key1|key2|..." would try every key at every position in the text.
+        trie = {}
+        for key in keys:
+            node = trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[""] = True
+        return cls.trie_node_pattern(trie)
+
+    @classmethod
+    def trie_node_pattern(cls, node):
+        branches = []
+        end_chars = []
+        for char in sorted(child for child in node if child):
+            if list(node[char]) == [""]:
+                # A key ends with this character, and no other key continues past it
+                end_chars.append(re.escape(char))
+            else:
+                branches.append(re.escape(char) + cls.trie_node_pattern(node[char]))
+        if len(end_chars) == 1:
+            branches.append(end_chars[0])
+        elif end_chars:
+            branches.append("[" + "".join(end_chars) + "]")
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            # A key also ends here, so the rest is optional (keys in one pass never do this, as
+            # one would be inside the other - but it keeps the pattern correct regardless)
+            pattern = "(?:" + pattern + ")?"
+        return pattern
+
+    def apply(self, text):
+        for replace_pass in self.passes:
+            text = replace_pass(text)
+        return text
+
+    def apply_file(self, in_file, out_file):
+        # Stream text from one file to another, applying the rules
+        if not self.passes:
+            shutil.copyfileobj(in_file, out_file)
+        elif self.by_line:
+            for line in in_file:
+                out_file.write(self.apply(line))
+        else:
+            while True:
+                lines = in_file.readlines(1 << 20)
+                if not lines:
+                    break
+                out_file.write(self.apply("".join(lines)))
+
+
+# Patterns used by the built-in LaTeX filters, to fix Pandoc's LaTeX source for latexdiff
+hypertarget_pattern = re.compile("(\\\\hypertarget{.*?}\\s?{%?}?)")
+label_end_pattern = re.compile("\\\\label{.*?(}\\s?})")
+
+
+def filter_strip_hypertarget(lines):
+    for line in lines:
+        match = hypertarget_pattern.search(line)
+        if match:
+            # Completely remove the '\hypertarget' line
+            line = line.replace(match.group(1), "")
+        yield line
+
+
+def filter_fix_label_end(lines):
+    for line in lines:
+        match = label_end_pattern.search(line)
+        if match:
+            # Fix up the extra bracket on the line end
+            line = line.replace(match.group(1), "}")
+        yield line
+
+
+class LatexFilterPipeline:
+    """A chain of line filters, run over the LaTeX that Pandoc produces in compare mode.
+
+    Each filter is a generator that takes an iterable of lines and yields lines, so a file is
+    streamed through all of them in a single pass. They are listed under "latex_filters" in the
+    config, either by the name of a built-in filter or as a {pattern, replace} regex substitution."""
+    BUILT_IN = {
+        "strip_hypertarget": filter_strip_hypertarget,
+        "fix_label_end": filter_fix_label_end,
+    }
+
+    def __init__(self, filter_conf):
+        self.filters = [self.make_filter(item) for item in filter_conf or []]
+
+    @classmethod
+    def make_filter(cls, item):
+        if isinstance(item, str):
+            if item not in cls.BUILT_IN:
+                raise ValueError("Unknown LaTeX filter '{}'".format(item))
+            return cls.BUILT_IN[item]
+        # Compile the pattern once, when the config is read
+        pattern = re.compile(item["pattern"])
+        replace = item.get("replace", "")
+        def filter_regex(lines):
+            for line in lines:
+                yield pattern.sub(replace, line)
+        return filter_regex
+
+    def run(self, lines):
+        for line_filter in self.filters:
+            lines = line_filter(lines)
+        return lines
+
+    def apply_file(self, input_latex):
+        # Stream the file through the filters into a new file, then swap it in
+        if not self.filters:
+            return
+        output_latex = input_latex + ".tmp"
+        with open(input_latex, 'rt', encoding="utf-8") as in_file:
+            with open(output_latex, 'wt', encoding="utf-8") as out_file:
+                out_file.writelines(self.run(in_file))
+        os.replace(output_latex, input_latex)
+        logging.debug("Wrote out file: %s", input_latex)
+
+
+def latex_aux_state(build_path, job_name):
+    # Return the checksums of the aux files xelatex has written, to tell whether a pass changed them
+    state = {}
+    for extension in latex_aux_extensions:
+        aux_file = os.path.join(build_path, job_name + extension)
+        if os.path.isfile(aux_file):
+            state[extension] = hash_file(aux_file)
+    return state
+
+
+class RenderError(Exception):
+    """Raised when a stage of rendering fails, so that the rest of the job is skipped"""
+    pass
+
+
+class RenderTimeout(RenderError):
+    """Raised when a stage of rendering runs out of time, and its commands have been stopped"""
+    pass
+
+
+class ProcessLimits:
+    """Limits on the resources used by each command run inside the chroot: rlimits, which are set
+    by the shell that starts the command, and optionally a cgroup that all of the commands are put in"""
+    def __init__(self, cpu_seconds=0, memory_mb=0, cgroup=None):
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.cgroup = cgroup
+
+    def ulimit_command(self):
+        # Return the shell commands to set the rlimits, to go in front of the command to limit.
+        # The hard CPU limit is a little higher, so the command gets SIGXCPU rather than SIGKILL
+        # and can be told apart from one that was killed for another reason.
+        commands = []
+        if self.cpu_seconds:
+            commands += ["ulimit -H -t {}".format(self.cpu_seconds + 5), "ulimit -S -t {}".format(self.cpu_seconds)]
+        if self.memory_mb:
+            commands.append("ulimit -v {}".format(self.memory_mb * 1024))
+        return "".join(command + "; " for command in commands)
+
+    def wrap(self, argv):
+        # Have a shell on the host move itself into the cgroup before it starts a command,
+        # so that the command and everything it starts are in the cgroup from the beginning
+        if not self.cgroup:
+            return list(argv)
+        return ["/bin/sh", "-c", 'echo $$ >"$0" && exec "$@"', os.path.join(self.cgroup, "cgroup.procs")] + list(argv)
+
+    def cpu_exceeded(self, exit_code):
+        # Whether a command was stopped for using up its CPU time, from its exit code (as given
+        # by Popen for a signal, or by a shell)
+        return bool(self.cpu_seconds) and exit_code in (-signal.SIGXCPU, 128 + signal.SIGXCPU)
+
+
+def chroot_relative(path):
+    # Return the path of a file inside the chroot, as seen by processes running in it
+    return os.path.join("/", os.path.relpath(path, chroot_path))
+
+
+def chroot_command(workdir, argv):
+    # Build the argument vector to run a command inside the chroot, from the given folder
+    # (as seen inside the chroot). chroot always starts in '/', so a fixed shell snippet sets the
+    # limits and changes folder first - the folder and command are passed as arguments, and never
+    # parsed by the shell.
+    return process_limits.wrap(["chroot", chroot_path, "/bin/sh", "-c",
+                                process_limits.ulimit_command() + 'cd "$0" && exec "$@"', workdir] + list(argv))
+
+
+def wait_for_process(process, timeout=None):
+    # Wait for a process like Popen.wait(), but with wait4() so the resource use of the process
+    # is known, including everything it started and waited for (i.e. the xelatex runs started by
+    # Pandoc). If it takes longer than the timeout, a timer kills its process group (so it must
+    # have been started in a session of its own). Returns the exit code, the resource use, and
+    # whether it ran out of time.
+    lock = threading.Lock()
+    state = {"done": False, "timed_out": False}
+    def expire():
+        with lock:
+            if state["done"]:
+                return
+            state["timed_out"] = True
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        pid, status, rusage = os.wait4(process.pid, 0)
+    finally:
+        # Once the process has been reaped its ID can be reused, so the timer mustn't fire after this
+        with lock:
+            state["done"] = True
+        if timer is not None:
+            timer.cancel()
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, rusage, state["timed_out"]
+
+
+def record_usage(usage, rusage):
+    # Add the CPU time and peak memory from wait4() to a command's record, if it has one
+    if usage is not None:
+        usage.update(user_seconds=round(rusage.ru_utime, 3), system_seconds=round(rusage.ru_stime, 3),
+                     max_rss_kb=rusage.ru_maxrss)
+
+
+def usage_totals(records):
+    # Add up the CPU time of some commands (or stages), and take the highest of their peak memory
+    totals = {}
+    for name in ("user_seconds", "system_seconds"):
+        values = [record[name] for record in records if record.get(name) is not None]
+        totals[name] = round(sum(values), 3) if values else None
+    peaks = [record["max_rss_kb"] for record in records if record.get("max_rss_kb") is not None]
+    totals["max_rss_kb"] = max(peaks) if peaks else None
+    return totals
+
+
+def describe_stages(stages):
+    # Sum up a job's timeline in one line for the log, i.e. "queued 0.2 s, pandoc 61.0 s (CPU 58.3 s, 912 MB)"
+    parts = []
+    for stage in stages:
+        text = "{} {:.1f} s".format(stage["stage"], stage["seconds"])
+        if stage["user_seconds"] is not None:
+            text += " (CPU {:.1f} s".format(stage["user_seconds"] + stage["system_seconds"])
+            if stage["max_rss_kb"] is not None:
+                text += ", {:.0f} MB".format(stage["max_rss_kb"] / 1024)
+            text += ")"
+        parts.append(text)
+    return ", ".join(parts)
+
+
+def kill_process_group(process):
+    # Kill a process started in a session of its own, along with everything it has started
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def append_to_log(log_file, file_name):
+    # Add the contents of another log file to a job's log. This goes through the job's own log file,
+    # which is flushed straight away, so it ends up between the output of the commands around it.
+    with open(file_name, 'rt', encoding="utf-8", errors="replace") as other_log_file:
+        log_file.flush()
+        log_file.write(other_log_file.read())
+        log_file.flush()
+
+
+def run_in_chroot(workdir, argv, log_file, stdout=None, timeout=None, usage=None):
+    # Run a command inside the chroot and wait for it to finish, returning its exit code.
+    # Output goes to the log file, unless a separate file for stdout is given. If it takes longer
+    # than the timeout, it is killed and subprocess.TimeoutExpired is raised. The CPU time and
+    # peak memory of the command are added to the usage dict, if one is given.
+    logging.debug("Will execute command in '%s': %s", workdir, argv)
+    if warm_pool is not None:
+        return warm_pool.run(workdir, argv, log_file, stdout, timeout, usage)
+    # The command gets its own process group, so anything it starts (i.e. the xelatex runs started
+    # by Pandoc) can be killed with it
+    p = subprocess.Popen(chroot_command(workdir, argv), stdout=stdout or log_file, stderr=log_file,
+                         env=chroot_env, start_new_session=True)
+    result, rusage, timed_out = wait_for_process(p, timeout)
+    record_usage(usage, rusage)
+    if timed_out:
+        raise subprocess.TimeoutExpired(p.args, timeout)
+    return result
+
+
+class WarmShell:
+    """A long-lived shell inside the chroot, which runs commands sent to it over a pipe"""
+    def __init__(self):
+        self.marker = "md2pdf-done-" + ''.join(random.sample(string.hexdigits, 16))
+        # The shell gets its own process group, so a command that runs out of time can be killed
+        # along with everything it started. This kills the shell too, and the pool starts a new one.
+        self.process = subprocess.Popen(process_limits.wrap(["chroot", chroot_path, "/bin/sh"]), stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, env=chroot_env, start_new_session=True)
+        self.killed = False
+        # CPU time used so far by the shell's commands, as (user, system) seconds
+        self.children_times = (0.0, 0.0)
+
+    def is_alive(self):
+        return not self.killed and self.process.poll() is None
+
+    def run(self, workdir, argv, log_path, stdout_path, timeout=None, usage=None):
+        # Run one command in a subshell, so the folder change and limits do not persist. Every argument
+        # is quoted, output goes to files so the only thing on the pipe is the shell's CPU times and the
+        # end marker, and stdin is closed so the command cannot read the next command (the chroot has
+        # no /dev/null).
+        command = "({}cd {} && exec {}) >>{} 2>>{} <&-; md2pdf_status=$?; times; echo \"{} $md2pdf_status\"\n".format(
+            process_limits.ulimit_command(), shlex.quote(workdir), " ".join(shlex.quote(arg) for arg in argv),
+            shlex.quote(stdout_path or log_path), shlex.quote(log_path), self.marker)
+        self.process.stdin.write(command.encode("utf-8"))
+        self.process.stdin.flush()
+        # Killing the shell ends its output, which stops the loop below
+        timer = threading.Timer(timeout, self.kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            times_line = ""
+            while True:
+                line = self.process.stdout.readline().decode("utf-8", "replace")
+                if not line:
+                    if self.killed:
+                        raise subprocess.TimeoutExpired(argv, timeout)
+                    raise RenderError("Warm worker exited unexpectedly")
+                if line.startswith(self.marker):
+                    self.record_times(times_line, usage)
+                    return int(line.split()[-1])
+                times_line = line
+        finally:
+            if timer:
+                timer.cancel()
+
+    def record_times(self, times_line, usage):
+        # The shell's "times" ends with the total CPU time of its commands (i.e. "0m1.250s 0m0.310s"),
+        # so the command's share is the change since the last one. The peak memory is not known.
+        times = re.findall(r"(\d+)m([\d.]+)s", times_line)
+        if len(times) != 2:
+            return
+        children_times = tuple(int(minutes) * 60 + float(seconds) for minutes, seconds in times)
+        if usage is not None:
+            usage.update(user_seconds=round(children_times[0] - self.children_times[0], 3),
+                         system_seconds=round(children_times[1] - self.children_times[1], 3), max_rss_kb=None)
+        self.children_times = children_times
+
+    def kill(self):
+        self.killed = True
+        kill_process_group(self.process)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+
+class WarmShellPool:
+    """Pool of WarmShells, so jobs do not pay for starting chroot and a shell for every command"""
+    def __init__(self, size):
+        self.size = size
+        self.shells = queue.Queue()
+        # Time saved for each command, compared to starting a new chroot, in seconds
+        self.saving = 0.0
+
+    def start(self):
+        for index in range(self.size):
+            self.shells.put(WarmShell())
+        # Load the toolchain into the page cache, then measure how much time is saved per command
+        # by comparing a new chroot against a warm shell, both running a command that does nothing
+        log_name = os.path.join(def_tempdir, "warm-up.log")
+        with open(log_name, 'w') as log_file:
+            for tool in ("pandoc", "xelatex", "latexdiff"):
+                self.run("/", [tool, "--version"], log_file, None)
+            cold_time = time.monotonic()
+            for attempt in range(5):
+                subprocess.Popen(chroot_command("/", ["true"]), stdout=log_file, stderr=log_file,
+                                 env=chroot_env).wait()
+            cold_time = time.monotonic() - cold_time
+            warm_time = time.monotonic()
+            for attempt in range(5):
+                self.run("/", ["true"], log_file, None)
+            warm_time = time.monotonic() - warm_time
+        os.remove(log_name)
+        self.saving = max(0.0, (cold_time - warm_time) / 5)
+        logging.info("Started %d warm workers, saving about %d ms per command", self.size, self.saving * 1000)
+
+    def run(self, workdir, argv, log_file, stdout, timeout=None, usage=None):
+        # Run a command on the next free shell, with paths as seen inside the chroot
+        log_path = chroot_relative(log_file.name)
+        stdout_path = chroot_relative(stdout.name) if stdout is not None else None
+        shell = self.shells.get()
+        try:
+            return shell.run(workdir, argv, log_path, stdout_path, timeout, usage)
+        finally:
+            if not shell.is_alive():
+                if not shell.killed:
+                    logging.warning("Warm worker has exited, starting a new one")
+                shell.close()
+                shell = WarmShell()
+            self.shells.put(shell)
+
+
+class RenderProfile:
+    """A named set of render options, which a client picks with the 'x-render-profile' header
+    (i.e. a quick draft for previews while editing, and the full render for the final PDF)"""
+    OUTPUTS = {"pdf": ".pdf", "html": ".html"}
+
+    def __init__(self, name, crossref=True, draft_graphics=False, max_passes=0, output="pdf", pandoc_args=()):
+        if output not in self.OUTPUTS:
+            raise ValueError("profile '{}' has an unknown output '{}', use one of: {}".format(
+                name, output, ", ".join(sorted(self.OUTPUTS))))
+        if isinstance(pandoc_args, str):
+            raise ValueError("profile '{}' needs 'pandoc_args' to be a list".format(name))
+        self.name = name
+        # Run the pandoc-crossref filter, for numbered references to figures, tables and sections
+        self.crossref = bool(crossref)
+        # Pass the "draft" class option, so graphicx draws boxes instead of loading the images
+        self.draft_graphics = bool(draft_graphics)
+        # Run xelatex at most this many times (0 leaves it to Pandoc), even if references are unsettled
+        self.max_passes = max(0, int(max_passes))
+        self.output = output
+        self.extension = self.OUTPUTS[output]
+        self.pandoc_args = [str(arg) for arg in pandoc_args]
+
+    def settings(self):
+        # Everything about the profile which changes the output, but not its name
+        return repr((self.crossref, self.draft_graphics, self.max_passes, self.output, self.pandoc_args))
+
+    def is_default(self):
+        return self.settings() == RenderProfile(default_render_profile).settings()
+
+    def uses_formats(self):
+        # A precompiled format only holds the part of the template's preamble that doesn't depend on
+        # the document or the options, so it suits any PDF
+        return self.output == "pdf"
+
+    def job_hash(self, upload_hash):
+        # An upload rendered with any other settings is a separate job, with its own folder and
+        # result, so a draft and the final PDF of the same file never get mixed up
+        if self.is_default():
+            return upload_hash
+        key_hash = hashlib.new('sha256')
+        key_hash.update("\n".join([upload_hash, self.settings()]).encode("utf-8"))
+        return key_hash.hexdigest()
+
+
+class GraphicsConverter:
+    """Converts the figures in an upload into a form xelatex can use as it is: EPS and SVG into PDF,
+    and large PNG and JPEG images scaled down. Otherwise, xelatex converts each EPS figure on every
+    pass and Pandoc converts each SVG figure, for every upload that uses them."""
+    KINDS = {".eps": "eps", ".ps": "eps", ".svg": "svg", ".png": "raster", ".jpg": "raster", ".jpeg": "raster"}
+
+    def __init__(self, convert=("eps", "svg"), max_pixels=0, min_kb=256):
+        if isinstance(convert, str):
+            convert = [convert]
+        unknown = set(convert) - {"eps", "svg"}
+        if unknown:
+            raise ValueError("unknown kind of figure to convert '{}', use: eps, svg".format(", ".join(sorted(unknown))))
+        self.convert = set(convert)
+        # Images are scaled down to fit in a square of this many pixels, if they are larger than min_kb
+        self.max_pixels = max(0, int(max_pixels))
+        self.min_size = max(0, int(min_kb)) * 1024
+        self.lock = threading.Lock()
+        # Maps the cache key of each figure being converted to an Event, set once it is done
+        self.converting = {}
+
+    def settings(self):
+        # Everything about the conversions which changes the output
+        return repr((sorted(self.convert), self.max_pixels, self.min_size))
+
+    def kind(self, path, vector=True):
+        # Return the kind of conversion a figure needs, or None. The vector figures are only converted
+        # when the output is a PDF.
+        kind = self.KINDS.get(os.path.splitext(path)[1].lower())
+        if kind == "raster":
+            return kind if self.max_pixels and os.path.getsize(path) > self.min_size else None
+        return kind if vector and kind in self.convert else None
+
+    @staticmethod
+    def output_name(kind, relative_path):
+        # Where a converted figure goes, relative to the job folder. The PDFs are put in a folder of
+        # their own, so they can't be taken for the job's output.
+        if kind == "raster":
+            return relative_path
+        return os.path.join(graphics_dir, os.path.splitext(relative_path)[0] + ".pdf")
+
+    def command(self, kind, input_name, output_name):
+        if kind == "eps":
+            return ["epstopdf", "--outfile=" + output_name, input_name]
+        if kind == "svg":
+            return ["rsvg-convert", "-f", "pdf", "-o", output_name, input_name]
+        return ["convert", input_name, "-resize", "{0}x{0}>".format(self.max_pixels), output_name]
+
+    def claim(self, graphic_key):
+        # Start converting a figure, unless another job is converting the same one. Returns None if the
+        # caller now owns the conversion (and must release it), or an Event which is set once the other
+        # job is done.
+        with self.lock:
+            event = self.converting.get(graphic_key)
+            if event is None:
+                self.converting[graphic_key] = threading.Event()
+            return event
+
+    def release(self, graphic_key):
+        with self.lock:
+            self.converting.pop(graphic_key).set()
+
+    def cache_key(self, kind, input_path):
+        # Converted figures are cached by the content of the figure, and how it is converted
+        key_hash = hashlib.new('sha256')
+        key_parts = [hash_file(input_path), repr(self.command(kind, "", "")), toolchain_version]
+        key_hash.update("\n".join(key_parts).encode("utf-8"))
+        return key_hash.hexdigest()
+
+
+def pandoc_command(template, input_name, output_name, format_file=None, profile=None):
+    # Build the Pandoc command to convert a MD file into LaTeX, PDF or HTML, with the options of a
+    # render profile (or of the default profile)
+    argv = ["pandoc"]
+    if profile is None or profile.crossref:
+        argv += ["--filter", "pandoc-crossref"]
+    if profile is not None and profile.output == "html":
+        # The LaTeX templates don't apply, and the images are embedded in the page
+        argv += ["--standalone", "--self-contained"]
+    else:
+        argv += ["--pdf-engine=xelatex", "--template=" + static_index.template_path(template)]
+    argv += ["--resource-path=.:" + chroot_static_dir,
+             "-M", "figPrefix=Figure", "-M", "tblPrefix=Table", "-M", "secPrefix=Section",
+             "-M", "autoSectionLabels=true", "--highlight-style=tango"]
+    if profile is not None:
+        if profile.draft_graphics:
+            argv += ["-V", "classoption=draft"]
+        argv += profile.pandoc_args
+    if format_file:
+        # Have xelatex start from the template's precompiled preamble
+        argv.append("--pdf-engine-opt=-fmt=" + format_file)
+    return argv + [input_name, "-o", output_name]
+
+
+class FormatCache:
+    """Builds and keeps a precompiled LaTeX format file (.fmt) for each template that opts in,
+    so xelatex does not have to process the template's preamble on every pass. Only the start of
+    the preamble, up to a \\csname endofdump\\endcsname line, goes into the format. It must not
+    use any Pandoc variables, as xelatex skips that part of each document when it loads the
+    format, and runs the rest of the preamble as normal."""
+    def __init__(self, templates):
+        self.templates = templates
+        self.formats_path = os.path.join(chroot_path, "var", "cache", "md2pdf-formats")
+        self.lock = threading.Lock()
+        # Maps template name to (template file stat, format path inside the chroot)
+        self.formats = {}
+        # Templates whose preamble could not be dumped, mapped to the file stat that failed
+        self.failed = {}
+
+    def build_all(self):
+        # Clear out any builds left from earlier runs
+        if os.path.isdir(self.formats_path):
+            for name in os.listdir(self.formats_path):
+                if name.startswith("build-"):
+                    shutil.rmtree(os.path.join(self.formats_path, name), ignore_errors=True)
+        for template in self.templates:
+            self.get(template)
+
+    def get(self, template):
+        # Return the path of the format file for a template (inside the chroot), or None if the
+        # template has not opted in or cannot be precompiled. Rebuilds it if the template has changed.
+        if template not in self.templates:
+            return None
+        template_file = static_index.file_for(template)
+        if not template_file:
+            return None
+        template_stat = os.stat(template_file)
+        template_stat = (template_stat.st_mtime, template_stat.st_size)
+        with self.lock:
+            cached = self.formats.get(template)
+            if cached and cached[0] == template_stat:
+                return cached[1]
+            if self.failed.get(template) == template_stat:
+                return None
+            format_file = self.build(template, template_file)
+            if format_file:
+                self.formats[template] = (template_stat, format_file)
+                self.failed.pop(template, None)
+            else:
+                self.failed[template] = template_stat
+            return format_file
+
+    def build(self, template, template_file):
+        # Check that the template marks where the part that doesn't depend on the document ends
+        with open(template_file, 'rt', encoding="utf-8", errors="replace") as template_text:
+            found = end_of_dump_pattern.search(template_text.read())
+        if not found:
+            logging.warning("Template '%s' has no \\csname endofdump\\endcsname line, so it can't be precompiled",
+                            template)
+            return None
+        if "$" in found.string[:found.start()].replace("$$", ""):
+            logging.warning("Template '%s' uses Pandoc variables before endofdump, so it can't be precompiled",
+                            template)
+            return None
+
+        # The format name changes with the template contents and the TeX Live version
+        key_hash = hashlib.new('sha256')
+        key_hash.update((static_index.checksum(template) + "\n" + toolchain_version).encode("utf-8"))
+        format_name = re.sub("[^A-Za-z0-9_-]", "_", os.path.splitext(os.path.basename(template))[0])
+        format_name += "-" + key_hash.hexdigest()[:16]
+        format_file = os.path.join(self.formats_path, format_name + ".fmt")
+        if os.path.isfile(format_file):
+            logging.info("Using existing LaTeX format for template '%s'", template)
+            return chroot_relative(os.path.join(self.formats_path, format_name))
+
+        logging.info("Building LaTeX format for template '%s'", template)
+        start_time = time.monotonic()
+        build_path = os.path.join(self.formats_path, "build-" + ''.join(random.sample(string.hexdigits, 16)))
+        os.makedirs(build_path)
+        try:
+            # Render a stub document with the template
+            with open(os.path.join(build_path, "stub.md"), 'wt', encoding="utf-8") as stub_file:
+                stub_file.write("Format stub\n")
+            chroot_dir = chroot_relative(build_path)
+            with open(os.path.join(build_path, "build.log"), 'wt', encoding="utf-8") as log_file:
+                result = run_in_chroot(chroot_dir, pandoc_command(template, "stub.md", "stub.tex"), log_file)
+                if result == 0:
+                    # Dump everything up to \endofdump into a format file
+                    result = run_in_chroot(chroot_dir, ["xelatex", "-ini", "-interaction=batchmode",
+                                                        "-jobname=" + format_name, "&xelatex", "mylatexformat.ltx",
+                                                        "stub.tex"], log_file)
+            built_file = os.path.join(build_path, format_name + ".fmt")
+            if result != 0 or not os.path.isfile(built_file):
+                logging.warning("Template '%s' could not be precompiled, see '%s'", template,
+                                os.path.join(build_path, "build.log"))
+                return None
+            os.replace(built_file, format_file)
+        except Exception as e:
+            logging.error("Unable to build LaTeX format for template '%s': %s", template, e)
+            return None
+        shutil.rmtree(build_path, ignore_errors=True)
+        logging.info("Built LaTeX format for template '%s' in %.1f seconds", template, time.monotonic() - start_time)
+        return chroot_relative(os.path.join(self.formats_path, format_name))
+
+
+class PdfRenderJob:
+    # Whether the job looks up and stores the Pandoc output in the result cache
+    caches_latex = True
+
+    def __init__(self, input_md, template, compare_mode=False, compare_md="", hashsum="", render_key="", document_id="",
+                 profile=None):
+        # Store the passed objects
+        self.hashsum = hashsum
+        self.render_key = render_key
+        self.document_id = document_id
+        self.profile = profile or render_profiles[default_render_profile]
+        self.md_file = os.path.abspath(input_md)
+        self.latex_template = template
+        self.compare_mode = compare_mode
+        self.compare_md = os.path.abspath(compare_md) if compare_md else ""
+        self.commands_run = 0
+        self.timed_out = False
+        # Details of how the job was rendered, for its status
+        self.details = {}
+        # Timing of the job, for the metrics
+        self.created = time.monotonic()
+        self.stage = "queued"
+        self.stage_started = None
+        # Each stage, with its start and end times and the commands it ran, for /jobinfo
+        self.timeline = [{"stage": "queued", "start": time.time(), "commands": []}]
+
+    def set_stage(self, stage):
+        # Move the job on to the next stage, recording how long the last one took
+        self.finish_stage()
+        self.stage = stage
+        self.stage_started = time.monotonic()
+        self.timeline.append({"stage": stage, "start": time.time(), "commands": []})
+        job_registry.update(self.hashsum, stage)
+        self.write_info(stage)
+
+    def finish_stage(self):
+        if self.stage_started is not None:
+            metrics.observe_stage(self.stage, time.monotonic() - self.stage_started)
+            self.stage_started = None
+        self.timeline[-1].setdefault("end", time.time())
+
+    def count(self, name, amount=1, **labels):
+        # Add to a counter in /metrics
+        metrics.inc(name, amount, **labels)
+
+    def run_command(self, chroot_dir, argv, log_file, stdout=None):
+        # Run one step of the job inside the chroot, in the time left for the current stage
+        self.commands_run += 1
+        stage_timeout = stage_timeouts.get(self.stage)
+        timeout = max(0.1, self.stage_started + stage_timeout - time.monotonic()) if stage_timeout else None
+        command = {"command": argv[0], "start": time.time()}
+        self.timeline[-1]["commands"].append(command)
+        try:
+            result = run_in_chroot(chroot_dir, argv, log_file, stdout, timeout, command)
+        except subprocess.TimeoutExpired:
+            raise RenderTimeout("The {} stage took longer than {:g} seconds, and was stopped".format(
+                self.stage, stage_timeout))
+        finally:
+            command["end"] = time.time()
+            for mode in ("user", "system"):
+                if command.get(mode + "_seconds") is not None:
+                    self.count("md2pdf_cpu_seconds_total", command[mode + "_seconds"], stage=self.stage, mode=mode)
+        command["exit"] = result
+        if process_limits.cpu_exceeded(result):
+            raise RenderTimeout("The {} stage used more than {} seconds of CPU time, and was stopped".format(
+                self.stage, process_limits.cpu_seconds))
+        return result
+
+    def pandoc_command(self, input_name, output_name, format_file=None):
+        return pandoc_command(self.latex_template, input_name, output_name, format_file, self.profile)
+
+    def run(self):
+        # All paths are absolute, or relative to the job folder and only used inside the chroot,
+        # so that several jobs can safely run at the same time
+        dirname = os.path.dirname(self.md_file)
+        chroot_dir = chroot_relative(dirname)
+        md_name = os.path.basename(self.md_file)
+
+        # Open a log file for the subprocess calls. It is emptied, then opened for appending, as the
+        # commands write to it through the same file, and anything added between them must not be
+        # overwritten by the next one.
+        log_name = os.path.join(dirname, os.path.splitext(md_name)[0] + ".log")
+        logging.debug("Writing log file to '%s'", log_name)
+        error = None
+        open(log_name, 'wt').close()
+        with open(log_name, 'at', encoding="utf-8") as log_file:
+            try:
+                if graphics_converter is not None:
+                    self.prepare_graphics(dirname, chroot_dir, log_file)
+                if self.compare_mode:
+                    self.render_compare(dirname, chroot_dir, log_file)
+                elif self.profile.output == "pdf" and ((self.document_id and max_latex_passes) or self.profile.max_passes):
+                    self.render_incremental(dirname, chroot_dir, md_name, log_file)
+                else:
+                    self.render_pandoc(chroot_dir, md_name, log_file)
+            except RenderError as e:
+                logging.warning("Render of '%s' failed: %s", self.md_file, e)
+                error = str(e)
+                self.timed_out = isinstance(e, RenderTimeout)
+        self.finish_stage()
+
+        if self.timed_out:
+            # Add the reason to the end of the log, which is what fetch returns, and remove any
+            # output that was only partly written
+            with open(log_name, 'at', encoding="utf-8") as log_file:
+                log_file.write("\nmd2pdf: {}\n".format(error))
+            for file in os.listdir(dirname):
+                if file.endswith(self.profile.extension):
+                    os.remove(os.path.join(dirname, file))
+
+        # Find the PDF (or the HTML page), if one was produced
+        pdf_name = None
+        for file in os.listdir(dirname):
+            if file.endswith(self.profile.extension):
+                pdf_name = file
+                break
+        self.finish(dirname, pdf_name, log_name, error)
+
+    def finish(self, dirname, pdf_name, log_name, error):
+        # Record the result of the job, and store its output
+        if pdf_name:
+            metrics.inc("md2pdf_jobs_total", result="done")
+            metrics.inc("md2pdf_pdf_rendered_bytes_total", os.path.getsize(os.path.join(dirname, pdf_name)))
+            # Keep a copy of the PDF in the result cache
+            if result_cache is not None and self.render_key:
+                result_cache.store(self.render_key, self.hashsum, os.path.join(dirname, pdf_name))
+            details = dict(self.details)
+            if warm_pool is not None:
+                details["warm_saved_ms"] = int(self.commands_run * warm_pool.saving * 1000)
+                logging.info("Warm workers saved about %d ms for '%s'", details["warm_saved_ms"], pdf_name)
+            job_registry.update(self.hashsum, "done", pdf=pdf_name, **details)
+            state = "done"
+        else:
+            state = "timed_out" if self.timed_out else "failed"
+            metrics.inc("md2pdf_failures_total", stage=self.stage)
+            metrics.inc("md2pdf_jobs_total", result=state)
+            job_registry.update(self.hashsum, state, error=error or "No PDF was produced, fetch the log for details",
+                                log=os.path.basename(log_name))
+        info = self.write_info(state)
+        if slow_job_seconds and info["seconds"] >= slow_job_seconds:
+            metrics.inc("md2pdf_slow_jobs_total")
+            logging.warning("Job %s for '%s' took %.1f seconds: %s", self.hashsum, os.path.basename(self.md_file),
+                            info["seconds"], describe_stages(info["stages"]))
+        job_storage.store(self.hashsum, dirname, job_registry.get(self.hashsum))
+
+        # Have the folder removed once clients have had time to fetch the PDF
+        janitor.schedule(dirname)
+
+    def job_info(self, state):
+        # The job's timeline, with the CPU time and peak memory of each stage and of each command
+        now = time.time()
+        stages = []
+        for entry in self.timeline:
+            commands = [dict(command, seconds=round(command.get("end", now) - command["start"], 3))
+                        for command in entry["commands"]]
+            stage = dict(entry, seconds=round(entry.get("end", now) - entry["start"], 3), commands=commands)
+            stage.update(usage_totals(commands))
+            stages.append(stage)
+        info = {"hash": self.hashsum, "state": state, "template": self.latex_template, "compare": self.compare_mode,
+                "profile": self.profile.name, "created": self.timeline[0]["start"], "updated": now,
+                "seconds": round(now - self.timeline[0]["start"], 3), "stages": stages}
+        info.update(usage_totals(stages))
+        return info
+
+    def write_info(self, state):
+        # Write the job's timeline into its folder, replacing the last one, and return it
+        info = self.job_info(state)
+        info_path = os.path.join(os.path.dirname(self.md_file), job_info_name)
+        try:
+            with open(info_path + ".tmp", 'wt', encoding="utf-8") as info_file:
+                json.dump(info, info_file)
+            os.replace(info_path + ".tmp", info_path)
+        except OSError as e:
+            logging.error("Unable to write job information to '%s': %s", info_path, e)
+        return info
+
+    def prepare_graphics(self, dirname, chroot_dir, log_file):
+        # Convert the figures in the job folder, reusing the conversions of the same figures by earlier
+        # jobs, then point the Markdown files at the figures which were converted into PDF
+        self.set_stage("graphics")
+        counts = {"converted": 0, "cached": 0, "failed": 0}
+        # Maps the path of each figure converted into PDF to the path of the PDF, relative to the job folder
+        converted = {}
+        for folder, folders, files in os.walk(dirname):
+            if folder == dirname:
+                folders[:] = [name for name in folders if name not in (graphics_dir, latex_build_dir)]
+            for file in files:
+                input_path = os.path.join(folder, file)
+                kind = graphics_converter.kind(input_path, vector=self.profile.output == "pdf")
+                if kind is None:
+                    continue
+                relative_path = os.path.relpath(input_path, dirname)
+                output_name = graphics_converter.output_name(kind, relative_path)
+                result = self.convert_graphic(dirname, chroot_dir, log_file, kind, relative_path, output_name)
+                counts[result] += 1
+                if result != "failed" and output_name != relative_path:
+                    converted[relative_path] = output_name
+        if not any(counts.values()):
+            return
+        self.details["graphics"] = counts
+        logging.info("Prepared %d figures for '%s' (%d from the cache, %d failed)", sum(counts.values()),
+                     os.path.basename(self.md_file), counts["cached"], counts["failed"])
+        if not converted:
+            return
+
+        def replace_reference(match):
+            path = converted.get(os.path.normpath(match.group(2)))
+            return match.group(1) + path if path else match.group(0)
+        for file in os.listdir(dirname):
+            if file.endswith(".md"):
+                md_path = os.path.join(dirname, file)
+                with open(md_path, 'rt', encoding="utf-8", errors="surrogateescape") as md_file:
+                    text = md_file.read()
+                new_text = graphics_reference_pattern.sub(replace_reference, text)
+                if new_text != text:
+                    # Write a new file, as a batch document's file is linked to the upload
+                    with open(md_path + ".tmp", 'wt', encoding="utf-8", errors="surrogateescape") as md_file:
+                        md_file.write(new_text)
+                    os.replace(md_path + ".tmp", md_path)
+
+    def convert_graphic(self, dirname, chroot_dir, log_file, kind, relative_path, output_name):
+        # Convert one figure, or take it from the result cache, returning "converted", "cached" or
+        # "failed". A figure which can't be converted is left as it is, for Pandoc and xelatex to deal with.
+        input_path = os.path.join(dirname, relative_path)
+        output_path = os.path.join(dirname, output_name)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        graphic_key = graphics_converter.cache_key(kind, input_path)
+        while True:
+            if result_cache.lookup_graphic(graphic_key, output_path):
+                self.count("md2pdf_cache_requests_total", cache="graphics", result="hit")
+                return "cached"
+            converting = graphics_converter.claim(graphic_key)
+            if converting is None:
+                break
+            # Another job is converting the same figure, so wait for it to be cached (or for the job
+            # to fail, when this one tries instead)
+            converting.wait()
+        self.count("md2pdf_cache_requests_total", cache="graphics", result="miss")
+        tmp_name = os.path.join(graphics_dir, "converting-" + ''.join(random.sample(string.hexdigits, 8)) +
+                                os.path.splitext(output_name)[1])
+        tmp_path = os.path.join(dirname, tmp_name)
+        os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+        try:
+            result = self.run_command(chroot_dir, graphics_converter.command(kind, relative_path, tmp_name), log_file)
+            if result != 0 or not os.path.isfile(tmp_path):
+                logging.warning("Unable to convert '%s' for '%s', leaving it as it is", relative_path,
+                                os.path.basename(self.md_file))
+                return "failed"
+            if kind == "raster" and os.path.getsize(tmp_path) >= os.path.getsize(input_path):
+                # Scaling it down didn't make it any smaller, so the original is kept (and cached, so it
+                # isn't tried again)
+                shutil.copyfile(input_path, tmp_path)
+            result_cache.store_graphic(graphic_key, tmp_path)
+            os.replace(tmp_path, output_path)
+        finally:
+            graphics_converter.release(graphic_key)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        return "converted"
+
+    def render_pandoc(self, chroot_dir, md_name, log_file):
+        # Have Pandoc render the PDF, running xelatex as many times as it needs (or the HTML page)
+        self.set_stage("pandoc")
+        output_name = os.path.splitext(md_name)[0] + self.profile.extension
+        format_file = format_cache.get(self.latex_template) if self.profile.uses_formats() else None
+        if self.run_command(chroot_dir, self.pandoc_command(md_name, output_name, format_file), log_file) != 0:
+            raise RenderError("Pandoc failed, fetch the log for details")
+
+    def render_incremental(self, dirname, chroot_dir, md_name, log_file):
+        # Have Pandoc write LaTeX, then run xelatex on it here, starting from the aux files kept from
+        # the last render of the same document, so a revision usually only needs one pass. Jobs
+        # whose profile limits the passes are run this way too, without keeping the aux files.
+        job_name = os.path.splitext(md_name)[0]
+        keep_aux = bool(self.document_id and max_latex_passes)
+        max_passes = min(passes for passes in (self.profile.max_passes, max_latex_passes) if passes)
+        self.set_stage("pandoc")
+        if self.run_command(chroot_dir, self.pandoc_command(md_name, job_name + ".tex"), log_file) != 0:
+            raise RenderError("Pandoc failed, fetch the log for details")
+
+        self.set_stage("xelatex")
+        build_path = os.path.join(dirname, latex_build_dir)
+        shutil.rmtree(build_path, ignore_errors=True)
+        os.mkdir(build_path)
+        reused = False
+        if keep_aux:
+            aux_key = self.aux_key()
+            reused = result_cache.lookup_aux(aux_key, build_path, job_name)
+            self.count("md2pdf_cache_requests_total", cache="aux", result="hit" if reused else "miss")
+        passes = self.run_latex_passes(chroot_dir, build_path, job_name, log_file, max_passes)
+        if passes is None and reused:
+            # The kept files might not suit this revision, so start again without them
+            logging.info("xelatex failed on '%s' with the kept aux files, trying again without them", md_name)
+            shutil.rmtree(build_path, ignore_errors=True)
+            os.mkdir(build_path)
+            reused = False
+            passes = self.run_latex_passes(chroot_dir, build_path, job_name, log_file, max_passes)
+        if passes is None:
+            # Pandoc does more than write LaTeX when it renders a PDF (i.e. converting SVG images),
+            # so leave it to Pandoc
+            logging.warning("xelatex failed on the LaTeX for '%s', rendering it with Pandoc instead", md_name)
+            self.render_pandoc(chroot_dir, md_name, log_file)
+            return
+        os.replace(os.path.join(build_path, job_name + ".pdf"), os.path.join(dirname, job_name + ".pdf"))
+        if keep_aux:
+            result_cache.store_aux(aux_key, build_path, job_name)
+        logging.info("Rendered '%s' in %d xelatex passes (aux files %s)", md_name, passes,
+                     "reused" if reused else "not reused")
+        self.details.update(latex_passes=passes, aux_reused=reused)
+
+    def run_latex_passes(self, chroot_dir, build_path, job_name, log_file, max_passes):
+        # Run xelatex until its aux files stop changing and it doesn't ask to be rerun, or up to
+        # max_passes times, returning the number of passes, or None if it failed (with its log added
+        # to the job's log)
+        argv = ["xelatex", "-interaction=batchmode", "-halt-on-error", "-output-directory=" + latex_build_dir]
+        format_file = format_cache.get(self.latex_template) if self.profile.uses_formats() else None
+        if format_file:
+            argv.append("-fmt=" + format_file)
+        argv.append(job_name + ".tex")
+        latex_log_name = os.path.join(build_path, job_name + ".log")
+        aux_state = latex_aux_state(build_path, job_name)
+        for passes in range(1, max_passes + 1):
+            if self.run_command(chroot_dir, argv, log_file) != 0:
+                if os.path.isfile(latex_log_name):
+                    append_to_log(log_file, latex_log_name)
+                return None
+            last_state, aux_state = aux_state, latex_aux_state(build_path, job_name)
+            with open(latex_log_name, 'rt', encoding="utf-8", errors="replace") as latex_log_file:
+                rerun = latex_rerun_pattern.search(latex_log_file.read()) is not None
+            if aux_state == last_state and not rerun:
+                return passes
+        if max_passes == max_latex_passes:
+            logging.warning("LaTeX for '%s' had not settled after %d xelatex passes", job_name, max_passes)
+        else:
+            logging.info("Stopped LaTeX for '%s' after %d xelatex passes, as its profile asks", job_name, max_passes)
+        return max_passes
+
+    def aux_key(self):
+        # The aux files are kept for each document, and only reused with the same template and toolchain
+        key_hash = hashlib.new('sha256')
+        key_parts = [self.document_id, self.latex_template, static_index.checksum(self.latex_template) or "",
+                     repr(self.pandoc_command("", "")), toolchain_version]
+        key_hash.update("\n".join(key_parts).encode("utf-8"))
+        return key_hash.hexdigest()
+
+    def render_compare(self, dirname, chroot_dir, log_file):
+        # Set up all the filenames
+        name_new_md = os.path.basename(self.md_file)
+        name_old_md = os.path.basename(self.compare_md)
+        name_new_latex = os.path.splitext(name_new_md)[0] + ".latex"
+        name_old_latex = os.path.splitext(name_old_md)[0] + ".latex"
+        name_diff_latex = name_new_latex.replace(".new","_changes")
+
+        # Run compare_replace
+        logging.info("Running compare_replace on input files")
+        for input_md in (name_new_md, name_old_md):
+            self.apply_compare_replace(os.path.join(dirname, input_md))
+
+        # Convert both MD files into LaTeX at the same time, with the "old" file on another thread.
+        # It gets its own log, added to the main log afterwards, so the two don't get mixed up.
+        self.set_stage("pandoc")
+        results = {}
+        errors = []
+        old_log_name = os.path.join(dirname, name_old_md + ".pandoc-log")
+        def convert_old():
+            try:
+                with open(old_log_name, 'wt', encoding="utf-8") as old_log_file:
+                    results[name_old_md] = self.convert_to_latex(dirname, chroot_dir, name_old_md, name_old_latex, old_log_file)
+            except RenderError as e:
+                errors.append(e)
+        thread = threading.Thread(target=convert_old)
+        thread.start()
+        try:
+            results[name_new_md] = self.convert_to_latex(dirname, chroot_dir, name_new_md, name_new_latex, log_file)
+        finally:
+            thread.join()
+            if os.path.isfile(old_log_name):
+                append_to_log(log_file, old_log_name)
+                os.remove(old_log_name)
+        if errors:
+            raise errors[0]
+        for input_md in (name_new_md, name_old_md):
+            if not results.get(input_md):
+                raise RenderError("Pandoc failed on '{}', fetch the log for details".format(input_md))
+
+        # Add the changes with latexdiff, writing its output to the diff file
+        self.set_stage("latexdiff")
+        with open(os.path.join(dirname, name_diff_latex), 'wb') as diff_file:
+            result = self.run_command(chroot_dir, ["latexdiff", "-t", "CULINECHBAR", name_old_latex, name_new_latex],
+                                   log_file, stdout=diff_file)
+        if result != 0:
+            raise RenderError("latexdiff failed, fetch the log for details")
+
+        # Finally, call xelatex to produce the PDF
+        self.set_stage("xelatex")
+        self.run_command(chroot_dir, ["xelatex", "-interaction=batchmode", name_diff_latex], log_file)
+
+    def convert_to_latex(self, dirname, chroot_dir, input_md, output_latex, log_file):
+        # Convert a MD file into LaTeX with Pandoc, reusing an earlier conversion of the
+        # same content and template if possible, then run the LaTeX filters over it.
+        # Returns True if it worked.
+        latex_key = None
+        if result_cache is not None and self.caches_latex:
+            key_hash = hashlib.new('sha256')
+            template_checksum = static_index.checksum(self.latex_template)
+            if template_checksum is None:
+                template_file = os.path.join(dirname, self.latex_template)
+                template_checksum = hash_file(template_file) if os.path.isfile(template_file) else self.latex_template
+            key_parts = [hash_file(os.path.join(dirname, input_md)), template_checksum,
+                         repr(self.pandoc_command("", "")), toolchain_version]
+            key_hash.update("\n".join(key_parts).encode("utf-8"))
+            latex_key = key_hash.hexdigest()
+            if result_cache.lookup_latex(latex_key, os.path.join(dirname, output_latex)):
+                self.count("md2pdf_cache_requests_total", cache="latex", result="hit")
+                logging.info("Using cached LaTeX for '%s'", input_md)
+                latex_filters.apply_file(os.path.join(dirname, output_latex))
+                return True
+            self.count("md2pdf_cache_requests_total", cache="latex", result="miss")
+
+        if self.run_command(chroot_dir, self.pandoc_command(input_md, output_latex), log_file) != 0:
+            return False
+        if latex_key is not None:
+            result_cache.store_latex(latex_key, os.path.join(dirname, output_latex))
+        logging.info("Running LaTeX filters on '%s'", output_latex)
+        latex_filters.apply_file(os.path.join(dirname, output_latex))
+        return True
+
+    def apply_compare_replace(self, input_md):
+        # Stream the file through the compiled replacements into a new file, then swap it in
+        output_md = input_md + ".tmp"
+        with open(input_md, 'rt', encoding="utf-8") as in_file:
+            with open(output_md, 'wt', encoding="utf-8") as out_file:
+                compare_replacer.apply_file(in_file, out_file)
+        os.replace(output_md, input_md)
+
+
+class CanaryRenderJob(PdfRenderJob):
+    """Render job for a warm-up canary, which keeps its timings and result to itself
+    instead of reporting them to the registry, metrics and job storage"""
+    # The canary has to run Pandoc to warm it up, so it doesn't use (or fill) the LaTeX cache
+    caches_latex = False
+
+    def __init__(self, **job_args):
+        super().__init__(**job_args)
+        self.stage_timings = {}
+        self.pdf_name = None
+        self.error = None
+
+    def set_stage(self, stage):
+        self.finish_stage()
+        self.stage = stage
+        self.stage_started = time.monotonic()
+
+    def finish_stage(self):
+        if self.stage_started is not None:
+            self.stage_timings[self.stage] = round(time.monotonic() - self.stage_started, 3)
+            self.stage_started = None
+
+    def count(self, name, amount=1, **labels):
+        pass
+
+    def finish(self, dirname, pdf_name, log_name, error):
+        self.pdf_name = pdf_name
+        if not pdf_name:
+            self.error = error or "No PDF was produced"
+
+
+class WarmUp(threading.Thread):
+    """Renders a canary document through each template (and once in compare mode) at startup,
+    so the first real jobs do not pay for cold font, package and disk caches. The server
+    reports itself as ready once every canary has rendered."""
+    def __init__(self, templates, compare_mode, document):
+        # Initialise the threading.Thread parent, as a daemon so it won't block shutdown
+        super().__init__(name="warm-up", daemon=True)
+        # Store the passed objects
+        self.document = document
+        # List of (canary name, template, compare mode)
+        self.canaries = [(template, template, False) for template in templates]
+        if compare_mode and templates:
+            self.canaries.append((templates[0] + " (compare)", templates[0], True))
+        self.lock = threading.Lock()
+        # One of "warming", "ready" or "failed"
+        self.state = "warming"
+        # Maps each canary name to its timings, or its error
+        self.results = {}
+
+    def run(self):
+        start_time = time.monotonic()
+        logging.info("Warming up with %d canary renders", len(self.canaries))
+        for index, (name, template, compare_mode) in enumerate(self.canaries):
+            result = self.render_canary(os.path.join(def_tempdir, "warm-up-{}".format(index)), template, compare_mode)
+            with self.lock:
+                self.results[name] = result
+            if "error" in result:
+                logging.error("Warm-up canary '%s' failed: %s (the log is in '%s')", name, result["error"], result["folder"])
+            else:
+                metrics.observe("md2pdf_warmup_duration_seconds", result["seconds"], canary=name)
+                logging.info("Warm-up canary '%s' rendered in %.2f seconds (%s)", name, result["seconds"],
+                             ", ".join("{} {:.2f} s".format(stage, duration)
+                                       for stage, duration in result["stages"].items()))
+        with self.lock:
+            failed = [name for name, result in self.results.items() if "error" in result]
+            self.state = "failed" if failed else "ready"
+        if failed:
+            logging.critical("Warm-up failed for: %s - the server will not report itself as ready", ", ".join(failed))
+        else:
+            logging.info("Warm-up finished in %.2f seconds, the server is ready", time.monotonic() - start_time)
+
+    def render_canary(self, folder, template, compare_mode):
+        # Render the canary in its own folder, returning its timings or its error
+        start_time = time.monotonic()
+        os.makedirs(folder, exist_ok=True)
+        if compare_mode:
+            md_path = os.path.join(folder, "canary.new.md")
+            compare_md = os.path.join(folder, "canary.old.md")
+            with open(compare_md, 'wt', encoding="utf-8") as md_file:
+                md_file.write(self.document.replace("warm", "cold"))
+        else:
+            md_path = os.path.join(folder, "canary.md")
+            compare_md = ""
+        with open(md_path, 'wt', encoding="utf-8") as md_file:
+            md_file.write(self.document)
+        job = CanaryRenderJob(input_md=md_path, template=template, compare_mode=compare_mode, compare_md=compare_md)
+        try:
+            job.run()
+        except Exception as e:
+            job.error = str(e)
+        if job.error:
+            # Keep the folder, so the log can be checked
+            return {"error": job.error, "folder": folder}
+        janitor.schedule(folder, 0)
+        return {"seconds": round(time.monotonic() - start_time, 3), "stages": job.stage_timings}
+
+    def report(self):
+        with self.lock:
+            return {"state": self.state, "canaries": dict(self.results)}
+
+
+def readiness():
+    # Return whether the server is ready for jobs, and the details for the /ready endpoint
+    if warm_up is None:
+        return True, {"ready": True, "state": "ready", "canaries": {}}
+    report = warm_up.report()
+    ready = report["state"] == "ready"
+    return ready, dict(ready=ready, **report)
+
+
+class UploadSpool:
+    """File-like object that CherryPy writes an uploaded file into, hashing it on the way through.
+    Data is kept in memory until it grows past the spool size, then it is moved to disk."""
+    def __init__(self):
+        self.hash = hashlib.new('sha256')
+        self.size = 0
+        self.path = None
+        self.file = io.BytesIO()
+        # For the metrics, when the upload started to arrive and how long was spent hashing it
+        self.created = time.monotonic()
+        self.hash_time = 0.0
+
+    def write(self, data):
+        self.size += len(data)
+        if max_upload_size and self.size > max_upload_size:
+            self.close()
+            raise cherrypy.HTTPError(413, "Uploaded file is larger than the limit of {} bytes".format(max_upload_size))
+        hash_start = time.monotonic()
+        self.hash.update(data)
+        self.hash_time += time.monotonic() - hash_start
+        if self.path is None and self.size > upload_spool_size:
+            # Move everything received so far out of memory and into a temporary file
+            self.path = os.path.join(def_tempdir, ''.join(random.sample(string.hexdigits, 16)))
+            logging.debug("Spooling upload to file '%s'", self.path)
+            disk_file = open(self.path, 'w+b', buffering=upload_chunk_size)
+            disk_file.write(self.file.getvalue())
+            self.file = disk_file
+        self.file.write(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def save_as(self, path):
+        # Give the spooled file its final name, and return something ZipFile can open
+        if self.path is None:
+            self.file.seek(0)
+            return self.file
+        self.file.close()
+        os.replace(self.path, path)
+        self.path = None
+        return path
+
+    def close(self):
+        # Discard the upload, removing the temporary file if one was made
+        self.file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class UploadPart(cherrypy._cpreqbody.Part):
+    # Have CherryPy receive uploaded files straight into an UploadSpool
+    def make_file(self):
+        return UploadSpool()
+
+
+def read_upload_headers(headers):
+    # Return the template, compare mode, document ID and render profile given by the headers of an
+    # upload. Raises ValueError if the headers ask for something the server can't do.
+    ## Check if the client has set the 'template' header
+    try:
+        x_template = headers.get('x-latex-template')
+    except:
+        pass
+    if isinstance(x_template, str):
+        template = x_template
+    else:
+        template = def_template
+
+    ## Check if the client has set the 'compare' header
+    try:
+        x_compare = headers.get('x-latex-compare')
+    except:
+        pass
+    if isinstance(x_compare, str):
+        logging.info("Upload has requested 'compare mode'")
+        compare_mode = True
+    else:
+        compare_mode = False
+
+    ## Check if the client has identified the document, so that revisions of it can be rendered incrementally
+    document_id = headers.get('x-document-id') or ""
+
+    ## Check if the client has picked a render profile, i.e. a quick draft for previews
+    profile_name = (headers.get('x-render-profile') or default_render_profile).strip()
+    profile = render_profiles.get(profile_name)
+    if profile is None:
+        raise ValueError("Unknown render profile '{}', use one of: {}".format(
+            profile_name, ", ".join(sorted(render_profiles))))
+    if compare_mode and profile.output != "pdf":
+        raise ValueError("Compare mode needs a render profile with PDF output")
+    return template, compare_mode, document_id.strip(), profile
+
+
+def start_render(filename, spool, template, compare_mode, document_id="", profile=None):
+    # Queue an upload to be rendered, unless the same file has been rendered already, and return
+    # the message for the client. Raises queue.Full if there is no room in the render queue, or
+    # RenderConflict if the same file is being rendered with other options.
+
+    ## The SHA256 hash of the file was calculated as it arrived, and is used as a reference (along
+    ## with the render profile, unless it is the default)
+    profile = profile or render_profiles[default_render_profile]
+    hashsum = profile.job_hash(spool.hexdigest())
+    logging.debug("Hash for upload '%s' is %s", filename, hashsum)
+
+    ## Check if this file has already been rendered with the same options
+    with metrics.time_stage("static"):
+        static_index.refresh()
+    render_key = get_render_key(spool.hexdigest(), template, compare_mode, profile)
+    if result_cache is not None and result_cache.lookup(render_key):
+        metrics.inc("md2pdf_cache_requests_total", cache="result", result="hit")
+        logging.info("Found cached PDF for hash %s", hashsum)
+        result_cache.set_alias(hashsum, render_key)
+        job_registry.update(hashsum, "done", cached=True, render_key=render_key)
+        return "File has already been rendered, request the PDF using the hash value"
+
+    ## Only render a file once at a time. An upload of a file which is already being rendered with
+    ## the same options joins that render, but one with other options has to wait for it to finish.
+    current_key = single_flight.claim(hashsum, render_key)
+    if current_key == render_key:
+        logging.info("Hash %s is already being rendered, joining that job", hashsum)
+        return "File is already being processed, request the PDF using the hash value"
+    elif current_key is not None:
+        logging.warning("Hash %s is being rendered with other options, rejecting upload '%s'", hashsum, filename)
+        raise RenderConflict("This file is being rendered with other options, please retry when that render has "
+                             "finished (see /status/{})".format(hashsum))
+
+    # From here, this upload owns the render until it is handed to a worker
+    try:
+        if result_cache is not None:
+            metrics.inc("md2pdf_cache_requests_total", cache="result", result="miss")
+            # Stop fetch from serving an older render of this file while the new one is processed
+            result_cache.set_alias(hashsum, None)
+        return submit_render(filename, spool, hashsum, render_key, template, compare_mode, document_id, profile)
+    except BaseException:
+        single_flight.release(hashsum)
+        raise
+
+
+def submit_render(filename, spool, hashsum, render_key, template, compare_mode, document_id, profile):
+    # Extract an upload into its job folder, and queue a job to render it. The job folder is left
+    # from an earlier render if this file was uploaded recently, in which case it is reused.
+    upload_path = os.path.normpath(def_tempdir)
+    output_path = os.path.join(upload_path, hashsum)
+    try:
+        os.mkdir(output_path)
+        path_exists = False
+    except FileExistsError:
+        logging.info("Path already exists: %s", output_path)
+        path_exists = True
+
+    if path_exists:
+        job = job_registry.get(hashsum)
+        if job is not None and job["state"] == "done" and job.get("render_key") == render_key and \
+                LocalJobStorage.find_in(output_path):
+            janitor.extend(output_path)
+            single_flight.release(hashsum)
+            return "File has already been rendered, request the PDF using the hash value"
+
+    ## Refuse the upload before extracting it if there is no room in the render queue. Uploads which
+    ## have already been rendered, or are being rendered, are answered before this even when it is full.
+    if scheduler.is_full():
+        logging.warning("Render queue is full, rejecting upload '%s'", filename)
+        if not path_exists:
+            os.rmdir(output_path)
+        raise queue.Full
+
+    if path_exists:
+        janitor.cancel(output_path)
+        ## The file is the same, so only the output of the earlier render needs to be removed
+        job_registry.update(hashsum, "extracting", template=template, compare=compare_mode, profile=profile.name,
+                            render_key=render_key)
+        for file in os.listdir(output_path):
+            if file.endswith((".log", ".pdf", ".html")) or file == job_info_name:
+                os.remove(os.path.join(output_path, file))
+    else:
+        ## Extract the ZIP archive into a temporary folder
+        job_registry.update(hashsum, "extracting", template=template, compare=compare_mode, profile=profile.name,
+                            render_key=render_key)
+        try:
+            # Small uploads are extracted straight from memory
+            with metrics.time_stage("extracting"):
+                zip_source = spool.save_as(os.path.join(upload_path, (hashsum + ".zip")))
+                in_zip = zipfile.ZipFile(zip_source, 'r')
+                in_zip.extractall(output_path)
+        except Exception as e:
+            logging.error("Error in zip extraction: %s", e)
+
+        ## Delete any existing PDF, HTML, log and job information files
+        for file in os.listdir(output_path):
+            if file.endswith((".log", ".pdf", ".html")) or file == job_info_name:
+                del_path = os.path.join(output_path, file)
+                logging.info("Deleting file: %s", del_path)
+                os.remove(del_path)
+    report_string = "File is being processed into a PDF, request it using the hash value"
+
+    ## Look for a MarkDown file in the extracted directory, and spawn a subprocess to render it
+    md_path = False
+    md_path_compare = False
+    for file in os.listdir(output_path):
+        if file.endswith(".md"):
+            tmp_path = os.path.join(output_path, file)
+            logging.info("Found MD file: %s", tmp_path)
+            if compare_mode:
+                if tmp_path.find("old") > -1:
+                    # Store the name of the "old" MD file
+                    md_path_compare = tmp_path
+                elif tmp_path.find("new") > -1:
+                    # Store the name of the "new" MD file
+                    md_path = tmp_path
+            else:
+                # Stop at the first found MD file in normal mode
+                md_path = tmp_path
+                break
+    if md_path:
+        md_basename = os.path.basename(md_path)
+        logging.debug("Basename is '%s'", md_basename)
+        # Queue a PdfRenderJob with necessary options
+        if compare_mode:
+            job = PdfRenderJob(input_md=md_path, template=template, compare_mode=True, compare_md=md_path_compare,
+                               hashsum=hashsum, render_key=render_key, profile=profile)
+        else:
+            job = PdfRenderJob(input_md=md_path, template=template,
+                               hashsum=hashsum, render_key=render_key, document_id=document_id, profile=profile)
+        try:
+            job_registry.update(hashsum, "queued", template=template, compare=compare_mode, profile=profile.name,
+                                render_key=render_key)
+            position = scheduler.submit(job)
+            report_string += "\nQueue position: {}\nEstimated wait: {} seconds".format(position, scheduler.estimate_wait(position))
+        except queue.Full:
+            # Remove the job folder, so the same file can be submitted again later
+            logging.warning("Render queue is full, rejecting file with hash %s", hashsum)
+            shutil.rmtree(output_path, ignore_errors=True)
+            job_registry.remove(hashsum)
+            raise
+    else:
+        report_string = "MD file not found in submitted archive"
+        metrics.inc("md2pdf_failures_total", stage="extracting")
+        job_registry.update(hashsum, "failed", error=report_string)
+        single_flight.release(hashsum)
+
+    return report_string
+
+
+class BatchDocumentJob(PdfRenderJob):
+    """Renders one document of a batch, handing its output back to the batch when it is finished"""
+    def __init__(self, batch, entry, **job_args):
+        super().__init__(**job_args)
+        self.batch = batch
+        self.entry = entry
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.batch.document_finished(self)
+
+
+class BatchThread(threading.Thread):
+    """Renders each document listed in the manifest of a batch upload on the render workers,
+    then collects the PDFs and a manifest of the results into one ZIP file"""
+    def __init__(self, hashsum, batch_path, entries, archive_name):
+        # Initialise the threading.Thread parent, as a daemon so it won't block shutdown
+        super().__init__(name="batch-" + hashsum[:8], daemon=True)
+        # Store the passed objects
+        self.hashsum = hashsum
+        self.batch_path = batch_path
+        self.input_path = os.path.join(batch_path, "input")
+        self.results_path = os.path.join(batch_path, "results")
+        self.entries = entries
+        self.archive_name = archive_name
+        self.lock = threading.Lock()
+        self.finished = 0
+        # Set if the batch fails as a whole, after which its documents no longer update its state
+        self.error = None
+        # Only keep one document per render worker in the queue, so a large batch doesn't fill it
+        self.slots = threading.Semaphore(scheduler.worker_count)
+
+    def run(self):
+        try:
+            self.render_all()
+        except Exception as e:
+            # Fail the batch, rather than leaving it as "rendering" until it is forgotten
+            logging.exception("Batch %s failed", self.hashsum)
+            self.fail("Batch failed: {}".format(e))
+
+    def fail(self, report_string):
+        with self.lock:
+            self.error = report_string
+        try:
+            with open(os.path.join(self.batch_path, "batch.log"), 'wt', encoding="utf-8") as log_file:
+                log_file.write(report_string + "\n")
+        except OSError as e:
+            logging.error("Unable to write the log of batch %s: %s", self.hashsum, e)
+        shutil.rmtree(self.input_path, ignore_errors=True)
+        shutil.rmtree(self.results_path, ignore_errors=True)
+        metrics.inc("md2pdf_failures_total", stage="rendering")
+        job_registry.update(self.hashsum, "failed", error=report_string, log="batch.log")
+        try:
+            job_storage.store(self.hashsum, self.batch_path, job_registry.get(self.hashsum))
+        except Exception as e:
+            logging.error("Unable to store the result of batch %s: %s", self.hashsum, e)
+        janitor.schedule(self.batch_path)
+
+    def render_all(self):
+        os.makedirs(self.results_path, exist_ok=True)
+        # The static content only needs to be checked once for the whole batch
+        with metrics.time_stage("static"):
+            static_index.refresh()
+        job_registry.update(self.hashsum, "rendering", documents=len(self.entries), finished=0)
+        for entry in self.entries:
+            if entry["state"] == "failed":
+                self.count_finished()
+                continue
+            try:
+                job = self.prepare(entry)
+            except OSError as e:
+                logging.error("Unable to prepare '%s' from batch %s: %s", entry["md"], self.hashsum, e)
+                entry.update(state="failed", error="Unable to prepare the document")
+                self.count_finished()
+                continue
+            if job is None:
+                self.count_finished()
+                continue
+            self.slots.acquire()
+            try:
+                job_registry.update(entry["hash"], "queued", template=entry["template"], compare=job.compare_mode,
+                                    render_key=job.render_key)
+                while True:
+                    try:
+                        scheduler.submit(job)
+                        break
+                    except queue.Full:
+                        # Wait for room in the queue, rather than turning the document away
+                        time.sleep(1)
+            except BaseException:
+                # The job never reached a worker, so it won't give its slot back
+                self.slots.release()
+                raise
+        # Wait for the last documents to finish
+        for index in range(scheduler.worker_count):
+            self.slots.acquire()
+
+        with metrics.time_stage("packing"):
+            output_path = self.pack()
+        shutil.rmtree(self.input_path, ignore_errors=True)
+        shutil.rmtree(self.results_path, ignore_errors=True)
+        failed = len([entry for entry in self.entries if entry["state"] != "done"])
+        logging.info("Batch %s finished, %d of %d documents failed", self.hashsum, failed, len(self.entries))
+        job_registry.update(self.hashsum, "done", zip=os.path.basename(output_path),
+                            documents=len(self.entries), finished=self.finished, failed=failed)
+        job_storage.store(self.hashsum, self.batch_path, job_registry.get(self.hashsum))
+
+        # Have the folder removed once clients have had time to fetch the ZIP file
+        janitor.schedule(self.batch_path)
+
+    def prepare(self, entry):
+        # Return a job to render a document, or None if its PDF is in the result cache
+        render_key = get_render_key(entry["hash"], entry["template"], "compare" in entry)
+        if result_cache is not None:
+            pdf_path = result_cache.lookup(render_key)
+            if pdf_path:
+                metrics.inc("md2pdf_cache_requests_total", cache="result", result="hit")
+                logging.info("Found cached PDF for '%s' in batch %s", entry["md"], self.hashsum)
+                link_file(pdf_path, os.path.join(self.results_path, entry["hash"] + ".pdf"))
+                result_cache.set_alias(entry["hash"], render_key)
+                job_registry.update(entry["hash"], "done", cached=True, render_key=render_key)
+                entry.update(state="done", cached=True)
+                return None
+            metrics.inc("md2pdf_cache_requests_total", cache="result", result="miss")
+
+        # Give the document its own folder, with links to the files next to it in the upload.
+        # Any PDF and log files are left out, as they would be taken for the job's output.
+        source_path = os.path.dirname(os.path.join(self.input_path, entry["md"]))
+        job_path = os.path.join(def_tempdir, entry["hash"])
+        shutil.rmtree(job_path, ignore_errors=True)
+        shutil.copytree(source_path, job_path, copy_function=link_file,
+                        ignore=shutil.ignore_patterns("*.pdf", "*.log"))
+        md_path = os.path.join(job_path, os.path.basename(entry["md"]))
+        if "compare" not in entry:
+            return BatchDocumentJob(self, entry, input_md=md_path, template=entry["template"],
+                                    hashsum=entry["hash"], render_key=render_key)
+
+        # Compare mode names its output after the "new" file, so make sure it has ".new" in its name
+        compare_path = os.path.join(job_path, os.path.basename(entry["compare"]))
+        if ".new" not in os.path.basename(md_path):
+            stem = os.path.splitext(md_path)[0]
+            os.link(md_path, stem + ".new.md")
+            os.link(compare_path, stem + ".old.md")
+            md_path, compare_path = stem + ".new.md", stem + ".old.md"
+        return BatchDocumentJob(self, entry, input_md=md_path, template=entry["template"], compare_mode=True,
+                                compare_md=compare_path, hashsum=entry["hash"], render_key=render_key)
+
+    def document_finished(self, job):
+        # Called on the render worker, so the output is taken before the job folder is deleted
+        entry = job.entry
+        status = job_registry.get(entry["hash"]) or {}
+        output_path = LocalJobStorage.find_in(os.path.dirname(job.md_file))
+        if status.get("state") == "done" and output_path and output_path.endswith(".pdf"):
+            entry["state"] = "done"
+        else:
+            entry.update(state="timed_out" if status.get("state") == "timed_out" else "failed",
+                         error=status.get("error") or "No PDF was produced")
+        if output_path:
+            try:
+                link_file(output_path, os.path.join(self.results_path, entry["hash"] + os.path.splitext(output_path)[1]))
+            except OSError as e:
+                logging.error("Unable to collect the output of '%s' from batch %s: %s", entry["md"], self.hashsum, e)
+        # The output is part of the batch now, so the job folder is not needed
+        janitor.schedule(os.path.dirname(job.md_file), 0)
+        self.count_finished()
+        self.slots.release()
+
+    def count_finished(self):
+        with self.lock:
+            self.finished += 1
+            if self.error is None:
+                job_registry.update(self.hashsum, "rendering", finished=self.finished)
+
+    def pack(self):
+        # Write the PDFs, the logs of failed documents and a manifest of the results into a ZIP file.
+        # PDFs are already compressed, so they are stored as they are.
+        output_path = os.path.join(self.batch_path, os.path.splitext(self.archive_name)[0] + "-pdf.zip")
+        manifest = []
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as out_zip:
+            for entry in self.entries:
+                result = {name: entry[name] for name in ("md", "compare", "template", "state", "error", "cached")
+                          if name in entry}
+                for extension in (".pdf", ".log"):
+                    result_file = os.path.join(self.results_path, entry["hash"] + extension)
+                    if not os.path.isfile(result_file) or (extension == ".log" and entry["state"] == "done"):
+                        continue
+                    archive_name = os.path.splitext(entry["output"])[0] + extension
+                    result["pdf" if extension == ".pdf" else "log"] = archive_name
+                    out_zip.write(result_file, archive_name,
+                                  zipfile.ZIP_STORED if extension == ".pdf" else zipfile.ZIP_DEFLATED)
+                manifest.append(result)
+            out_zip.writestr("manifest.json", json.dumps({"batch": self.hashsum, "documents": manifest}, indent=2))
+        return output_path
+
+
+def link_file(source, target):
+    # Hard link a file, or copy it where that is not possible (i.e. across file systems)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return target
+
+
+def read_batch_manifest(input_path, batch_hash, default_template):
+    # Read the list of documents from the manifest in an extracted batch upload. Returns one entry
+    # for each document, marking any that are invalid as failed. Raises ValueError if there is no
+    # usable manifest.
+    for name in batch_manifest_names:
+        manifest_path = os.path.join(input_path, name)
+        if os.path.isfile(manifest_path):
+            break
+    else:
+        raise ValueError("No manifest found, expected one of: " + ", ".join(batch_manifest_names))
+    try:
+        with open(manifest_path, 'rt', encoding="utf-8") as manifest_file:
+            # JSON is also valid YAML, so either format can be read
+            manifest = YAML(typ="safe").load(manifest_file)
+    except Exception as e:
+        raise ValueError("Unable to read '{}': {}".format(name, e))
+    if isinstance(manifest, dict):
+        manifest = manifest.get("documents")
+    if not isinstance(manifest, list) or not manifest:
+        raise ValueError("The manifest must list at least one document")
+
+    def check_md(path):
+        # Only accept Markdown files inside the upload
+        if not isinstance(path, str) or not path.endswith(".md"):
+            return False
+        full_path = os.path.normpath(os.path.join(input_path, path))
+        return full_path.startswith(input_path + os.sep) and os.path.isfile(full_path)
+
+    entries = []
+    outputs = set()
+    for index, item in enumerate(manifest):
+        if isinstance(item, str):
+            item = {"md": item}
+        if not isinstance(item, dict):
+            item = {}
+        md = item.get("md")
+        entry = {"md": md, "template": item.get("template") or default_template, "state": "queued"}
+        if item.get("compare"):
+            entry["compare"] = item["compare"]
+
+        # Name the PDF after the Markdown file, unless a name was given, and keep the names unique
+        output = item.get("output") or os.path.splitext(str(md))[0] + ".pdf"
+        output = os.path.normpath(str(output)).lstrip(os.sep)
+        if output.startswith(".."):
+            output = "document-{}.pdf".format(index + 1)
+        stem, extension = os.path.splitext(output)
+        count = 1
+        while output in outputs:
+            count += 1
+            output = "{}-{}{}".format(stem, count, extension)
+        outputs.add(output)
+        entry["output"] = output
+        # Each document is identified by the batch and its own settings, so a batch that is
+        # uploaded again can be served from the result cache
+        entry["hash"] = hashlib.sha256("\n".join([batch_hash, str(md), str(entry.get("compare")),
+                                                  str(entry["template"]), output]).encode("utf-8")).hexdigest()
+
+        if not check_md(md):
+            entry.update(state="failed", error="'md' must name a Markdown file in the upload")
+        elif "compare" in entry and (not check_md(entry["compare"]) or
+                                     os.path.dirname(os.path.normpath(entry["compare"])) != os.path.dirname(os.path.normpath(md))):
+            entry.update(state="failed", error="'compare' must name a Markdown file in the same folder as 'md'")
+        entries.append(entry)
+    return entries
+
+
+def start_batch(filename, spool, template):
+    # Extract a batch upload and start rendering the documents listed in its manifest, and return
+    # the message for the client
+    hashsum = spool.hexdigest()
+    batch_path = os.path.join(os.path.normpath(def_tempdir), hashsum)
+    try:
+        os.mkdir(batch_path)
+    except FileExistsError:
+        logging.info("Path already exists: %s", batch_path)
+        return "Batch has already been submitted, request the ZIP file using the hash value"
+
+    ## Extract the ZIP archive once, for all the documents in the batch
+    job_registry.update(hashsum, "extracting", batch=True, template=template)
+    input_path = os.path.join(batch_path, "input")
+    try:
+        with metrics.time_stage("extracting"):
+            zip_source = spool.save_as(os.path.join(def_tempdir, hashsum + ".zip"))
+            in_zip = zipfile.ZipFile(zip_source, 'r')
+            in_zip.extractall(input_path)
+        entries = read_batch_manifest(input_path, hashsum, template)
+    except (zipfile.BadZipFile, ValueError) as e:
+        logging.error("Unable to start batch '%s': %s", filename, e)
+        report_string = "Batch could not be started: {}".format(e)
+        with open(os.path.join(batch_path, "batch.log"), 'wt', encoding="utf-8") as log_file:
+            log_file.write(report_string + "\n")
+        shutil.rmtree(input_path, ignore_errors=True)
+        metrics.inc("md2pdf_failures_total", stage="extracting")
+        job_registry.update(hashsum, "failed", error=report_string, log="batch.log")
+        job_storage.store(hashsum, batch_path, job_registry.get(hashsum))
+        janitor.schedule(batch_path)
+        return report_string
+
+    logging.info("Batch '%s' lists %d documents", filename, len(entries))
+    job_registry.update(hashsum, "queued", documents=len(entries), finished=0)
+    BatchThread(hashsum, batch_path, entries, filename).start()
+    return "Batch of {} documents is being processed, request the ZIP file using the hash value".format(len(entries))
+
+
+def start_upload(path, filename, spool, template, compare_mode, document_id="", profile=None):
+    # Start the work for a file uploaded to "/upload" or "/batch". Raises ValueError if the upload
+    # asks for something the server can't do.
+    if path == "/batch":
+        if profile is not None and not profile.is_default():
+            raise ValueError("Render profiles can't be used for batches")
+        return start_batch(filename, spool, template)
+    return start_render(filename, spool, template, compare_mode, document_id, profile)
+
+
+def find_result(hashsum, render_key=None):
+    # Find the output for a hash: its PDF from the result cache or the job, or failing that the
+    # log (or a batch's ZIP file). If a render key is given, only the PDF of that render is
+    # accepted. Returns the path and the render key of the PDF (None if not known), or None and None.
+    if render_key is not None:
+        if not re.fullmatch("[0-9a-f]{64}", render_key):
+            return None, None
+        # A particular render can be served straight from the cache
+        if result_cache is not None:
+            pdf_path = result_cache.lookup(render_key)
+            if pdf_path:
+                return pdf_path, render_key
+
+    if result_cache is not None:
+        pdf_path = result_cache.lookup_hash(hashsum)
+        if pdf_path:
+            # Entries in the result cache are named after their render key
+            output_path, output_key = pdf_path, os.path.basename(os.path.dirname(pdf_path))
+        else:
+            output_path, output_key = None, None
+    else:
+        output_path, output_key = None, None
+    job = job_registry.get(hashsum)
+    if output_path is None and (job is None or job["state"] in JobRegistry.FINAL_STATES):
+        # While a file is being rendered, its job folder only holds part of the output
+        output_path = job_storage.find_output(hashsum)
+        if output_path and output_path.endswith(tuple(output_content_types)):
+            output_key = (job or job_storage.load_status(hashsum) or {}).get("render_key")
+        if output_path:
+            # Keep the job folder for longer, as its client is still interested in it
+            janitor.extend(os.path.join(def_tempdir, hashsum))
+    if render_key is not None and output_key != render_key:
+        return None, None
+    return output_path, output_key
+
+
+def result_etag(output_path, render_key):
+    # A PDF is identified by its render key, which covers the upload and everything used to render
+    # it. Anything else (or a PDF from an unknown render) is identified by its size and time.
+    if render_key:
+        return '"{}"'.format(render_key)
+    file_stat = os.stat(output_path)
+    return '"{:x}-{:x}"'.format(file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def etag_matches(header, etag):
+    # Check an If-None-Match header against an ETag
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or ("W/" + etag) in tags
+
+
+@functools.lru_cache(maxsize=None)
+def read_page(name):
+    # Read one of the web pages, and return it with its ETag. They are only read once.
+    with open(os.path.join(html_path, name), 'rb') as page_file:
+        data = page_file.read()
+    return data, '"{}"'.format(hashlib.sha256(data).hexdigest()[:32])
+
+
+def upload_report(size, filename, hashsum, report_string):
+    ## Create a short message to send back to the client
+    out = '''
+File received
+length: {}
+filename: {}
+hash: {}
+{}
+''' .format(size, filename, hashsum, report_string)
+    return out
+
+
+class App:
+    def busy_response(self):
+        # Tell the client to come back later, via a 503 and a "Retry-After" header.
+        # This is returned rather than raised, as CherryPy strips "Retry-After" from error pages.
+        retry_after = max(1, scheduler.estimate_wait())
+        cherrypy.response.status = 503
+        cherrypy.response.headers['Retry-After'] = str(retry_after)
+        return "Server is busy, please retry in {} seconds\n".format(retry_after)
+
+    @cherrypy.expose
+    def index(self):
+        return self.serve_page('index.html', 'text/html;charset=utf-8')
+
+    @cherrypy.expose
+    def style(self):
+        return self.serve_page('style.css', 'text/css;charset=utf-8')
+
+    def serve_page(self, name, content_type):
+        data, etag = read_page(name)
+        cherrypy.response.headers['Content-Type'] = content_type
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        if etag_matches(cherrypy.request.headers.get('If-None-Match'), etag):
+            cherrypy.response.status = 304
+            return b""
+        return data
+
+    @cherrypy.expose
+    @cherrypy.config(**{'request.body.part_class': UploadPart})
+    def upload(self, ufile):
+        return self.receive_upload(ufile, "/upload")
+
+    ## Render many documents from one upload, listed in a manifest inside the ZIP file
+    @cherrypy.expose
+    @cherrypy.config(**{'request.body.part_class': UploadPart})
+    def batch(self, ufile):
+        return self.receive_upload(ufile, "/batch")
+
+    def receive_upload(self, ufile, path):
+        logging.debug("Using temporary directory '%s'", def_tempdir)
+
+        ## The upload has normally been received and hashed by CherryPy already, via UploadPart
+        if isinstance(ufile.file, UploadSpool):
+            spool = ufile.file
+        else:
+            spool = UploadSpool()
+            while True:
+                data = ufile.file.read(upload_chunk_size)
+                if not data:
+                    break
+                spool.write(data)
+        metrics.observe_stage("receive", time.monotonic() - spool.created)
+        metrics.observe_stage("hash", spool.hash_time)
+        metrics.inc("md2pdf_upload_bytes_total", spool.size)
+        try:
+            return self.process_upload(ufile.filename, spool, path)
+        finally:
+            spool.close()
+
+    def process_upload(self, filename, spool, path):
+        ## Check that the client has set the "x-method" header
+        x_method = cherrypy.request.headers.get('x-method')
+        good_req = False
+        if isinstance(x_method, str):
+            if x_method == "MD-to-PDF":
+                good_req = True
+        if not good_req:
+            raise cherrypy.HTTPError(405, "This server only supports Markdown to PDF rendering, please check your request")
+        try:
+            template, compare_mode, document_id, profile = read_upload_headers(cherrypy.request.headers)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        hashsum = profile.job_hash(spool.hexdigest())
+
+        ## In a cluster, the server which owns the hash renders the file
+        owner = peer_ring.forward_to(hashsum, cherrypy.request.headers) if peer_ring is not None else None
+        if owner:
+            response = peer_ring.forward_upload(owner, filename, spool, cherrypy.request.headers, path)
+            if response is not None:
+                return self.relay_response(response)
+
+        try:
+            report_string = start_upload(path, filename, spool, template, compare_mode, document_id, profile)
+        except queue.Full:
+            return self.busy_response()
+        except RenderConflict as e:
+            raise cherrypy.HTTPError(409, str(e))
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+
+        ## Finally, actually send the response
+        return self.upload_response(spool.size, filename, hashsum, report_string)
+
+    def forward_request(self, owner, path, endpoint):
+        # Pass a request for a hash on to the server which owns it, streaming back its answer
+        headers = {}
+        for name in ('Accept', 'If-None-Match', 'Range', 'If-Range'):
+            if name in cherrypy.request.headers:
+                headers[name] = cherrypy.request.headers[name]
+        try:
+            response = peer_ring.forward("GET", owner + path, headers=headers,
+                                         params=cherrypy.request.params, stream=True)
+        except requests.RequestException as e:
+            logging.error("Unable to forward request for '%s' to '%s': %s", path, owner, e)
+            raise cherrypy.HTTPError(502, "The server which owns this hashsum could not be reached")
+        metrics.inc("md2pdf_forwarded_requests_total", endpoint=endpoint)
+        return self.relay_response(response)
+
+    def relay_response(self, response):
+        cherrypy.response.status = response.status_code
+        for name in relayed_headers:
+            if name in response.headers:
+                cherrypy.response.headers[name] = response.headers[name]
+        if 'hashsum' in response.cookies:
+            cherrypy.response.cookie['hashsum'] = response.cookies['hashsum']
+        cherrypy.response.stream = True
+        return response.iter_content(upload_chunk_size)
+
+    def upload_response(self, size, filename, hashsum, report_string):
+        ## Put the hash value in a cookie to send back to the client
+        cookie = cherrypy.response.cookie
+        cookie['hashsum'] = hashsum
+        return upload_report(size, filename, hashsum, report_string)
+
+    ## Provide a handler for checking on the progress of a job
+    @cherrypy.expose
+    def status(self, hashsum="", timeout=0, since=None, stream=None):
+        try:
+            timeout = min(float(timeout), max_status_wait)
+            since = int(since) if since is not None else None
+        except ValueError:
+            raise cherrypy.HTTPError(400, "The 'timeout' and 'since' parameters must be numbers")
+
+        job = job_registry.get(hashsum)
+        if job is None and result_cache is not None and result_cache.lookup_hash(hashsum):
+            # Rendered before the server was restarted
+            job_registry.update(hashsum, "done", cached=True)
+            job = job_registry.get(hashsum)
+        if job is None:
+            # Finished on another server, with shared storage
+            job = job_storage.load_status(hashsum)
+            if job is not None:
+                cherrypy.response.headers['Content-Type'] = 'application/json'
+                return json.dumps(job).encode("utf-8")
+        if job is None:
+            owner = peer_ring.forward_to(hashsum, cherrypy.request.headers) if peer_ring is not None else None
+            if owner:
+                return self.forward_request(owner, "/status/" + hashsum, "status")
+            raise cherrypy.HTTPError(404, ("No job was found for the given hashsum: " + hashsum))
+
+        # Send a stream of server-sent events if the client asked for one
+        accept = cherrypy.request.headers.get('Accept', "")
+        if stream is not None or "text/event-stream" in accept:
+            cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+            cherrypy.response.headers['Cache-Control'] = 'no-cache'
+            cherrypy.response.stream = True
+            return self.status_events(hashsum, since)
+
+        # Otherwise, wait for a change (or for the job to finish) before answering
+        if timeout > 0 and (since is not None or job["state"] not in JobRegistry.FINAL_STATES):
+            job = job_registry.wait(hashsum, since, timeout) or job
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(job).encode("utf-8")
+
+    def status_events(self, hashsum, since):
+        # Send an event each time the job changes, until it is finished
+        version = since if since is not None else -1
+        while True:
+            job = job_registry.wait(hashsum, version, status_heartbeat)
+            if job is None:
+                yield b"event: gone\ndata: {}\n\n"
+                return
+            if job["version"] == version:
+                # Nothing has changed, send a comment to keep the connection open
+                yield b": keep-alive\n\n"
+                continue
+            version = job["version"]
+            yield "id: {}\nevent: status\ndata: {}\n\n".format(version, json.dumps(job)).encode("utf-8")
+            if job["state"] in JobRegistry.FINAL_STATES:
+                return
+
+    ## Provide a handler for fetching a compiled PDF
+    @cherrypy.expose
+    def fetch(self, hashsum="", key=None):
+        with metrics.time_stage("fetch"):
+            return self.serve_result(hashsum, key)
+
+    def serve_result(self, hashsum, render_key):
+        # Serve the PDF from the result cache or the job, or the job's log if it did not produce one
+        output_path, output_key = find_result(hashsum, render_key)
+        if output_path:
+            etag = result_etag(output_path, output_key)
+            headers = cherrypy.response.headers
+            headers['ETag'] = etag
+            # A PDF fetched by its render key never changes, but the render for a hash can
+            headers['Cache-Control'] = 'public, max-age={}, immutable'.format(immutable_max_age) if render_key else 'no-cache'
+            if etag_matches(cherrypy.request.headers.get('If-None-Match'), etag):
+                cherrypy.response.status = 304
+                return b""
+            if cherrypy.request.headers.get('If-Range', etag) != etag:
+                # The client's partial copy is out of date, so send all of the file
+                cherrypy.request.headers.pop('Range', None)
+            if output_path.endswith(tuple(output_content_types)):
+                logging.info("Serving rendered file: %s", output_path)
+                metrics.inc("md2pdf_pdf_served_bytes_total", os.path.getsize(output_path))
+                content_type = output_content_types[os.path.splitext(output_path)[1]]
+            elif output_path.endswith(".zip"):
+                logging.info("Serving batch ZIP file: %s", output_path)
+                content_type = "application/zip"
+            else:
+                logging.info("Found error logfile: %s", output_path)
+                content_type = None
+            # This handles "Range" requests too
+            return cherrypy.lib.static.serve_file(output_path, content_type=content_type, disposition='attachment',
+                                                  name=os.path.basename(output_path))
+
+        # In a cluster, the job might belong to another server
+        owner = peer_ring.forward_to(hashsum, cherrypy.request.headers) if peer_ring is not None else None
+        if owner:
+            return self.forward_request(owner, "/fetch", "fetch")
+
+        # If we get to this point, we could not find a PDF or an error log
+        logging.critical("File not found for hash: %s", hashsum)
+        raise cherrypy.HTTPError(404, ("No file was found for the given hashsum: " + hashsum))
+
+    ## Provide a handler for the timeline and resource use of a job
+    @cherrypy.expose
+    def jobinfo(self, hashsum=""):
+        info = job_storage.load_info(hashsum)
+        if info is None:
+            owner = peer_ring.forward_to(hashsum, cherrypy.request.headers) if peer_ring is not None else None
+            if owner and job_registry.get(hashsum) is None:
+                return self.forward_request(owner, "/jobinfo/" + hashsum, "jobinfo")
+            raise cherrypy.HTTPError(404, ("No job information was found for the given hashsum: " + hashsum))
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return json.dumps(info).encode("utf-8")
+
+    ## Provide a handler for load balancers, which answers 503 until the warm-up has passed
+    @cherrypy.expose
+    def ready(self):
+        ready, report = readiness()
+        if not ready:
+            cherrypy.response.status = 503
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return json.dumps(report).encode("utf-8")
+
+    ## Provide a handler for monitoring, in the Prometheus text format
+    @cherrypy.expose
+    def metrics(self):
+        gauges = {
+            "md2pdf_queue_depth": scheduler.jobs.qsize(),
+            "md2pdf_active_workers": scheduler.active_workers,
+            "md2pdf_workers": scheduler.worker_count,
+            "md2pdf_janitor_pending_folders": janitor.pending(),
+            "md2pdf_temp_disk_used_percent": round(janitor.disk_usage(), 2),
+            "md2pdf_ready": int(readiness()[0]),
+        }
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.render(gauges).encode("utf-8")
+
+
+class AsyncHTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class AsyncRequest:
+    """One HTTP request received by the AsyncServer"""
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        url = urllib.parse.urlsplit(target)
+        self.path = urllib.parse.unquote(url.path)
+        self.params = {name: values[0] for name, values in urllib.parse.parse_qs(url.query).items()}
+        self.body_started = False
+        # Set once the whole body has been read, so the next request on the connection can follow it
+        self.body_done = False
+        self.writer = None
+
+    def keep_alive(self):
+        connection = self.headers.get("Connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+
+class AsyncServer:
+    """Serves the same endpoints as App from a single asyncio event loop, as an alternative to the
+    CherryPy thread pool. Slow uploads and downloads and waiting status requests don't hold a
+    thread each, so thousands of idle connections can be kept open. Work which blocks, such as
+    extracting uploads and forwarding requests to other servers, is run on a small thread pool."""
+    # How long an idle keep-alive connection is kept open, in seconds
+    IDLE_TIMEOUT = 75
+    # The longest request line and headers that will be accepted, in bytes
+    MAX_HEADER_SIZE = 65536
+    REASONS = {100: "Continue", 200: "OK", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request",
+               404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 416: "Range Not Satisfiable",
+               500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable"}
+
+    def __init__(self, host, port, blocking_threads=16):
+        self.host = host
+        self.port = port
+        self.blocking_threads = blocking_threads
+        # Maps a job hash to the events of the requests waiting for it to change
+        self.waiters = {}
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.blocking_threads, thread_name_prefix="async-blocking")
+        job_registry.add_listener(self.job_changed)
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                            limit=self.MAX_HEADER_SIZE, backlog=1024)
+        logging.info("Serving on http://%s:%d with asyncio", self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    def run_blocking(self, function, *args):
+        return self.loop.run_in_executor(self.executor, function, *args)
+
+    ## Connections and the HTTP protocol
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.send_response(writer, None, 400, "Request headers are too large\n")
+                    break
+                request = self.parse_head(head)
+                if request is None:
+                    await self.send_response(writer, None, 400, "Malformed request\n")
+                    break
+                request.writer = writer
+                try:
+                    await self.dispatch(request, reader, writer)
+                except AsyncHTTPError as e:
+                    await self.drain_body(request, reader)
+                    if not request.body_done:
+                        # The error came part way through the body, so the rest of it can't be told
+                        # apart from the next request: close the connection after answering
+                        request.headers["Connection"] = "close"
+                    await self.send_response(writer, request, e.status, e.message + "\n")
+                if not request.keep_alive():
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.error("Error while handling a connection: %s", e)
+        finally:
+            writer.close()
+
+    def parse_head(self, head):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            return None
+        headers = cherrypy.lib.httputil.HeaderMap()
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip()] = value.strip()
+        return AsyncRequest(method, target, version, headers)
+
+    async def body_chunks(self, request, reader):
+        # Yield the request body as it arrives, for both fixed-length and chunked bodies
+        limit = (max_upload_size + 65536) if max_upload_size else 0
+        if request.headers.get("Expect", "").lower() == "100-continue" and not request.body_started:
+            request.writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        request.body_started = True
+        received = 0
+        if "chunked" in request.headers.get("Transfer-Encoding", "").lower():
+            while True:
+                size_line = await reader.readuntil(b"\r\n")
+                size = int(size_line.split(b";")[0].strip(), 16)
+                if size == 0:
+                    # Skip any trailers
+                    while (await reader.readuntil(b"\r\n")) != b"\r\n":
+                        pass
+                    request.body_done = True
+                    return
+                received += size
+                if limit and received > limit:
+                    raise AsyncHTTPError(413, "Request body is larger than the limit of {} bytes".format(limit))
+                yield await reader.readexactly(size)
+                await reader.readexactly(2)
+        else:
+            try:
+                remaining = int(request.headers.get("Content-Length", 0))
+            except ValueError:
+                raise AsyncHTTPError(400, "Invalid Content-Length")
+            if limit and remaining > limit:
+                raise AsyncHTTPError(413, "Request body is larger than the limit of {} bytes".format(limit))
+            while remaining > 0:
+                data = await reader.read(min(remaining, upload_chunk_size))
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(data)
+                yield data
+            request.body_done = True
+
+    async def drain_body(self, request, reader):
+        # Read and discard whatever is left of the request body, so the connection can be reused
+        if request.body_started:
+            return
+        async for data in self.body_chunks(request, reader):
+            pass
+
+    def write_head(self, writer, request, status, headers):
+        lines = ["HTTP/1.1 {} {}".format(status, self.REASONS.get(status, ""))]
+        if request is None or not request.keep_alive():
+            headers["Connection"] = "close"
+        for name, value in headers.items():
+            lines.append("{}: {}".format(name, value))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def send_response(self, writer, request, status, body, headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        headers = dict(headers or {})
+        headers.setdefault("Content-Type", "text/plain;charset=utf-8")
+        if status != 304:
+            headers["Content-Length"] = str(len(body))
+        self.write_head(writer, request, status, headers)
+        if (request is None or request.method != "HEAD") and status != 304:
+            writer.write(body)
+        await writer.drain()
+
+    async def send_stream(self, writer, request, status, chunks, headers):
+        # Send a body of unknown length, chunked if the client understands it
+        headers = dict(headers)
+        chunked = request.version == "HTTP/1.1"
+        if chunked:
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            request.headers["Connection"] = "close"
+        self.write_head(writer, request, status, headers)
+        async for data in chunks:
+            if data:
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+                await writer.drain()
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def send_file(self, writer, request, path, content_type, attachment=False, etag=None,
+                        cache_control="no-cache"):
+        # Send a file, or the part of it asked for with a "Range" header
+        headers = {"Content-Type": content_type, "Accept-Ranges": "bytes", "Cache-Control": cache_control}
+        if etag:
+            headers["ETag"] = etag
+        if attachment:
+            headers["Content-Disposition"] = 'attachment; filename="{}"'.format(os.path.basename(path))
+        if etag and etag_matches(request.headers.get("If-None-Match"), etag):
+            return await self.send_response(writer, request, 304, b"", headers)
+
+        # Opening and looking at the file can block (i.e. on shared storage), so it is done on the thread pool
+        in_file = await self.run_blocking(open, path, 'rb')
+        try:
+            size = (await self.run_blocking(os.fstat, in_file.fileno())).st_size
+            status, offset, count = 200, 0, size
+            if "Range" in request.headers and request.headers.get("If-Range", etag) == etag:
+                ranges = cherrypy.lib.httputil.get_ranges(request.headers["Range"], size)
+                if ranges == []:
+                    headers["Content-Range"] = "bytes */{}".format(size)
+                    return await self.send_response(writer, request, 416, "Requested range not satisfiable\n", headers)
+                if ranges is not None and len(ranges) == 1:
+                    # Several ranges are answered with the whole file, which is also allowed
+                    start, stop = ranges[0]
+                    status, offset, count = 206, start, stop - start
+                    headers["Content-Range"] = "bytes {}-{}/{}".format(start, stop - 1, size)
+            headers["Content-Length"] = str(count)
+            self.write_head(writer, request, status, headers)
+            await writer.drain()
+            if request.method != "HEAD" and count:
+                # Uses sendfile() where possible, so the file does not pass through Python
+                await self.loop.sendfile(writer.transport, in_file, offset, count)
+        finally:
+            in_file.close()
+
+    ## Handlers for each endpoint
+    async def dispatch(self, request, reader, writer):
+        path = request.path.rstrip("/").split("/")
+        endpoint = path[1] if len(path) > 1 else "index"
+        if endpoint in ("upload", "batch"):
+            return await self.upload(request, reader, writer, "/" + endpoint)
+        await self.drain_body(request, reader)
+        if endpoint in ("index", "index.html"):
+            await self.send_page(writer, request, 'index.html', "text/html;charset=utf-8")
+        elif endpoint == "style":
+            await self.send_page(writer, request, 'style.css', "text/css;charset=utf-8")
+        elif endpoint == "fetch":
+            await self.fetch(request, writer, request.params.get("hashsum", ""), request.params.get("key"))
+        elif endpoint == "status":
+            await self.status(request, writer, path[2] if len(path) > 2 else request.params.get("hashsum", ""))
+        elif endpoint == "jobinfo":
+            await self.jobinfo(request, writer, path[2] if len(path) > 2 else request.params.get("hashsum", ""))
+        elif endpoint == "ready":
+            ready, report = readiness()
+            await self.send_response(writer, request, 200 if ready else 503, json.dumps(report),
+                                     {"Content-Type": "application/json", "Cache-Control": "no-cache"})
+        elif endpoint == "metrics":
+            gauges = {
+                "md2pdf_queue_depth": scheduler.jobs.qsize(),
+                "md2pdf_active_workers": scheduler.active_workers,
+                "md2pdf_workers": scheduler.worker_count,
+                "md2pdf_janitor_pending_folders": janitor.pending(),
+                "md2pdf_temp_disk_used_percent": round(await self.run_blocking(janitor.disk_usage), 2),
+                "md2pdf_ready": int(readiness()[0]),
+            }
+            await self.send_response(writer, request, 200, metrics.render(gauges),
+                                     {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+        else:
+            raise AsyncHTTPError(404, "The path '{}' was not found.".format(request.path))
+
+    async def receive_upload(self, request, reader):
+        # Read a multipart/form-data body as it arrives, writing the "ufile" field into an
+        # UploadSpool. Returns the file name and the spool.
+        match = re.search(r'boundary="?([^";]+)"?', request.headers.get("Content-Type", ""))
+        if not match:
+            raise AsyncHTTPError(400, "Expected a multipart/form-data upload")
+        delimiter = b"\r\n--" + match.group(1).encode("latin-1")
+        # Start with a line break, so that the first boundary matches the delimiter too
+        buffer = b"\r\n"
+        state = "preamble"
+        filename = None
+        spool = None
+        target = None
+        try:
+            async for data in self.body_chunks(request, reader):
+                buffer += data
+                while state != "done":
+                    if state == "headers":
+                        end = buffer.find(b"\r\n\r\n")
+                        if end < 0:
+                            if len(buffer) > self.MAX_HEADER_SIZE:
+                                raise AsyncHTTPError(400, "Malformed multipart upload")
+                            break
+                        part_headers = buffer[:end].decode("utf-8", "replace")
+                        buffer = buffer[end + 4:]
+                        name = re.search(r'\bname="([^"]*)"', part_headers)
+                        part_filename = re.search(r'\bfilename="([^"]*)"', part_headers)
+                        target = None
+                        if name and name.group(1) == "ufile" and part_filename and spool is None:
+                            filename = part_filename.group(1)
+                            spool = UploadSpool()
+                            target = spool
+                        state = "data"
+                        continue
+                    index = buffer.find(delimiter)
+                    if index < 0 or len(buffer) < index + len(delimiter) + 2:
+                        # Keep enough at the end to find a delimiter split across two reads
+                        keep = len(delimiter) + 2
+                        if index < 0 and len(buffer) > keep:
+                            if target is not None:
+                                target.write(buffer[:-keep])
+                            buffer = buffer[-keep:]
+                        break
+                    if target is not None:
+                        target.write(buffer[:index])
+                    ending = buffer[index + len(delimiter):index + len(delimiter) + 2]
+                    buffer = buffer[index + len(delimiter) + 2:]
+                    state = "done" if ending == b"--" else "headers"
+                if state == "done":
+                    buffer = b""
+        except cherrypy.HTTPError as e:
+            # The spool refused the upload, as it is too large
+            raise AsyncHTTPError(e.code, str(e._message))
+        except BaseException:
+            if spool is not None:
+                spool.close()
+            raise
+        if spool is None:
+            raise AsyncHTTPError(400, "No file was uploaded in the 'ufile' field")
+        return filename, spool
+
+    async def upload(self, request, reader, writer, path):
+        if request.method != "POST":
+            raise AsyncHTTPError(405, "Uploads must be sent with POST")
+        logging.debug("Using temporary directory '%s'", def_tempdir)
+        filename, spool = await self.receive_upload(request, reader)
+        try:
+            metrics.observe_stage("receive", time.monotonic() - spool.created)
+            metrics.observe_stage("hash", spool.hash_time)
+            metrics.inc("md2pdf_upload_bytes_total", spool.size)
+
+            ## Check that the client has set the "x-method" header
+            if request.headers.get('x-method') != "MD-to-PDF":
+                raise AsyncHTTPError(405, "This server only supports Markdown to PDF rendering, please check your request")
+            try:
+                template, compare_mode, document_id, profile = read_upload_headers(request.headers)
+            except ValueError as e:
+                raise AsyncHTTPError(400, str(e))
+            hashsum = profile.job_hash(spool.hexdigest())
+
+            ## In a cluster, the server which owns the hash renders the file
+            owner = peer_ring.forward_to(hashsum, request.headers) if peer_ring is not None else None
+            if owner:
+                response = await self.run_blocking(peer_ring.forward_upload, owner, filename, spool, request.headers, path)
+                if response is not None:
+                    headers = {"Content-Type": response.headers.get("Content-Type", "text/plain")}
+                    if "Retry-After" in response.headers:
+                        headers["Retry-After"] = response.headers["Retry-After"]
+                    if "hashsum" in response.cookies:
+                        headers["Set-Cookie"] = "hashsum=" + response.cookies["hashsum"]
+                    return await self.send_response(writer, request, response.status_code, response.content, headers)
+
+            try:
+                report_string = await self.run_blocking(start_upload, path, filename, spool, template, compare_mode,
+                                                           document_id, profile)
+            except ValueError as e:
+                raise AsyncHTTPError(400, str(e))
+            except RenderConflict as e:
+                raise AsyncHTTPError(409, str(e))
+            except queue.Full:
+                retry_after = max(1, scheduler.estimate_wait())
+                return await self.send_response(writer, request, 503,
+                                                "Server is busy, please retry in {} seconds\n".format(retry_after),
+                                                {"Retry-After": str(retry_after)})
+            await self.send_response(writer, request, 200,
+                                     upload_report(spool.size, filename, hashsum, report_string),
+                                     {"Set-Cookie": "hashsum=" + hashsum})
+        finally:
+            spool.close()
+
+    async def send_page(self, writer, request, name, content_type):
+        data, etag = await self.run_blocking(read_page, name)
+        headers = {"Content-Type": content_type, "ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return await self.send_response(writer, request, 304, b"", headers)
+        await self.send_response(writer, request, 200, data, headers)
+
+    async def fetch(self, request, writer, hashsum, render_key):
+        start_time = time.monotonic()
+        output_path, output_key = await self.run_blocking(find_result, hashsum, render_key)
+        if output_path:
+            metrics.observe_stage("fetch", time.monotonic() - start_time)
+            etag = await self.run_blocking(result_etag, output_path, output_key)
+            # A PDF fetched by its render key never changes, but the render for a hash can
+            cache_control = "public, max-age={}, immutable".format(immutable_max_age) if render_key else "no-cache"
+            if output_path.endswith(tuple(output_content_types)):
+                logging.info("Serving rendered file: %s", output_path)
+                metrics.inc("md2pdf_pdf_served_bytes_total", await self.run_blocking(os.path.getsize, output_path))
+                content_type = output_content_types[os.path.splitext(output_path)[1]]
+            elif output_path.endswith(".zip"):
+                logging.info("Serving batch ZIP file: %s", output_path)
+                content_type = "application/zip"
+            else:
+                logging.info("Found error logfile: %s", output_path)
+                content_type = "text/plain;charset=utf-8"
+            return await self.send_file(writer, request, output_path, content_type, attachment=True, etag=etag,
+                                        cache_control=cache_control)
+
+        # In a cluster, the job might belong to another server
+        owner = peer_ring.forward_to(hashsum, request.headers) if peer_ring is not None else None
+        if owner:
+            return await self.forward_request(request, writer, owner, "/fetch", "fetch")
+
+        logging.critical("File not found for hash: %s", hashsum)
+        raise AsyncHTTPError(404, "No file was found for the given hashsum: " + hashsum)
+
+    async def forward_request(self, request, writer, owner, path, endpoint):
+        # Pass a request on to the server which owns the hash, streaming back its answer
+        headers = {}
+        for name in ('Accept', 'If-None-Match', 'Range', 'If-Range'):
+            if name in request.headers:
+                headers[name] = request.headers[name]
+        try:
+            response = await self.run_blocking(functools.partial(
+                peer_ring.forward, "GET", owner + path, headers=headers, params=request.params, stream=True))
+        except requests.RequestException as e:
+            logging.error("Unable to forward request for '%s' to '%s': %s", path, owner, e)
+            raise AsyncHTTPError(502, "The server which owns this hashsum could not be reached")
+        metrics.inc("md2pdf_forwarded_requests_total", endpoint=endpoint)
+        relay_headers = {}
+        for name in relayed_headers:
+            if name in response.headers:
+                relay_headers[name] = response.headers[name]
+        if response.status_code == 304:
+            response.close()
+            return await self.send_response(writer, request, 304, b"", relay_headers)
+        chunk_iterator = response.iter_content(upload_chunk_size)
+
+        async def chunks():
+            try:
+                while True:
+                    data = await self.run_blocking(next, chunk_iterator, None)
+                    if data is None:
+                        return
+                    yield data
+            finally:
+                response.close()
+        await self.send_stream(writer, request, response.status_code, chunks(), relay_headers)
+
+    async def status(self, request, writer, hashsum):
+        try:
+            timeout = min(float(request.params.get("timeout", 0)), max_status_wait)
+            since = int(request.params["since"]) if "since" in request.params else None
+        except ValueError:
+            raise AsyncHTTPError(400, "The 'timeout' and 'since' parameters must be numbers")
+
+        job = job_registry.get(hashsum)
+        if job is None and result_cache is not None and await self.run_blocking(result_cache.lookup_hash, hashsum):
+            # Rendered before the server was restarted
+            job_registry.update(hashsum, "done", cached=True)
+            job = job_registry.get(hashsum)
+        if job is None:
+            # Finished on another server, with shared storage
+            job = await self.run_blocking(job_storage.load_status, hashsum)
+            if job is not None:
+                return await self.send_response(writer, request, 200, json.dumps(job),
+                                                {"Content-Type": "application/json"})
+            owner = peer_ring.forward_to(hashsum, request.headers) if peer_ring is not None else None
+            if owner:
+                return await self.forward_request(request, writer, owner, "/status/" + hashsum, "status")
+            raise AsyncHTTPError(404, "No job was found for the given hashsum: " + hashsum)
+
+        # Send a stream of server-sent events if the client asked for one
+        if "stream" in request.params or "text/event-stream" in request.headers.get("Accept", ""):
+            headers = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+            return await self.send_stream(writer, request, 200, self.status_events(hashsum, since), headers)
+
+        # Otherwise, wait for a change (or for the job to finish) before answering
+        if timeout > 0 and (since is not None or job["state"] not in JobRegistry.FINAL_STATES):
+            job = await self.wait_job(hashsum, since, timeout) or job
+        await self.send_response(writer, request, 200, json.dumps(job), {"Content-Type": "application/json"})
+
+    async def jobinfo(self, request, writer, hashsum):
+        info = await self.run_blocking(job_storage.load_info, hashsum)
+        if info is None:
+            owner = peer_ring.forward_to(hashsum, request.headers) if peer_ring is not None else None
+            if owner and job_registry.get(hashsum) is None:
+                return await self.forward_request(request, writer, owner, "/jobinfo/" + hashsum, "jobinfo")
+            raise AsyncHTTPError(404, "No job information was found for the given hashsum: " + hashsum)
+        await self.send_response(writer, request, 200, json.dumps(info),
+                                 {"Content-Type": "application/json", "Cache-Control": "no-cache"})
+
+    async def status_events(self, hashsum, since):
+        # Send an event each time the job changes, until it is finished
+        version = since if since is not None else -1
+        while True:
+            job = await self.wait_job(hashsum, version, status_heartbeat)
+            if job is None:
+                yield b"event: gone\ndata: {}\n\n"
+                return
+            if job["version"] == version:
+                # Nothing has changed, send a comment to keep the connection open
+                yield b": keep-alive\n\n"
+                continue
+            version = job["version"]
+            yield "id: {}\nevent: status\ndata: {}\n\n".format(version, json.dumps(job)).encode("utf-8")
+            if job["state"] in JobRegistry.FINAL_STATES:
+                return
+
+    ## Waiting for jobs to change, without a thread for each waiting request
+    def job_changed(self, hashsum):
+        # Called by the JobRegistry, from whichever thread changed the job
+        self.loop.call_soon_threadsafe(self.wake_waiters, hashsum)
+
+    def wake_waiters(self, hashsum):
+        for event in self.waiters.pop(hashsum, ()):
+            event.set()
+
+    async def wait_job(self, hashsum, since, timeout):
+        # The same as JobRegistry.wait, but waits on the event loop
+        deadline = self.loop.time() + timeout
+        while True:
+            # Register for changes before looking at the job, so none can be missed
+            event = asyncio.Event()
+            self.waiters.setdefault(hashsum, set()).add(event)
+            job = job_registry.get(hashsum)
+            remaining = deadline - self.loop.time()
+            if job is None or remaining <= 0 or \
+                    (since is None and job["state"] in JobRegistry.FINAL_STATES) or \
+                    (since is not None and job["version"] > since):
+                self.waiters.get(hashsum, set()).discard(event)
+                return job
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                events = self.waiters.get(hashsum)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self.waiters[hashsum]
 
 
 if __name__ == '__main__':
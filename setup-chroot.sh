@@ -58,6 +58,24 @@ do
     cp -a "${1}/usr/bin/${binary}" usr/bin/
 done
 
+# Copy ImageMagick from Snap (or from base if not running as Snap), for scaling down images. On
+# Debian and Ubuntu, "convert" is a link through /etc/alternatives to the versioned binary, so copy
+# the binary itself. Its libraries and coders come with usr/lib below, its policy and delegate
+# files are in etc, and its locale files are in usr/share.
+imagemagick=$(ls "${1}"/usr/bin/convert-im* 2>/dev/null | head -n 1)
+if [ -z "${imagemagick}" ]
+then
+    imagemagick="${1}/usr/bin/convert"
+fi
+if [ -e "${imagemagick}" ]
+then
+    cp -L "${imagemagick}" usr/bin/convert
+    cp -ar "${1}"/etc/ImageMagick-* etc/
+    cp -ar "${1}"/usr/share/ImageMagick-* usr/share/
+else
+    echo "ImageMagick was not found, so images can't be scaled down (see the 'graphics' setting)"
+fi
+
 # Copy from Snap (or from base if not running as Snap)
 usr_share_dirs=("fonts" "i18n" "locale" "locales" "perl" "ghostscript")
 for folder in "${usr_share_dirs[@]}"